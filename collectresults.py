@@ -4,97 +4,82 @@
 import glob
 import sys
 import os.path
-import codecs
+import getopt
+import wsd2scoring
 
-basedir = sys.argv[1]
+def usage():
+    print >> sys.stderr,"Usage: collectresults.py [-s resultsstore] [-k topconfigurations] [-m precision|recall] [-r] basedir"
+    print >> sys.stderr," -s [file]    Results store, default: [basedir]/results.sqlite"
+    print >> sys.stderr," -k [int]     Number of best configurations to list per lemma (default: 3)"
+    print >> sys.stderr," -m [metric]  Rank and report by precision (default) or recall"
+    print >> sys.stderr," -r           Reload the results files of all configurations into the store, not just of those not in the store yet"
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "s:k:m:r")
+except getopt.GetoptError, err:
+    print str(err)
+    usage()
+    sys.exit(2)
+
+if len(args) != 1:
+    usage()
+    sys.exit(2)
+
+basedir = args[0]
+storefile = basedir + '/results.sqlite'
+k = 3
+metric = 'precision'
+RELOAD = False
+
+for o, a in opts:
+    if o == '-s':
+        storefile = a
+    elif o == '-k':
+        k = int(a)
+    elif o == '-m':
+        metric = a
+    elif o == '-r':
+        RELOAD = True
+    else:
+        raise Exception("Unknown option: " + o)
 
 languages = ['nl','es','it','de','fr']
-confs = set()
 
-bestdata = {}
-oofdata = {}
+store = wsd2scoring.ResultsStore(storefile)
 
+#Runs record their scores in the store as they complete, only results files of runs that did not (yet) have to be read
 for lang in languages:
-    bestdata[lang] = {}
-    oofdata[lang] = {}
-    
     for confdir in glob.glob(basedir + '/' + lang + '/*'):
         conf = os.path.basename(confdir)
         if os.path.isdir(confdir) and (conf[0] == 'c' or conf == 'baseline' or conf[0] == 'v'):
-            confs.add(conf)
-            if os.path.exists(confdir + '/results'):
+            if os.path.exists(confdir + '/results') and (RELOAD or not (lang, conf) in store):
                 print >>sys.stderr,"Processing " + confdir + '/results'
-                mode = ''
-                f = codecs.open(confdir + '/results','r','utf-8')
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        if line[:4] == 'BEST':
-                            mode = 'best'
-                        elif line[:3] == 'OUT':
-                            mode = 'oof'
-                        elif line[0] != '-':
-                            fields = line.split("\t")
-                            lemma = fields[0].strip(':')
-                            if lemma == 'AVERAGE':
-                                lemma = 'OVERALL'
-                            score = float(fields[1])
-                            if mode == 'best':
-                                if not lemma in bestdata[lang]: 
-                                    bestdata[lang][lemma] = {}
-                                bestdata[lang][lemma][conf] = score
-                            elif mode == 'oof':
-                                if not lemma in oofdata[lang]: 
-                                    oofdata[lang][lemma] = {}
-                                oofdata[lang][lemma][conf] = score                                
-                f.close()
+                store.load(lang, conf, confdir + '/results')
+store.commit()
 
+confs = store.configurations()
 
-print "TYPE\tLANG\tLEMMA\tFIRST\tSECOND\tTHIRD",
-for conf in sorted(confs):
-    print "\t" + conf,
+ranks = ['FIRST','SECOND','THIRD']
+print "TYPE\tLANG\tLEMMA\t" + "\t".join( ranks[i] if i < len(ranks) else 'TOP' + str(i+1) for i in range(k) ),
+for conf in confs:
+    print "\t" + conf.encode('utf-8'),
 print
 
 for lang in languages:
-    if lang in bestdata:
-        lemmas = set(bestdata[lang]) | set(oofdata[lang])
-        
-        for lemma in sorted(lemmas):
-            print "best\t" + lang + "\t" + lemma.encode('utf-8'),
-            if lemma in bestdata[lang]:
-                bestconfs = [ conf for conf, score in sorted(bestdata[lang][lemma].items(), key=lambda x: x[1] * -1)[:3] ]
-                if len(bestconfs) < 3:
-                    bestconfs += ["-"] * (3 - len(bestconfs))
-                for conf in bestconfs: 
-                    print "\t" + conf,
-                for conf in sorted(confs):
-                    if conf in bestdata[lang][lemma]:
-                        print "\t" + str(bestdata[lang][lemma][conf]),
-                    else:
-                        print "\t0",
-            else:
-                print "-\t-\t-",
-                for conf in sorted(confs):
+    for lemma in store.lemmas(lang):
+        for scoretype in ('best','oof'):
+            print scoretype + "\t" + lang + "\t" + lemma.encode('utf-8'),
+            scores = store.scores(lang, lemma, scoretype, metric)
+            topconfs = [ conf.encode('utf-8') for conf, score in store.top(lang, lemma, scoretype, metric, k) ]
+            if len(topconfs) < k:
+                topconfs += ["-"] * (k - len(topconfs))
+            for conf in topconfs:
+                print "\t" + conf,
+            for conf in confs:
+                if conf in scores:
+                    print "\t" + str(scores[conf]),
+                else:
                     print "\t0",
             print
-            
-            print "oof\t" + lang + "\t" + lemma.encode('utf-8'),
-            if lemma in oofdata[lang]:
-                bestconfs =  [ conf for conf, score in sorted(oofdata[lang][lemma].items(), key=lambda x: x[1] * -1)[:3] ]
-                if len(bestconfs) < 3:
-                    bestconfs += ["-"] * (3 - len(bestconfs) )               
-                for conf in bestconfs: 
-                    print "\t" + conf,
-                for conf in sorted(confs):
-                    if conf in oofdata[lang][lemma]:
-                        print "\t" + str(oofdata[lang][lemma][conf]),
-                    else:
-                        print "\t0",
-            else:
-                print "-\t-\t-",
-                for conf in sorted(confs):
-                    print "\t0",
-            print            
-            
-            
 
+store.close()
@@ -103,10 +103,6 @@ def compute(targetlang, c,pos,lemma,bag):
             extractor = campyon.Campyon('-f',filename, '-o',outputfile,'-k',keep)
             extractor()
         
-    if bag:
-        for filename in glob.glob(basedir + '/' + targetlang + '/' + reference + '/*.bag'):
-            shutil.copyfile(filename,outputdir + '/' + os.path.basename(filename))            
-    
     if DOTRAIN:
         cmd = 'python ' + WSDDIR + '/wsd2.py --nogen --train -L ' + targetlang + ' -o ' + outputdir + ' -w ' + targetwords
         cmd += ' -c ' + str(c)
@@ -130,7 +126,14 @@ def compute(targetlang, c,pos,lemma,bag):
     cmd += ' -c ' + str(c)
     if pos: cmd += ' -p'
     if lemma: cmd += ' -l'
-    if bag: cmd += ' -b'
+    if bag:
+        cmd += ' -b'
+        #reference the bags of the reference run rather than copying them
+        if os.path.exists(basedir + '/' + targetlang + '/' + reference + '/bags.sqlite'):
+            cmd += ' --bagstore=' + basedir + '/' + targetlang + '/' + reference + '/bags.sqlite'
+        else:
+            cmd += ' --bagstore=' + basedir + '/' + targetlang + '/' + reference
+    cmd += ' --resultsstore=' + basedir + '/results.sqlite' #scores of all runs, see collectresults.py
     cmd += ' --Stagger=freeling:localhost:1850'
     cmd += ' >&2 2> ' + outputdir + '/test.log'
     print >>sys.stderr,"Testing "+ targetlang + " " + id + ": " + cmd               
@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wsd2
+
+
+class BagStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        bag = [ (u'bus', u'n', u'trainer', 3, 0.5), (u'team', u'n', u'trainer', 4, 0.25) ]
+        store = wsd2.BagStore(self.dir + '/bags.sqlite', 'nl', True)
+        store.write(u'coach', u'n', bag)
+        store.commit()
+        store.close()
+
+        store = wsd2.BagStore(self.dir + '/bags.sqlite', 'nl')
+        self.assertTrue( (u'coach',u'n') in store )
+        self.assertFalse( (u'ring',u'n') in store )
+        self.assertEqual(store.bag(u'coach', u'n'), bag)
+
+    def test_missing(self):
+        """Opening a store that does not exist fails, and does not create it"""
+        self.assertRaises(Exception, wsd2.BagStore, self.dir + '/bgas.sqlite', 'nl')
+        self.assertFalse(os.path.exists(self.dir + '/bgas.sqlite'))
+
+    def test_notabagstore(self):
+        db = sqlite3.connect(self.dir + '/results.sqlite')
+        db.execute("CREATE TABLE results (lang TEXT)")
+        db.close()
+        self.assertRaises(Exception, wsd2.BagStore, self.dir + '/results.sqlite', 'nl')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import codecs
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wsd2
+from pynlpl.formats.moses import PhraseTable
+
+#source ||| target ||| alignment ||| alignment ||| scores, as loaded by the baseline
+PHRASETABLE = u"""coach ||| trainer ||| (0) ||| (0) ||| 0.6 0.5 0.7 0.4 2.718
+coach ||| bus ||| (0) ||| (0) ||| 0.3 0.2 0.25 0.1 2.718
+coach ||| de bus ||| (0) ||| () (0) ||| 0.1 0.1 0.05 0.1 2.718
+coaches ||| trainers ||| (0) ||| (0) ||| 0.8 0.5 0.9 0.4 2.718
+coaches ||| bussen ||| (0) ||| (0) ||| 0.2 0.2 0.1 0.1 2.718
+going ||| gaan ||| (0) ||| (0) ||| 1 1 1 1 2.718
+go ||| gaan ||| (0) ||| (0) ||| 1 1 1 1 2.718
+mice ||| muizen ||| (0) ||| (0) ||| 0.9 0.8 0.9 0.8 2.718
+mice ||| de muizen ||| (0) ||| () (0) ||| 0.1 0.1 0.1 0.1 2.718
+mouse ||| muis ||| (0) ||| (0) ||| 1 1 1 1 2.718
+red ||| rood ||| (0) ||| (0) ||| 1 1 1 1 2.718
+the coach ||| de trainer ||| (0) (1) ||| (0) (1) ||| 1 1 1 1 2.718
+went ||| ging ||| (0) ||| (0) ||| 0.7 0.6 0.8 0.5 2.718
+went ||| gingen ||| (0) ||| (0) ||| 0.3 0.2 0.2 0.1 2.718
+"""
+
+TARGETWORDS = { (u'coach',u'n'): True, (u'mouse',u'n'): True, (u'go',u'v'): True }
+
+#(words, postags, lemmas) as a tagger would return them
+TAGGED = [
+    ([u'the', u'mice', u'went', u'red'], [u'DT', u'NNS', u'VBD', u'JJ'], [u'the', u'mouse', u'go', u'red']),
+    ([u'coaches', u'go', u'going'], [u'NNS', u'VBP', u'VBG'], [u'coach', u'go', u'go']),
+    ([u'a', u'mouse', u'and', u'a', u'coach'], [u'DT', u'NN', u'CC', u'DT', u'NN'], [u'a', u'mouse', u'and', u'a', u'coach']),
+    ([u'they', u'coach'], [u'PRP', u'VBP'], [u'they', u'coach']),
+]
+
+
+class ListTagger(object):
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.cursor = 0
+
+    def process(self, words):
+        sentence = self.sentences[self.cursor]
+        self.cursor += 1
+        return sentence
+
+    def reset(self):
+        self.cursor = 0
+
+
+class FilteredPhraseTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = self.dir + '/phrase-table'
+        f = codecs.open(self.filename,'w','utf-8')
+        f.write(PHRASETABLE)
+        f.close()
+        self.full = PhraseTable(self.filename, True, False, "|||", 5)
+
+        self.corpusfile = self.dir + '/corpus.en'
+        f = codecs.open(self.corpusfile,'w','utf-8')
+        for words, postags, lemmas in TAGGED:
+            f.write(u' '.join(words) + u'\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def expected(self, source):
+        """The (target, Pst, Pts, null_alignments) tuples for a source word according to the full phrase table"""
+        nulls = {}
+        for line in PHRASETABLE.split(u'\n'):
+            if line:
+                segments = [ segment.strip() for segment in line.split(u'|||') ]
+                nulls[(segments[0], segments[1])] = segments[3].count(u'()')
+        return tuple( (target, scores[0], scores[2], nulls[(source, target)]) for target, scores in self.full[source] )
+
+    def assertAgrees(self, phrasetable, sources):
+        for source in sources:
+            self.assertTrue(source in self.full)
+            self.assertTrue(source in phrasetable, source + " is missing")
+            self.assertEqual(phrasetable[source], self.expected(source))
+
+    def test_stems(self):
+        """Without word forms, the lemmas and their regular inflections are kept, in the five-field layout"""
+        phrasetable = wsd2.FilteredPhraseTable(self.filename, TARGETWORDS)
+        self.assertAgrees(phrasetable, [u'coach', u'coaches', u'mouse', u'go', u'going'])
+        self.assertEqual(phrasetable[u'coach'][2], (u'de bus', 0.1, 0.05, 1))
+        #the documented loss: irregular inflections do not share the stem
+        self.assertFalse(u'mice' in phrasetable)
+        self.assertFalse(u'went' in phrasetable)
+        self.assertFalse(u'red' in phrasetable)
+        self.assertFalse(u'the coach' in phrasetable)
+
+    def test_wordforms(self):
+        """With the word forms tagged with a target word, all lookups by those word forms agree with the full table"""
+        wsd2.TaggedCorpus.build(self.corpusfile + '.tagstore', self.corpusfile, ListTagger(TAGGED), 'list')
+        store = wsd2.TaggedCorpus(self.corpusfile + '.tagstore')
+        wordforms = store.wordforms(TARGETWORDS)
+        self.assertEqual(wordforms, set([u'coach', u'coaches', u'mouse', u'mice', u'go', u'going', u'went']))
+
+        phrasetable = wsd2.FilteredPhraseTable(self.filename, TARGETWORDS, wordforms)
+        self.assertAgrees(phrasetable, wordforms)
+        self.assertFalse(u'red' in phrasetable)
+
+        #the sidecar file holds the same table
+        self.assertEqual(wsd2.FilteredPhraseTable(self.filename, TARGETWORDS, wordforms).phrasetable, phrasetable.phrasetable)
+        self.assertFalse(u'mice' in wsd2.FilteredPhraseTable(self.filename, TARGETWORDS))
+
+    def test_columns(self):
+        """Other layouts are read by specifying the columns"""
+        f = codecs.open(self.filename,'w','utf-8')
+        f.write(u"coach ||| trainer ||| 0.6 0.5 0.7 0.4\ncoach ||| bus ||| 0.3\n")
+        f.close()
+        phrasetable = wsd2.FilteredPhraseTable(self.filename, TARGETWORDS, None, "|||", 3, 0)
+        self.assertEqual(phrasetable[u'coach'], ((u'trainer', 0.6, 0.7, 0), (u'bus', 0.3, 0.3, 0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import codecs
+import glob
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wsd2
+from pynlpl.tagger import Tagger
+from pynlpl.formats.giza import GizaModel
+
+SOURCEVOCAB = "the a coach bus drove players team ticket train match game fire ring boxing wedding gold rest of day we took big small red".split()
+TARGETVOCAB = "de een trainer|bus bus reed spelers team kaartje trein wedstrijd|lucifer spel vuur ring|kring boksen bruiloft goud rust van dag wij namen groot klein rood".split()
+NOUNS = ('coach','ring','match','bus','ticket','train','game','players')
+
+
+class InstanceTrainer(wsd2.CLWSD2Trainer):
+    """Trainer that only writes the bags and the training instances, the classifiers themselves are not trained"""
+
+    def run2(self):
+        for classifier in self.classifiers.values():
+            classifier.flush()
+
+
+def writetagged(f, words):
+    f.write(u' '.join( word + u'|' + (word[:-1] if word.endswith(u's') else word) + u'|' + (u'N' if word in NOUNS else u'V') for word in words ) + u'\n')
+
+
+class ShardingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """A small parallel corpus, GIZA++ alignments in both directions, tagger output for both sides, and tagged corpus stores"""
+        cls.dir = tempfile.mkdtemp()
+        random.seed(1)
+        f_source = codecs.open(cls.dir + '/corpus.en','w','utf-8')
+        f_target = codecs.open(cls.dir + '/corpus.nl','w','utf-8')
+        f_sourcetagged = codecs.open(cls.dir + '/corpus.en.tagged','w','utf-8')
+        f_targettagged = codecs.open(cls.dir + '/corpus.nl.tagged','w','utf-8')
+        f_s2t = codecs.open(cls.dir + '/s2t.A3.final','w','utf-8')
+        f_t2s = codecs.open(cls.dir + '/t2s.A3.final','w','utf-8')
+        for n in range(200):
+            source = [ random.choice(SOURCEVOCAB) for i in range(random.randint(4,12)) ]
+            target = [ random.choice(TARGETVOCAB[SOURCEVOCAB.index(word)].split('|')) for word in source ]
+            if n % 3 == 0:
+                target.reverse()
+                align = lambda k: len(source) - 1 - k
+            else:
+                align = lambda k: k
+            f_source.write(u' '.join(source) + u'\n')
+            f_target.write(u' '.join(target) + u'\n')
+            writetagged(f_sourcetagged, source)
+            writetagged(f_targettagged, target)
+            f_s2t.write(u"# Sentence pair (%d)\n%s\nNULL ({ }) %s\n" % (n+1, u' '.join(target), u' '.join( u"%s ({ %d })" % (word, align(k)+1) for k, word in enumerate(source) )))
+            f_t2s.write(u"# Sentence pair (%d)\n%s\nNULL ({ }) %s\n" % (n+1, u' '.join(source), u' '.join( u"%s ({ %d })" % (word, align(k)+1) for k, word in enumerate(target) )))
+        for f in (f_source, f_target, f_sourcetagged, f_targettagged, f_s2t, f_t2s):
+            f.close()
+
+        f = open(cls.dir + '/targetwords','w')
+        f.write("coach\tn\nring\tn\nmatch\tn\n")
+        f.close()
+
+        wsd2.phrasetablefile = ''
+        cls.sourcestore = wsd2.TaggedCorpus.load(cls.dir + '/corpus.en', cls.tagger('en'), 'file:corpus.en.tagged')
+        cls.targetstore = wsd2.TaggedCorpus.load(cls.dir + '/corpus.nl', cls.tagger('nl'), 'file:corpus.nl.tagged')
+        cls.alignments = wsd2.AlignmentStore.load(cls.dir + '/corpus.align', cls.dir + '/s2t.A3.final', cls.dir + '/t2s.A3.final')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    @classmethod
+    def tagger(cls, lang):
+        return Tagger('file', cls.dir + '/corpus.' + lang + '.tagged')
+
+    def train(self, name, workers, alignments = False, store = True, singlepass = False):
+        """Train into a fresh output directory, returns the bags (all rows of bags.sqlite) and the contents of all .train files"""
+        outputdir = self.dir + '/' + name
+        os.mkdir(outputdir)
+        if store:
+            sourcetagger, targettagger = self.sourcestore, self.targetstore
+        else:
+            sourcetagger, targettagger = self.tagger('en'), self.tagger('nl')
+        if alignments:
+            gizamodels = (None, None)
+            kwargs = { 'alignments': self.alignments }
+        else:
+            gizamodels = (GizaModel(self.dir + '/s2t.A3.final'), GizaModel(self.dir + '/t2s.A3.final'))
+            kwargs = { 'gizafiles': (self.dir + '/s2t.A3.final', self.dir + '/t2s.A3.final') }
+
+        stderr = sys.stderr
+        sys.stderr = open(outputdir + '.log','w')
+        try:
+            trainer = InstanceTrainer(outputdir, 'nl', None, gizamodels[0], gizamodels[1], self.dir + '/corpus.en', self.dir + '/corpus.nl', self.dir + '/targetwords', sourcetagger, targettagger, 1, True, True, False, False, '-a 0', True, False, 2, 0.001, 1, singlepass=singlepass, workers=workers, **kwargs)
+            trainer.run()
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+
+        db = sqlite3.connect(outputdir + '/bags.sqlite')
+        bags = db.execute("SELECT * FROM bags ORDER BY targetlang, focuslemma, focuspos, keylemma, keypos, sense").fetchall()
+        db.close()
+        instances = {}
+        for filename in glob.glob(outputdir + '/*.train'):
+            f = open(filename,'rb')
+            instances[os.path.basename(filename)] = f.read()
+            f.close()
+        return bags, instances
+
+    def assertSameOutput(self, output, reference):
+        bags, instances = output
+        referencebags, referenceinstances = reference
+        self.assertEqual(bags, referencebags)
+        self.assertEqual(sorted(instances), sorted(referenceinstances))
+        for filename in referenceinstances:
+            self.assertEqual(instances[filename], referenceinstances[filename], filename + " differs")
+
+    def test_giza(self):
+        reference = self.train('giza1', 1)
+        self.assertTrue(reference[0])
+        self.assertEqual(sorted(reference[1]), ['coach.n.nl.train','match.n.nl.train','ring.n.nl.train'])
+        self.assertSameOutput(self.train('giza3', 3), reference)
+        #the store must yield exactly what the tagger does
+        self.assertSameOutput(self.train('giza1tagger', 1, store=False), reference)
+
+    def test_alignments(self):
+        reference = self.train('align1', 1, alignments=True)
+        self.assertSameOutput(self.train('align3', 3, alignments=True), reference)
+        self.assertSameOutput(self.train('alignvsgiza1', 1), reference)
+
+    def test_singlepass(self):
+        reference = self.train('singlepass1', 1, alignments=True, singlepass=True)
+        self.assertSameOutput(self.train('singlepass3', 3, alignments=True, singlepass=True), reference)
+
+
+if __name__ == '__main__':
+    unittest.main()
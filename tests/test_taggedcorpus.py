@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import codecs
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wsd2
+from pynlpl.tagger import Tagger
+
+
+class ListTagger(object):
+    """Tagger returning (words, postags, lemmas) from a list, in order"""
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.cursor = 0
+
+    def process(self, words):
+        sentence = self.sentences[self.cursor]
+        self.cursor += 1
+        return sentence
+
+    def reset(self):
+        self.cursor = 0
+
+
+class TaggedCorpusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.corpusfile = self.dir + '/corpus.txt'
+        self.prefix = self.corpusfile + '.tagstore'
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writecorpus(self, sentences):
+        f = codecs.open(self.corpusfile,'w','utf-8')
+        for words, postags, lemmas in sentences:
+            f.write(u' '.join(words) + u'\n')
+        f.close()
+
+    def test_filetagger(self):
+        """Every sentence of the store equals the output of the file-based Tagger it was built with, whose last tag of a sentence comes with the newline"""
+        words = [u'the', u'coach', u'drove', u'job', u'w1', u'team', u'ring', u'rings']
+        sentences = []
+        f = codecs.open(self.dir + '/corpus.tagged','w','utf-8')
+        for i in range(60):
+            sentence = [ words[(i * 7 + j * 3) % len(words)] for j in range(2 + i % 6) ]
+            f.write(u' '.join( word + u'|' + word.rstrip(u's') + u'|' + (u'N' if j % 2 else u'V') for j, word in enumerate(sentence) ) + u'\n')
+            sentences.append( (sentence, None, None) )
+        f.close()
+        self.writecorpus(sentences)
+
+        wsd2.TaggedCorpus.build(self.prefix, self.corpusfile, Tagger('file', self.dir + '/corpus.tagged'), 'file:corpus.tagged')
+        store = wsd2.TaggedCorpus(self.prefix)
+        self.assertEqual(len(store), len(sentences))
+
+        tagger = Tagger('file', self.dir + '/corpus.tagged')
+        for i in range(len(store)):
+            words, postags, lemmas = tagger.process(None)
+            self.assertEqual(store[i], ([ x.strip() for x in words ], [ x.strip() for x in postags ], [ x.strip() for x in lemmas ]))
+
+    def test_linebreaks(self):
+        """Tokens with characters that codecs counts as line breaks survive the round trip"""
+        sentences = [
+            ([u'a\x85b', u'coach'], [u'N', u'N'], [u'a\x85b', u'coach']),
+            ([u'job', u'x y', u'c\rd'], [u'N', u'V\n', u'N'], [u'job', u'x y', u'c\rd']),
+            ([u'fin', u'coach'], [u'N', u'N'], [u'fin', u'coach']),
+        ]
+        self.writecorpus( ([u'w'], None, None) for x in sentences )
+
+        wsd2.TaggedCorpus.build(self.prefix, self.corpusfile, ListTagger(sentences), 'list')
+        store = wsd2.TaggedCorpus(self.prefix)
+        self.assertEqual(len(store), len(sentences))
+        for i, (words, postags, lemmas) in enumerate(sentences):
+            self.assertEqual(store[i], ([ x.strip() for x in words ], [ x.strip() for x in postags ], [ x.strip() for x in lemmas ]))
+
+    def test_uptodate(self):
+        """A store is only up to date for the tagger it was built with, in the current format"""
+        sentences = [ ([u'job'], [u'N'], [u'job']) ]
+        self.writecorpus(sentences)
+        wsd2.TaggedCorpus.build(self.prefix, self.corpusfile, ListTagger(sentences), 'list')
+        self.assertTrue(wsd2.TaggedCorpus.uptodate(self.prefix, self.corpusfile, 'list'))
+        self.assertFalse(wsd2.TaggedCorpus.uptodate(self.prefix, self.corpusfile, 'other'))
+
+        #a store of the first format only has the tagger specification
+        f = codecs.open(self.prefix + '.info','w','utf-8')
+        f.write(u'list\n')
+        f.close()
+        self.assertFalse(wsd2.TaggedCorpus.uptodate(self.prefix, self.corpusfile, 'list'))
+
+
+if __name__ == '__main__':
+    unittest.main()
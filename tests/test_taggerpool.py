@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import time
+import threading
+import SocketServer
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wsd2
+from pynlpl.tagger import Tagger
+
+
+class FrogHandler(SocketServer.StreamRequestHandler):
+    """Speaks the Frog server protocol: tags each sentence (terminated by EOT) after a delay that depends on its length, so concurrent requests complete out of order"""
+
+    def handle(self):
+        sentence = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.strip()
+            if line != 'EOT':
+                sentence = line
+                continue
+            words = sentence.split(' ')
+            with self.server.lock:
+                self.server.active += 1
+                self.server.maxactive = max(self.server.maxactive, self.server.active)
+            time.sleep(0.002 * (len(words) % 5))
+            response = ''
+            for i, word in enumerate(words):
+                response += '\t'.join([str(i+1), word, word.lower(), '[' + word.lower() + ']', ('N' if len(word) % 2 else 'V') + '(' + str(self.server.server_address[1]) + ')', '0.9']) + '\n'
+            with self.server.lock:
+                self.server.active -= 1
+            self.wfile.write(response + 'READY\n')
+            self.wfile.flush()
+
+
+class FrogServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), FrogHandler)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.maxactive = 0
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def spec(self):
+        return 'frog:127.0.0.1:' + str(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+SENTENCES = [ [ word for word in ("The coach drove the Team to a Match near the Ring of fire at noon".split(' ') * 3)[i % 7:i % 7 + 1 + i % 11] ] for i in range(60) ]
+
+
+class TaggerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [ FrogServer(), FrogServer() ]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def reference(self, server):
+        """Tags all sentences one by one over a single connection"""
+        tagger = Tagger(*server.spec().split(':'))
+        return [ tagger.process(words) for words in SENTENCES ]
+
+    def test_single(self):
+        """tagbatch() and tagstream() on a single connection tag sentence by sentence, in order"""
+        reference = self.reference(self.servers[0])
+        self.assertEqual(reference[1], ([u'coach', u'drove'], [u'N(' + str(self.servers[0].server_address[1]) + ')', u'N(' + str(self.servers[0].server_address[1]) + ')'], [u'coach', u'drove']))
+        tagger = wsd2.maketagger(self.servers[0].spec())
+        self.assertFalse(isinstance(tagger, wsd2.TaggerPool))
+        self.assertEqual(wsd2.tagbatch(tagger, SENTENCES), reference)
+        self.assertEqual(list(wsd2.tagstream(tagger, iter(SENTENCES), 7)), reference)
+
+    def test_pool(self):
+        """A pool with several connections to one server gives the same output, in order, tagging concurrently"""
+        reference = self.reference(self.servers[0])
+        self.assertEqual(self.servers[0].maxactive, 1)
+        pool = wsd2.maketagger(self.servers[0].spec(), 4)
+        self.assertTrue(isinstance(pool, wsd2.TaggerPool))
+        self.assertEqual(pool.processbatch(SENTENCES), reference)
+        self.assertTrue(self.servers[0].maxactive > 1)
+        self.assertEqual(list(wsd2.tagstream(pool, iter(SENTENCES), 25)), reference)
+        self.assertEqual(pool.process(SENTENCES[3]), reference[3])
+
+    def test_servers(self):
+        """A pool over several servers tags every sentence once, in order (the tags say which server tagged a sentence)"""
+        reference = self.reference(self.servers[0])
+        pool = wsd2.maketagger(','.join( server.spec() for server in self.servers ), 2)
+        self.assertEqual(len(pool.taggers), 4)
+        tagged = pool.processbatch(SENTENCES)
+        self.assertEqual(len(tagged), len(SENTENCES))
+        ports = set()
+        for (words, postags, lemmas), (refwords, refpostags, reflemmas) in zip(tagged, reference):
+            self.assertEqual(words, refwords)
+            self.assertEqual(lemmas, reflemmas)
+            self.assertEqual([ pos[:pos.index('(')] for pos in postags ], [ pos[:pos.index('(')] for pos in refpostags ])
+            ports.update( pos[pos.index('(')+1:-1] for pos in postags )
+        self.assertEqual(ports, set( str(server.server_address[1]) for server in self.servers ))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wsd2
+
+#stands in for ucto: splits off full stops, one line out per line in, block buffered output
+TOKENISER = [sys.executable, '-c', "import sys\nfor line in iter(sys.stdin.readline, ''):\n    sys.stdout.write(' '.join(line.replace('.', ' .').split()) + '\\n')\n", '--']
+
+
+Popen = subprocess.Popen
+
+class RecordingPopen(Popen):
+    started = []
+
+    def __init__(self, *args, **kwargs):
+        Popen.__init__(self, *args, **kwargs)
+        RecordingPopen.started.append(self)
+
+
+def lexelts(n):
+    for i in range(n):
+        lang = ('en','nl')[(i / 3) % 2]
+        yield lang, u'word' + unicode(i), u'n', [ (unicode(j), u'left context. ', u'word' + unicode(i), u' right. context' * j) for j in range(i % 5 + 1) ]
+
+
+class TokeniseStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ucto = wsd2.UCTO
+        wsd2.UCTO = TOKENISER
+        RecordingPopen.started = []
+        wsd2.subprocess.Popen = RecordingPopen
+
+    def tearDown(self):
+        wsd2.UCTO = self.ucto
+        wsd2.subprocess.Popen = Popen
+
+    def test_stream(self):
+        """The stream yields what tokenise() gives for each lexical unit, with one process per run of a language"""
+        stream = list(wsd2.tokenisestream(lexelts(20)))
+        self.assertEqual(len(RecordingPopen.started), 7) #the language changes every three lexical units
+        self.assertEqual(len(stream), 20)
+        for (lang, lemma, pos, instances, tokenised), expected in zip(stream, lexelts(20)):
+            self.assertEqual( (lang, lemma, pos, instances), expected )
+            self.assertEqual(tokenised, wsd2.tokenise([ leftcontext + head + rightcontext for id, leftcontext, head, rightcontext in instances ], lang))
+        self.assertEqual(stream[1][4], [u'left context . word1', u'left context . word1 right . context'])
+
+    def test_close(self):
+        """No ucto process outlives a stream that is closed early"""
+        for stop in (1, 3, 4, 10):
+            RecordingPopen.started = []
+            stream = wsd2.tokenisestream(lexelts(200))
+            for i in range(stop):
+                stream.next()
+            stream.close()
+            self.assertTrue(RecordingPopen.started)
+            for process in RecordingPopen.started:
+                self.assertFalse(process.poll() is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,23 +4,20 @@
 import getopt
 import sys
 import os
-import timbl
 import wsd2
-import codecs
-import glob
 
 
 def usage():
-    print >> sys.stderr,"Usage: wsd2-voter.py -c [classifierdir1 classifierdir2] -L [lang]  -o [outputdir] -O [timbloptions] -I [divergencefrombestoutputthreshold]"
-        
+    print >> sys.stderr,"Usage: wsd2-voter.py -c [classifierdir1 classifierdir2] -L [lang]  -o [outputdir] -O [timbloptions] -I [divergencefrombestoutputthreshold] -T [testdir] -w [targetwordsfile] -P [classifierserverhost:port] -R [resultsstore] --workers=[int] --noparamsearch"
+
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], "c:L:o:O:")
+    opts, args = getopt.getopt(sys.argv[1:], "c:L:o:O:P:R:T:w:I:", ["workers=","noparamsearch"])
 except getopt.GetoptError, err:
     # print help information and exit:
     print str(err)
     usage()
-    sys.exit(2)           
+    sys.exit(2)
 
 
 targetlang = None
@@ -30,9 +27,13 @@ testdir = wsd2.WSDDIR + "/data/trial"
 targetwordsfile = wsd2.WSDDIR + "/data/targetwords.trial"
 classifierdirs = []
 divergencefrombestoutputthreshold = 0.9
+classifierpool = None
+resultsstore = None
+workers = 1
+paramsearch = True
 
 for o, a in opts:
-    if o == "-c":	
+    if o == "-c":
         classifierdirs = a.split(' ')
     elif o == '-L':
         targetlang = a
@@ -41,11 +42,20 @@ for o, a in opts:
     elif o == '-O':
         timbloptions = a
     elif o == '-T':
-        testdir = a     
-    elif o == '-w':   
+        testdir = a
+    elif o == '-w':
         targetwordsfile = a
     elif o == '-I':
         divergencefrombestoutputthreshold = float(a)
+    elif o == '-P':
+        host, port = a.rsplit(':',1)
+        classifierpool = wsd2.ClassifierPoolClient(host, int(port))
+    elif o == '-R':
+        resultsstore = a
+    elif o == '--workers':
+        workers = int(a)
+    elif o == '--noparamsearch':
+        paramsearch = False
     else:
         raise Exception("Unknown option: " + o)
 
@@ -54,119 +64,16 @@ if not classifierdirs or not targetwordsfile or not targetlang:
     sys.exit(2)
 
 
-
-classifiers = {}
-targetwords = wsd2.loadtargetwords(targetwordsfile)
-testfiles = []
-for lemma, pos in targetwords:
+lemmas = []
+for lemma, pos in wsd2.loadtargetwords(targetwordsfile):
     if os.path.exists(testdir+"/" + lemma + '.data'):
-        testfiles.append(testdir+"/" + lemma + '.data')
+        lemmas.append( (lemma,pos) )
     else:
         print >>sys.stderr, "WARNING: No testfile found for " + lemma + " (tried " + testdir+"/" + lemma + '.data)'
-testset = wsd2.TestSet(testfiles)
-
-votertraindata = {}
-votertestdata = {}
-for lemma,pos in testset.lemmas():       
-    print >>sys.stderr, "Processing " + lemma.encode('utf-8')
-    votertraindata[(lemma,pos)] = {}
-    votertestdata[(lemma,pos)] = {}
-    
-    for classifierdir in classifierdirs:  
-        classifiername = os.path.basename(classifierdir)
-        
-        votertraindata[(lemma,pos)][classifiername] = []
-        
-        
-        if os.path.exists(classifierdir + '/' + lemma + '.' + pos + '.' + targetlang + '.votertrain'):
-            f = codecs.open(classifierdir + '/' + lemma + '.' + pos + '.' + targetlang + '.votertrain','r','utf-8')
-            for line in f:
-                line = line.strip()
-                fields = line.split('\t')
-                votertraindata[(lemma,pos)][classifiername].append( (fields[0],fields[1]) )  #(train,gold)
-            f.close() 
-        else:
-            raise Exception("No votertrain found for " + lemma.encode('utf-8') + " in " + classifierdir)              
-            
-
-        if os.path.exists(classifierdir + '/' + lemma + '.' + pos + '.votertest'):
-            f = codecs.open(classifierdir + '/' + lemma + '.' + pos + '.votertest','r','utf-8')
-            for line in f:
-                line = line.strip()
-                fields = line.split('\t')
-                id = fields[0]
-                if not id in votertestdata[(lemma,pos)]: 
-                    votertestdata[(lemma,pos)][id] = {}
-                votertestdata[(lemma,pos)][id][classifiername] =  (fields[0], fields[1], fields[2])  #(id, focusword, sense)
-            f.close() 
-        else:
-            raise Exception("No votertest found for " + lemma.encode('utf-8') + " in " + classifierdir)                          
-            
-#TODO: integrity check?    
-
-classifiers = {}
-for lemma,pos in testset.lemmas():       
-    print >>sys.stderr, "Processing " + lemma.encode('utf-8')
-    
-    classifiers[(lemma,pos)] = timbl.TimblClassifier(outputdir + '/' + lemma + '.' + pos + '.' + targetlang, timbloptions)
-        
-                
-    col = {}
-            
-    for i, classifierdir in enumerate(classifierdirs):  
-        classifiername = os.path.basename(classifierdir)
-        if not i in col: col[i] = []                
-                
-        for data, classlabel in votertraindata[(lemma,pos)][classifiername]:            
-            for train, gold in data: 
-                col[i].append(train)
-                if i == 0: col[-1].append(gold)
-                                
-        
-        classifiers[(lemma,pos)].append(features, classlabel)
-        
-
-print >>sys.stderr, "Training " + str(len(classifiers)) + " classifiers"
-for classifier in classifiers:
-    classifiers[classifier].train()
-    #classifiers[classifier].save()
-    
-print >>sys.stderr, "Voter Parameter optimisation"
-for f in glob.glob(outputdir + '/*.train'):
-    os.system("paramsearch ib1 " + f + " > " + f + ".paramsearch")
-
-print >>sys.stderr, "Testing classifiers"
-basictimbloptions = timbloptions
-for lemma,pos in testset.lemmas():            
-    print >>sys.stderr, "Processing " + lemma.encode('utf-8')
-
-    timbloptions = basictimbloptions 
-    if os.path.exists(outputdir + '/' + lemma +'.' + pos + '.' + targetlang + '.train.paramsearch'):
-        o = wsd2.paramsearch2timblargs(outputdir + '/' + lemma +'.' + pos + '.' + targetlang + '.train.paramsearch')
-        timbloptions += " " + o 
-        print >>sys.stderr, "Parameter optimisation loaded: " + o
-    else:            
-        print >>sys.stderr, "NOTICE: No parameter optimisation found!"
-     
-    out_best = codecs.open(outputdir + '/' + lemma + '.' + pos + '.best','w','utf-8')
-    out_oof = codecs.open(outputdir + '/' + lemma + '.' + pos + '.oof','w','utf-8')     
-    oof_senses = []
-     
-    for id in sorted(votertestdata[(lemma,pos)]):     
-        features = []
-        for classifierdir in classifierdirs:  
-            classifiername = os.path.basename(classifierdir)
-            features.append( votertestdata[(lemma,pos)][id][classifiername][-1] )            
-        print >>sys.stderr, "--> Classifying " + id + " :" + repr(features)
-        sense, distribution, distance = classifiers[(lemma,pos)].classify(features)        
-        wsd2.processresult(out_best, oof_senses, id, lemma, pos, targetlang, sense, distribution, distance, divergencefrombestoutputthreshold)
 
-    out_best.close()
-    wsd2.processresult_final(out_oof, oof_senses)
-    out_oof.close()
-         
-    #score
-    os.system('perl ' + wsd2.WSDDIR + '/ScorerTask3.pl ' + outputdir + '/' + lemma + '.' + pos + '.best' + ' ' + wsd2.WSDDIR + '/data/trial/' + targetlang + '/' + lemma + '_gold.txt 2> ' + outputdir + '/' + lemma + '.' + pos + '.best.scorerr')
-    os.system('perl ' + wsd2.WSDDIR + '/ScorerTask3.pl ' + outputdir + '/' + lemma + '.' + pos + '.oof' + ' ' + wsd2.WSDDIR + '/data/trial/' + targetlang + '/' + lemma + '_gold.txt -t oof 2> ' + outputdir + '/' + lemma + '.' + pos + '.oof.scorerr')
-    
-wsd2.scorereport(outputdir)        
+voter = wsd2.Voter(outputdir, targetlang, timbloptions, divergencefrombestoutputthreshold, workers, paramsearch, classifierpool)
+for classifierdir in classifierdirs:
+    print >>sys.stderr, "Loading voter data from " + classifierdir
+    voter.load(classifierdir, lemmas)
+voter.run()
+voter.score(testdir, resultsstore)
@@ -39,17 +39,39 @@ import os
 import codecs
 from lxml import etree as ElementTree
 from pynlpl.formats.moses import PhraseTable
-from pynlpl.formats.giza import GizaModel
+from pynlpl.formats.giza import GizaModel, GizaSentenceAlignment
 from pynlpl.tagger import Tagger
 import timbl
 import glob
-import random
+import itertools
+import array
+import mmap
+import shutil
+import gzip
+import bz2
+import subprocess
+import threading
+import hashlib
+import marshal
+import multiprocessing
+import numpy
+import sqlite3
+import socket
+import SocketServer
+import json
+import collections
+import heapq
+import Queue
+from wsd2scoring import GoldStandard, Scorer, ResultsStore, readresults, scorereport, perlsplit, perltrue, perlstr, perlround
 #import matplotlib
 #matplotlib.use('Agg')
 #import matplotlib.pyplot
 
 WSDDIR = os.path.dirname(os.path.abspath(__file__))
 
+UCTO = ['ucto','-m','-n'] #tokeniser command, the language flag is added per run
+TIMBL = ['timbl','-F','Tabbed'] #classifier command for batch classification, options and files are added per run
+
 def usage():
     """Print usage instructions"""
     print >> sys.stderr,"Usage: wsd2.py --train -L [lang] -s [source-text] -t [target-text] -m [moses-phrasetable] -w [targetwords-file] -o [outputdir] -O [timbloptions]"
@@ -63,18 +85,33 @@ def usage():
     print >> sys.stderr,"          1) Bag-of-word needs to occur at least x times in context"
     print >> sys.stderr,"          2) Bag-of-word needs to have sense|keyword probability of at least x"
     print >> sys.stderr,"          3) Filter out words with a global corpus occurence less than x"
+    print >> sys.stderr," --fullphrasetable   Load the entire phrasetable, rather than only the entries for the target words (and their inflections, irregular ones only with --tagcache)"
     print >> sys.stderr," -R                     Automatically compute absolute threshold per word-expert"
     print >> sys.stderr," -M [float]  Maximum diverge from best translation option in generation of training data (0 < x < 1), default 0.5"
     print >> sys.stderr," -I [float]  In final output of best senses, include senses that diverge by 0 < x < 1 from the actual best sense, default 0.9"
     print >> sys.stderr," --Stagger   Tagger for source language, set to frog:[port] or freeling:[channel] or corenlp, start the tagger server manually first for the first two"
     print >> sys.stderr," --Ttagger   Tagger for target language, set to frog:[port] or freeling:[channel] (start the tagger server manually first) or  de.lex or fr.lex for built-in lexicons.. "
+    print >> sys.stderr," --taggerconnections=[int]   Number of connections to open to each tagger server (default: 1), several servers may also be given in --Stagger/--Ttagger, separated by commas. Sentences are then tagged concurrently over all connections"
+    print >> sys.stderr," --alignments=[file]    Use with --train: precomputed intersection of the GIZA alignments, built from the models given with -a if it does not exist yet (or is outdated), so -a may be omitted afterwards"
+    print >> sys.stderr," --tagcache  Use with --train: tag the source and target corpus only once and store the result in a compact binary store next to the corpus ([corpus].tagstore.*), later runs read the store instead of invoking the tagger"
+    print >> sys.stderr," --bagstore=[file]      Use with --test: the bags of words to use, by default the store written by --train in the output directory ([outputdir]/bags.sqlite). May also be a directory with .bag files of older training runs"
+    print >> sys.stderr," --classifierserver=[port]    Run a classifier pool server on the given port, keeping the classifiers loaded over repeated test runs (use with --classifierpool)"
+    print >> sys.stderr," --classifierpool=[host:port] Use with --test: classify through the given classifier pool server rather than loading the classifiers anew"
+    print >> sys.stderr," --resultsstore=[file]  Also record the scores in this results store (SQLite), shared by all configurations (see collectresults.py). The configuration is named after the output directory"
     print >> sys.stderr," -v [file]         Load variable configuration from file"
     print >> sys.stderr," -V          Produce input for voter system (choose a different outputdirectory for each classifier)"
+    print >> sys.stderr," --voterwith=[dirs]  Use with -V and --test: also run a voter over the output of this run and that of the classifiers in the given output directories (space separated), writing to [outputdir]/voter. The output of this run is passed on in memory"
     print >> sys.stderr," -S          Constrain to known senses (prunes other senses during testing)"
     print >> sys.stderr," -X          Do not score against gold standard"
+    print >> sys.stderr," --singlepass        Use with -b: read the corpus only once, buffering the occurrences until the bags of words are known"
+    print >> sys.stderr," --buffersize=[int]  Maximum number of occurrences buffered in memory with --singlepass, the rest is spilled to disk (default: 1000000)"
     print >> sys.stderr," --nogen     Use with --train: train classifiers but do NOT regenerate training instances"
     print >> sys.stderr," --scoreonly No training or testing, just score existing result files"
+    print >> sys.stderr," --workers=[int]     Number of worker processes to use (default: 1), training with multiple workers requires --tagcache"
+    print >> sys.stderr," --stream    Parse and tokenise test data incrementally, classifying each lexical unit as soon as it is read (for very large test files, disables the cache, can not be combined with --scoreonly)"
+    print >> sys.stderr," --cachedir=[dir]    Directory for caching parsed and tokenised test data (default: " + WSDDIR + "/cache), set empty to disable"
     print >> sys.stderr," --votertrainonly    Only generate and train voter (implies --nogen)"
+    print >> sys.stderr," --voterheldout=[loo|int]  Generate the voter training data by leave-one-out classification of the training data (loo), or k-fold cross-validation (give k), rather than by classifying it with the classifier trained on it"
 
 class TestSet(object):
     languages = {
@@ -91,39 +128,118 @@ class TestSet(object):
         u"español": 'es',
     }
 
-    def __init__(self, filenames = []):
+    CACHEVERSION = "1"
+
+    def __init__(self, filenames = [], cachedir = None, workers = 1):
+        self.workers = workers
         self.lexunits = {}
         self.orderedlemmas = [] #we have to retain the order somehow, dictionary is unordered
+        self.tagged = {}
+        self.cachefilename = None
         if (isinstance( filenames,str) or isinstance(filenames,unicode)):
-            self.load(filenames)
-        else:
-            for filename in filenames:
-                self.load(filename)
-
-
-    def load(self, filename):
-        """Read test or trial data and parses it into a usable datastructure"""
-        print >>sys.stderr, "Loading and tokenising " + filename.encode('utf-8')
-        tree = ElementTree.parse(filename)
-        root = tree.xpath("/corpus")
-        if len(root) > 0:
-            root = root[0]
+            filenames = [filenames]
+        if cachedir:
+            cachefile = self.cachefilename = self.cachefile(filenames, cachedir)
+            if os.path.exists(cachefile):
+                self.loadcache(cachefile)
+            else:
+                self.load(filenames)
+                self.savecache(cachefile)
         else:
-            raise Exception("This is not a valid test-file!")
-        self.lang = TestSet.languages[root.attrib['lang'].lower()]
-
+            self.load(filenames)
 
+    def cachefile(self, filenames, cachedir):
+        """Returns the cache filename for the given input files. The key is a hash of the contents of all files (which includes their language) and the tokeniser invocation, so any change to an input file invalidates the cache"""
+        h = hashlib.sha1()
+        h.update(TestSet.CACHEVERSION + ' ' + ' '.join(UCTO) + ' ' + str(marshal.version) + '\n')
+        for filename in filenames:
+            f = open(filename,'rb')
+            while True:
+                data = f.read(1048576)
+                if not data: break
+                h.update(data)
+            f.close()
+            h.update('\0')
+        return cachedir + '/' + h.hexdigest() + '.testset'
 
-        for lemmanode in root.findall('.//lexelt'):
-            lemma, pos = lemmanode.attrib['item'].rsplit(".",1)
+    def loadcache(self, cachefile):
+        print >>sys.stderr, "Loading cached test set " + cachefile
+        f = open(cachefile,'rb')
+        self.lang, self.lexunits, self.orderedlemmas = marshal.load(f)
+        f.close()
 
-            instances = {}
-            tmpfilename = '/tmp/' + "%032x" % random.getrandbits(128)
-            tmpfile = codecs.open(tmpfilename,'w','utf-8')
-            tmpmap = []
-            idmap = []
+    def savecache(self, cachefile):
+        print >>sys.stderr, "Caching test set in " + cachefile
+        cachedir = os.path.dirname(cachefile)
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        #write to a temporary file first so concurrent runs never see a partial cache
+        tmpfile = cachefile + '.' + str(os.getpid())
+        f = open(tmpfile,'wb')
+        marshal.dump( (getattr(self,'lang',None), self.lexunits, self.orderedlemmas), f)
+        f.close()
+        os.rename(tmpfile, cachefile)
+
+    def tag(self, tagger, taggerspec = None):
+        """Tags all instances of the test set before feature extraction, through tagbatch(). The result is available through taggedinstances() and, if the test set is cached and the tagger specification is known, cached next to the test set, so later runs with the same tagger need not tag again. Note that a single tagger server connection (the pynlpl Tagger) still takes one request per sentence, it is the cache and, with --taggerconnections, the concurrent connections of a TaggerPool that save time"""
+        tagcachefile = None
+        if self.cachefilename and taggerspec:
+            tagcachefile = self.cachefilename[:-len('.testset')] + '.' + hashlib.sha1(taggerspec).hexdigest()[:12] + '.tagged'
+            if os.path.exists(tagcachefile):
+                print >>sys.stderr, "Loading cached tagged test set " + tagcachefile
+                f = open(tagcachefile,'rb')
+                self.tagged = marshal.load(f)
+                f.close()
+                return
+
+        keys = []
+        sentences = []
+        for lemma, pos, instances in self.iterlexelts():
+            for id, (leftcontext, head, rightcontext) in instances:
+                keys.append( (lemma+'.'+pos, id) )
+                sentences.append( (leftcontext + ' ' + head + ' ' + rightcontext).split(' ') )
+        print >>sys.stderr, "Tagging " + str(len(sentences)) + " test instances"
+        if not hasattr(tagger, 'processbatch'):
+            print >>sys.stderr, "NOTICE: Tagger has no batch interface, tagging one sentence per request (see --taggerconnections)"
+        self.tagged = {}
+        for (lexunit, id), tagged in zip(keys, tagbatch(tagger, sentences)):
+            if not lexunit in self.tagged:
+                self.tagged[lexunit] = {}
+            self.tagged[lexunit][id] = tuple(tagged)
+
+        if tagcachefile:
+            print >>sys.stderr, "Caching tagged test set in " + tagcachefile
+            tmpfile = tagcachefile + '.' + str(os.getpid())
+            f = open(tmpfile,'wb')
+            marshal.dump(self.tagged, f)
+            f.close()
+            os.rename(tmpfile, tagcachefile)
 
-            for instancenode in lemmanode.findall('.//instance'):
+    def taggedinstances(self, lemma, pos, instances, tagger):
+        """Returns the tagged instances of a lexical unit as (words, postags, lemmas) tuples, in the order of the given instances. Taken from tag() if it was called, tagged in one batch otherwise"""
+        if lemma+'.'+pos in self.tagged:
+            return [ self.tagged[lemma+'.'+pos][id] for id, _ in instances ]
+        else:
+            return tagbatch(tagger, [ (leftcontext + ' ' + head + ' ' + rightcontext).split(' ') for id, (leftcontext, head, rightcontext) in instances ])
+
+
+    def parse(self, filename):
+        """Read test or trial data incrementally and yields the untokenised instances per lexical unit: (lang, lemma, pos, [(id, leftcontext, head, rightcontext)]). Processed elements are cleared so memory use does not grow with the input"""
+        print >>sys.stderr, "Loading " + filename.encode('utf-8')
+        lang = None
+        for event, node in ElementTree.iterparse(filename, events=('start','end'), tag=('corpus','lexelt')):
+            if node.tag == 'corpus':
+                if event == 'start':
+                    lang = TestSet.languages[node.attrib['lang'].lower()]
+                continue
+            elif event == 'start':
+                continue
+            elif lang is None:
+                raise Exception("This is not a valid test-file!")
+
+            lemma, pos = node.attrib['item'].rsplit(".",1)
+            instances = []
+            for instancenode in node.findall('.//instance'):
                 id = int(instancenode.attrib['id'])
                 contextnode = instancenode.find('.//context')
                 leftcontext = contextnode.text
@@ -138,79 +254,110 @@ class TestSet(object):
                 if not rightcontext: rightcontext = ""
                 if rightcontext and not isinstance(rightcontext, unicode):
                     rightcontext = unicode(rightcontext, 'utf-8')
-                idmap.append(id)
-                tmpmap.append( (leftcontext, head, rightcontext) )
-                tmpfile.write(leftcontext + head + rightcontext + "\n")
-                #instances[id] = (leftcontext,head,rightcontext) #room for output classes is reserved (set to None)
-
-            tmpfile.close()
-            r = os.system('ucto -L' + self.lang +  ' -m -n ' + tmpfilename + ' ' + tmpfilename +'.out')
-            if r != 0:
-                raise Exception("ucto failed")
-
-            print >>sys.stderr, "Processing ucto output from "+ tmpfilename + '.out'
-            f = codecs.open(tmpfilename + '.out','r','utf-8')
-            for i, line in enumerate(f):
-                if i == len(tmpmap): break
-                leftcontext_untok, head, rightcontext_untok = tmpmap[i]
-                line = line.strip()
-                words = line.split(' ')
-
-                origindex = len(leftcontext_untok.split(' '))
-                mindistance = 9999
-                focusindex = -1
-
-                for j, word in enumerate(words):
-                    if word == head:
-                        distance = abs(origindex - j)
-                        if distance <= mindistance:
-                            focusindex = j
-                            mindistance = distance
+                instances.append( (id, leftcontext, head, rightcontext) )
 
-                if focusindex  == -1:
-                    print >>sys.stderr,"Full match not found, attempting to find partial match"
-                    #final partial match:
-                    for j, word in enumerate(words):
-                        partialfound = word.find(head)
-                        if partialfound != -1:
-                            distance = abs(origindex - j)
-                            if distance <= mindistance:
-                                focusindex = j
-                                mindistance = distance
-
-                    if focusindex != -1:
-                        leftcontext = u" ".join(words[:focusindex])
-                        if partialfound > 0:
-                            leftcontext += " " + words[focusindex][:partialfound]
-                        rightcontext = u" ".join(words[focusindex + 1:])
-
-
-                        if words[focusindex][partialfound + len(head):]:
-                            rightcontext = words[focusindex][partialfound + len(head):] + ' ' + rightcontext
-                    else:
-                        raise Exception("Focus word not found after tokenisation! This should not happen! head=" + head.encode('utf-8') + ",words=" + ' '.join(words).encode('utf-8'))
-                else:
-                    leftcontext = u" ".join(words[:focusindex])
-                    rightcontext = u" ".join(words[focusindex + 1:])
+            #free the processed lexical unit
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
 
+            yield lang, lemma, pos, instances
 
-                instances[idmap[i]] = (leftcontext, head, rightcontext)
-
-            f.close()
 
+    def load(self, filenames):
+        """Read test or trial data and parses it into a usable datastructure. The contexts of all lexical units of all files are tokenised in a single ucto run per language (or per group of files when loading with multiple workers)"""
+        if (isinstance( filenames,str) or isinstance(filenames,unicode)):
+            filenames = [filenames]
+
+        if self.workers > 1 and len(filenames) > 1:
+            #split into contiguous groups so merging in group order retains the original order of the lemmas
+            groupsize = (len(filenames) + self.workers - 1) / self.workers
+            groups = [ filenames[i:i+groupsize] for i in range(0, len(filenames), groupsize) ]
+            print >>sys.stderr, "Loading " + str(len(filenames)) + " files in " + str(len(groups)) + " worker processes"
+            pool = multiprocessing.Pool(len(groups))
             try:
-                os.unlink(tmpfilename)
-                os.unlink(tmpfilename + '.out')
-            except:
-                pass
-
-            self.lexunits[lemma+'.'+pos] = instances
+                results = pool.map(_loadtestfiles, groups)
+            finally:
+                pool.close()
+                pool.join()
+            for lang, lexunits, orderedlemmas in results:
+                self.lang = lang
+                self.lexunits.update(lexunits)
+                self.orderedlemmas += orderedlemmas
+            return
+
+        lexelts = []
+        for filename in filenames:
+            lexelts += list(self.parse(filename))
+
+        #gather all contexts per language in one stream, tokenise, and map the lines back to (lemma,pos,id)
+        tokenised = {}
+        for lang in set( x[0] for x in lexelts ):
+            lines = []
+            for lexeltlang, lemma, pos, instances in lexelts:
+                if lexeltlang == lang:
+                    for id, leftcontext, head, rightcontext in instances:
+                        lines.append(leftcontext + head + rightcontext)
+            tokenised[lang] = iter(tokenise(lines, lang))
+
+        for lang, lemma, pos, instances in lexelts:
+            self.lang = lang
+            self.lexunits[lemma+'.'+pos] = dict( (id, TestSet.align(tokenised[lang].next(), leftcontext, head)) for id, leftcontext, head, rightcontext in instances )
             self.orderedlemmas.append( (lemma,pos) ) #(so we can keep right ordering)
 
+    @staticmethod
+    def align(line, leftcontext_untok, head):
+        """Find the head in a tokenised line, returns (leftcontext, head, rightcontext)"""
+        words = line.strip().split(' ')
+
+        origindex = len(leftcontext_untok.split(' '))
+        mindistance = 9999
+        focusindex = -1
+
+        for j, word in enumerate(words):
+            if word == head:
+                distance = abs(origindex - j)
+                if distance <= mindistance:
+                    focusindex = j
+                    mindistance = distance
+
+        if focusindex  == -1:
+            print >>sys.stderr,"Full match not found, attempting to find partial match"
+            #final partial match:
+            for j, word in enumerate(words):
+                partialfound = word.find(head)
+                if partialfound != -1:
+                    distance = abs(origindex - j)
+                    if distance <= mindistance:
+                        focusindex = j
+                        mindistance = distance
+
+            if focusindex != -1:
+                leftcontext = u" ".join(words[:focusindex])
+                if partialfound > 0:
+                    leftcontext += " " + words[focusindex][:partialfound]
+                rightcontext = u" ".join(words[focusindex + 1:])
+
+
+                if words[focusindex][partialfound + len(head):]:
+                    rightcontext = words[focusindex][partialfound + len(head):] + ' ' + rightcontext
+            else:
+                raise Exception("Focus word not found after tokenisation! This should not happen! head=" + head.encode('utf-8') + ",words=" + ' '.join(words).encode('utf-8'))
+        else:
+            leftcontext = u" ".join(words[:focusindex])
+            rightcontext = u" ".join(words[focusindex + 1:])
+
+        return (leftcontext, head, rightcontext)
+
     def lemmas(self):
         for lemma,pos in self.orderedlemmas:
             yield lemma, pos
 
+    def iterlexelts(self):
+        """Yields (lemma, pos, instances) per lexical unit, in order, instances as returned by instances()"""
+        for lemma,pos in self.orderedlemmas:
+            yield lemma, pos, self.instances(lemma,pos)
+
     def has(self, lemma, pos):
         return (lemma+'.'+pos in self.lexunits)
 
@@ -220,6 +367,219 @@ class TestSet(object):
         else:
             raise KeyError
 
+def _loadtestfiles(filenames):
+    """Worker for parallel loading of test files, returns (lang, lexunits, orderedlemmas)"""
+    testset = TestSet(filenames)
+    return testset.lang, testset.lexunits, testset.orderedlemmas
+
+
+class StreamingTestSet(TestSet):
+    """Test set for corpus-scale input: files are parsed incrementally and each lexical unit is tokenised and handed out as soon as it is read, instead of loading everything up front. Instances are not retained, only the order of the lemmas (for scoring)"""
+
+    def __init__(self, filenames = []):
+        self.lexunits = {}
+        self.orderedlemmas = []
+        self.tagged = {}
+        if (isinstance( filenames,str) or isinstance(filenames,unicode)):
+            filenames = [filenames]
+        self.filenames = filenames
+
+    def iterlexelts(self):
+        """Yields (lemma, pos, instances) per lexical unit, in order. All lexical units are tokenised by one long-lived ucto process (per language), see tokenisestream()"""
+        def lexelts():
+            for filename in self.filenames:
+                for lexelt in self.parse(filename):
+                    yield lexelt
+
+        for lang, lemma, pos, instances, tokenised in tokenisestream(lexelts()):
+            self.lang = lang
+            self.orderedlemmas.append( (lemma,pos) )
+            yield lemma, pos, sorted( (id, TestSet.align(line, leftcontext, head)) for line, (id, leftcontext, head, rightcontext) in zip(tokenised, instances) )
+
+    def instances(self, lemma, pos):
+        raise Exception("Instances of a streaming test set can only be obtained through iterlexelts()")
+
+    def tag(self, tagger, taggerspec = None):
+        raise Exception("A streaming test set is tagged per lexical unit, through taggedinstances()")
+
+
+def tagbatch(tagger, sentences):
+    """Tags a list of sentences (lists of words), returns a list of (words, postags, lemmas), in order. Taggers offering processbatch() (a TaggerPool) get all sentences in one batch. Others, such as the pynlpl Tagger, whose clients send one sentence per request to the tagger server, are called per sentence: this is no faster than tagging the sentences one by one"""
+    if hasattr(tagger, 'processbatch'):
+        return tagger.processbatch(sentences)
+    else:
+        return [ tagger.process(words) for words in sentences ]
+
+
+def tagstream(tagger, sentences, chunksize = 1000):
+    """Tags an iterable of sentences (lists of words) in chunks of the given size through tagbatch(), yields (words, postags, lemmas) per sentence, in order"""
+    chunk = []
+    for words in sentences:
+        chunk.append(words)
+        if len(chunk) == chunksize:
+            for tagged in tagbatch(tagger, chunk):
+                yield tagged
+            chunk = []
+    if chunk:
+        for tagged in tagbatch(tagger, chunk):
+            yield tagged
+
+
+class TaggerPool(object):
+    """Pool of connections to one or more tagger servers (frog, freeling, corenlp), given as tagger specifications, with the given number of connections per server. Every connection is served by a thread of its own, so processbatch() tags many sentences concurrently, the results are returned in order. Otherwise usable as a single Tagger"""
+
+    def __init__(self, specs, connections = 1):
+        self.specs = specs
+        self.taggers = []
+        for spec in specs:
+            for i in range(connections):
+                self.taggers.append( Tagger(*spec.split(':')) )
+        self.lock = threading.Lock()
+        print >>sys.stderr, "Tagger pool with " + str(len(self.taggers)) + " connections to " + ', '.join(specs)
+
+    def process(self, words):
+        with self.lock:
+            return self.taggers[0].process(words)
+
+    def processbatch(self, sentences):
+        if len(self.taggers) == 1 or len(sentences) <= 1:
+            with self.lock:
+                return [ self.taggers[0].process(words) for words in sentences ]
+
+        results = [None] * len(sentences)
+        queue = iter(enumerate(sentences))
+        queuelock = threading.Lock()
+        errors = []
+
+        def work(tagger):
+            while not errors:
+                with queuelock:
+                    try:
+                        i, words = queue.next()
+                    except StopIteration:
+                        return
+                try:
+                    results[i] = tagger.process(words)
+                except Exception, e:
+                    errors.append(e)
+
+        with self.lock:
+            threads = [ threading.Thread(target=work, args=(tagger,)) for tagger in self.taggers ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def reset(self):
+        for tagger in self.taggers:
+            tagger.reset()
+
+
+def maketagger(spec, connections = 1):
+    """Returns the tagger for a specification as given on the command line (--Stagger/--Ttagger). Several tagger servers may be given, separated by commas, and with multiple connections a TaggerPool is returned"""
+    specs = spec.split(',')
+    if len(specs) > 1 or connections > 1:
+        for s in specs:
+            if s.split(':')[0] not in ('frog','freeling','corenlp'):
+                raise Exception("Only tagger servers (frog, freeling, corenlp) can be pooled, got: " + s)
+        return TaggerPool(specs, connections)
+    else:
+        return Tagger(*spec.split(':'))
+
+
+def tokenise(lines, lang):
+    """Tokenise a list of lines (one sentence per line) with a single ucto process, communicating over pipes. Returns the tokenised lines, in the same order"""
+    print >>sys.stderr, "Tokenising " + str(len(lines)) + " lines with ucto (" + lang + ")"
+    process = subprocess.Popen(UCTO + ['-L' + lang], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def feed():
+        #write from a separate thread so ucto can't block on a full output pipe
+        for line in lines:
+            process.stdin.write(line.replace('\n',' ').encode('utf-8') + '\n')
+        process.stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    tokenised = [ unicode(line,'utf-8').strip() for line in process.stdout ]
+    feeder.join()
+    if process.wait() != 0:
+        raise Exception("ucto failed")
+    if len(tokenised) < len(lines):
+        raise Exception("ucto output does not align with input, expected " + str(len(lines)) + " lines, got " + str(len(tokenised)))
+    return tokenised[:len(lines)]
+
+def tokenisestream(lexelts):
+    """Tokenise an iterable of parsed lexical units (lang, lemma, pos, instances) with one ucto process per language that lives for the whole stream, instead of starting ucto for every lexical unit. Yields (lang, lemma, pos, instances, tokenisedlines) per lexical unit, in order.
+
+    The lexical units are read and written to ucto from a separate thread, which runs ahead of the consumer, so the output is read back lexical unit by lexical unit without relying on ucto flushing its output per line"""
+    pending = Queue.Queue()
+    processes = []
+    stopped = threading.Event()
+    lock = threading.Lock() #ucto processes are started and registered under the lock, so none escapes the cleanup
+
+    def feed():
+        process = None
+        processlang = None
+        try:
+            for lang, lemma, pos, instances in lexelts:
+                if stopped.is_set():
+                    return
+                if process is None or lang != processlang:
+                    if process is not None:
+                        process.stdin.close()
+                    with lock:
+                        if stopped.is_set():
+                            return
+                        print >>sys.stderr, "Tokenising stream with ucto (" + lang + ")"
+                        process = subprocess.Popen(UCTO + ['-L' + lang], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                        processes.append(process)
+                    processlang = lang
+                for id, leftcontext, head, rightcontext in instances:
+                    process.stdin.write((leftcontext + head + rightcontext).replace('\n',' ').encode('utf-8') + '\n')
+                pending.put( (process, (lang, lemma, pos, instances)) )
+            pending.put(None)
+        except Exception, e:
+            pending.put(e)
+        finally:
+            if process is not None:
+                process.stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            elif isinstance(item, Exception):
+                raise item
+            process, (lang, lemma, pos, instances) = item
+            tokenised = []
+            for i in range(len(instances)):
+                line = process.stdout.readline()
+                if not line:
+                    raise Exception("ucto output does not align with input, ucto ended before the last line of " + lemma.encode('utf-8') + "." + pos)
+                tokenised.append(unicode(line,'utf-8').strip())
+            yield lang, lemma, pos, instances, tokenised
+        feeder.join()
+        for process in processes:
+            if process.stdout.read().strip():
+                raise Exception("ucto output does not align with input, got more lines than were written")
+            if process.wait() != 0:
+                raise Exception("ucto failed")
+    finally:
+        #stop the feeder too if the consumer stops early (a killed ucto breaks a pending write)
+        with lock:
+            stopped.set()
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+        feeder.join()
+
 def loadtargetwords(targetwordsfile):
     targetwords = {}
     f = codecs.open(targetwordsfile, 'r','utf-8')
@@ -245,6 +605,114 @@ def loadtargetwords(targetwordsfile):
 
     return targetwords
 
+class FilteredPhraseTable(object):
+    """Moses phrase table restricted to the source words that are relevant for the target words: only single-word source phrases that share the stem of a target lemma (i.e. the lemma itself and its regular inflections), or that are among the given source word forms, are kept. Lookups are by word form, so irregular inflections of a target word (not sharing its stem) are only kept if they are passed as source words, see TaggedCorpus.wordforms(); otherwise they are missing from the filtered table whereas the full phrase table would have them.
+
+    scorecolumn and aligncolumn are the (1-based) fields holding the scores and the target-to-source alignment, by default those of the five-field table (source ||| target ||| alignment ||| alignment ||| scores) that PhraseTable loads for --fullphrasetable.
+
+    The phrase table is streamed only once; the filtered table is stored in a small sidecar file next to it, which later runs load directly. Lookups behave like those on PhraseTable: phrasetable[sourceword] returns a tuple of (target, Pst, Pts, null_alignments)"""
+
+    VERSION = "2" #of the sidecar file
+
+    def __init__(self, filename, targetwords, sourcewords = None, delimiter="|||", scorecolumn = 5, aligncolumn = 4):
+        self.filename = filename
+        self.stems = set( FilteredPhraseTable.stem(lemma) for lemma, pos in targetwords )
+        self.stemlengths = sorted(set( len(stem) for stem in self.stems ))
+        self.sourcewords = set(sourcewords) if sourcewords else set()
+        self.scorecolumn = scorecolumn
+        self.aligncolumn = aligncolumn
+
+        h = hashlib.sha1()
+        h.update( FilteredPhraseTable.VERSION + ' ' + delimiter + ' ' + str(scorecolumn) + ' ' + str(aligncolumn) + '\n')
+        h.update( u"\n".join(sorted(self.stems)).encode('utf-8') + '\n\n' )
+        h.update( u"\n".join(sorted(self.sourcewords)).encode('utf-8') )
+        self.sidecarfile = filename + '.' + h.hexdigest()[:12] + '.filtered'
+
+        if os.path.exists(self.sidecarfile) and os.path.getmtime(self.sidecarfile) >= os.path.getmtime(filename):
+            print >>sys.stderr, "Loading filtered phrasetable " + self.sidecarfile
+            f = open(self.sidecarfile,'rb')
+            self.phrasetable = marshal.load(f)
+            f.close()
+        else:
+            self.phrasetable = {}
+            self.load(filename, delimiter)
+            self.save()
+        print >>sys.stderr, len(self.phrasetable), "source words in filtered phrasetable"
+
+    @staticmethod
+    def stem(lemma):
+        """Very crude stem, cf. targetmatch()"""
+        lemma = lemma.lower()
+        if len(lemma) > 3:
+            return lemma[:-1]
+        else:
+            return lemma
+
+    def relevant(self, source):
+        if ' ' in source:
+            return False
+        if source in self.sourcewords:
+            return True
+        source = source.lower()
+        for l in self.stemlengths:
+            if source[:l] in self.stems:
+                return True
+        return False
+
+    def load(self, filename, delimiter):
+        print >>sys.stderr, "Filtering phrasetable " + filename
+        if filename.split(".")[-1] == "bz2":
+            f = bz2.BZ2File(filename,'r')
+        elif filename.split(".")[-1] == "gz":
+            f = gzip.GzipFile(filename,'r')
+        else:
+            f = open(filename,'r')
+        for linenum, line in enumerate(f):
+            if (linenum+1) % 1000000 == 0:
+                print >>sys.stderr, "@" + str(linenum+1)
+            #cheap check on the raw source phrase before decoding and splitting the whole line
+            source = line[:line.find(delimiter)].strip()
+            if not source or not self.relevant(unicode(source,'utf-8')):
+                continue
+            segments = [ unicode(segment.strip(),'utf-8') for segment in line.split(delimiter) ]
+            if len(segments) < 3 or len(segments) < self.scorecolumn:
+                print >>sys.stderr, "Invalid line: ", line
+                continue
+            scores = [ float(x) for x in segments[self.scorecolumn-1].split() ]
+            Pst = scores[0]
+            if len(scores) > 2:
+                Pts = scores[2]
+            else:
+                Pts = scores[0]
+            if self.aligncolumn > 0 and len(segments) >= self.aligncolumn:
+                null_alignments = segments[self.aligncolumn-1].count("()")
+            else:
+                null_alignments = 0
+            if not segments[0] in self.phrasetable:
+                self.phrasetable[segments[0]] = []
+            self.phrasetable[segments[0]].append( (segments[1], Pst, Pts, null_alignments) )
+        f.close()
+        for source in self.phrasetable:
+            self.phrasetable[source] = tuple(self.phrasetable[source])
+
+    def save(self):
+        print >>sys.stderr, "Saving filtered phrasetable " + self.sidecarfile
+        tmpfile = self.sidecarfile + '.' + str(os.getpid())
+        f = open(tmpfile,'wb')
+        marshal.dump(self.phrasetable, f)
+        f.close()
+        os.rename(tmpfile, self.sidecarfile)
+
+    def __contains__(self, source):
+        return source in self.phrasetable
+
+    def __getitem__(self, source):
+        return self.phrasetable[source]
+
+    def __len__(self):
+        return len(self.phrasetable)
+
+
 def targetmatch(target, senses):
     target = target.lower()
     for sense in senses:
@@ -259,9 +727,640 @@ def targetmatch(target, senses):
 
 
 
+def recordoffsets(filename, step, linesperrecord = 1):
+    """Returns the byte offsets of record 0, step, 2*step, etc. in a file, a record consists of linesperrecord lines"""
+    offsets = []
+    f = open(filename,'rb')
+    offset = 0
+    for linenum, line in enumerate(f):
+        if linenum % (step * linesperrecord) == 0:
+            offsets.append(offset)
+        offset += len(line)
+    f.close()
+    return offsets
+
+def readlines(filename, offset, count):
+    """Yields up to count lines (unicode) from a file, starting at the given byte offset"""
+    f = open(filename,'rb')
+    f.seek(offset)
+    for line in itertools.islice(f, count):
+        yield unicode(line,'utf-8')
+    f.close()
+
+def compressed(filename):
+    return filename.split(".")[-1] in ("bz2","gz")
+
+def opengiza(filename):
+    """Opens a GIZA++ A3.final file for reading, which may be compressed (.bz2 or .gz) as GizaModel allows"""
+    if filename.split(".")[-1] == "bz2":
+        return bz2.BZ2File(filename,'r')
+    elif filename.split(".")[-1] == "gz":
+        return gzip.GzipFile(filename,'r')
+    else:
+        return open(filename,'rb')
+
+def readgiza(filename, offset = 0):
+    """Yields GizaSentenceAlignment instances from a GIZA++ A3.final file, starting at the given byte offset. Compressed files can only be read from the start"""
+    if offset and compressed(filename):
+        raise Exception("Can not seek in compressed GIZA++ file " + filename + ", decompress it first")
+    f = opengiza(filename)
+    if offset: f.seek(offset)
+    index = 0
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        elif line[0] != '#':
+            raise Exception("Error parsing GIZA++ Alignment in " + filename + ", expected new fragment, found: " + repr(line))
+        index += 1
+        targetline = unicode(f.readline(),'utf-8')
+        sourceline = unicode(f.readline(),'utf-8')
+        yield GizaSentenceAlignment(sourceline, targetline, index)
+    f.close()
+
+
+class StoredAlignment(object):
+    """Intersected word alignment of a single sentence pair, as read from an AlignmentStore. Offers getalignedtarget() like GizaSentenceAlignment"""
+
+    def __init__(self, line):
+        self.alignment = {}
+        for entry in line.rstrip('\n').split('\t'):
+            if entry:
+                sourceindex, foundindex, target = entry.split(':',2)
+                if ',' in foundindex:
+                    begin, end = foundindex.split(',')
+                    foundindex = (int(begin), int(end))
+                else:
+                    foundindex = int(foundindex)
+                self.alignment[int(sourceindex)] = (target, foundindex)
+
+    def getalignedtarget(self, index):
+        try:
+            return self.alignment[index]
+        except KeyError:
+            return None, -1
+
+
+class AlignmentStore(object):
+    """Precomputed intersection of the source-to-target and target-to-source GIZA++ alignments of a corpus, so it need not be recomputed by every training pass and every configuration.
+
+    The store holds one line per sentence pair, listing for every aligned source index the result of getalignedtarget() as tab-separated sourceindex:targetindex:target entries (or sourceindex:begin,end:target for spans). An index of line offsets (filename + '.index') allows random access. Iterating and indexing yields StoredAlignment instances"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = array.array('L')
+        f = open(filename + '.index','rb')
+        self.index.fromstring(f.read())
+        f.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, sentencenum):
+        f = open(self.filename,'rb')
+        f.seek(self.index[sentencenum])
+        alignment = StoredAlignment(unicode(f.readline(),'utf-8'))
+        f.close()
+        return alignment
+
+    def __iter__(self):
+        return self.iterfrom(0)
+
+    def iterfrom(self, offset):
+        """Iterate over the alignments starting at the given byte offset"""
+        f = open(self.filename,'rb')
+        f.seek(offset)
+        for line in f:
+            yield StoredAlignment(unicode(line,'utf-8'))
+        f.close()
+
+    @staticmethod
+    def uptodate(filename, gizafile_s2t, gizafile_t2s):
+        if not os.path.exists(filename) or not os.path.exists(filename + '.index'):
+            return False
+        mtime = min(os.path.getmtime(filename), os.path.getmtime(filename + '.index'))
+        return mtime >= os.path.getmtime(gizafile_s2t) and mtime >= os.path.getmtime(gizafile_t2s)
+
+    @staticmethod
+    def build(filename, gizafile_s2t, gizafile_t2s, workers = 1):
+        """Intersect the alignments in two GIZA++ A3.final files and write the store. With multiple workers, ranges of sentences are processed in parallel and concatenated afterwards. Compressed GIZA++ files (.bz2, .gz) are read as well, but can not be split into ranges, so are processed by a single worker"""
+        print >>sys.stderr, "Computing alignment intersection " + filename
+        if workers > 1 and (compressed(gizafile_s2t) or compressed(gizafile_t2s)):
+            print >>sys.stderr, "NOTICE: GIZA++ files are compressed, computing the intersection in a single process"
+            workers = 1
+        if workers > 1:
+            f = open(gizafile_s2t,'rb')
+            total = sum( 1 for line in f ) / 3
+            f.close()
+            shardsize = max(1, (total + workers - 1) / workers)
+            offsets_s2t = recordoffsets(gizafile_s2t, shardsize, 3)
+            offsets_t2s = recordoffsets(gizafile_t2s, shardsize, 3)
+        else:
+            shardsize = None #all
+            offsets_s2t = offsets_t2s = [0]
+        shards = [ (gizafile_s2t, gizafile_t2s, offset_s2t, offset_t2s, shardsize, filename + '.part' + str(shardnum)) for shardnum, (offset_s2t, offset_t2s) in enumerate(zip(offsets_s2t, offsets_t2s)) ]
+        if len(shards) > 1:
+            pool = multiprocessing.Pool(len(shards))
+            try:
+                pool.map(_intersectalignments, shards, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for shard in shards:
+                _intersectalignments(shard)
+
+        #concatenate the parts and build the line offset index
+        index = array.array('L')
+        offset = 0
+        f_out = open(filename,'wb')
+        for shard in shards:
+            partfile = shard[-1]
+            f_in = open(partfile,'rb')
+            for line in f_in:
+                index.append(offset)
+                f_out.write(line)
+                offset += len(line)
+            f_in.close()
+            os.unlink(partfile)
+        f_out.close()
+
+        f = open(filename + '.index','wb')
+        index.tofile(f)
+        f.close()
+        print >>sys.stderr, "Stored alignments for " + str(len(index)) + " sentence pairs"
+
+    @staticmethod
+    def load(filename, gizafile_s2t, gizafile_t2s, workers = 1):
+        """Returns the store, (re)building it from the GIZA++ files first if necessary"""
+        if gizafile_s2t and gizafile_t2s and not AlignmentStore.uptodate(filename, gizafile_s2t, gizafile_t2s):
+            AlignmentStore.build(filename, gizafile_s2t, gizafile_t2s, workers)
+        print >>sys.stderr, "Loading alignment intersection " + filename
+        return AlignmentStore(filename)
+
+
+def _intersectalignments(args):
+    """Worker computing the intersected alignments for a range of sentences, writes one line per sentence pair to partfile"""
+    gizafile_s2t, gizafile_t2s, offset_s2t, offset_t2s, count, partfile = args
+    f = codecs.open(partfile,'w','utf-8')
+    for s2t, t2s in itertools.islice(itertools.izip(readgiza(gizafile_s2t, offset_s2t), readgiza(gizafile_t2s, offset_t2s)), count): #count None: all
+        intersection = s2t.intersect(t2s)
+        entries = []
+        if intersection != None:
+            for i in range(len(intersection.source)):
+                target, foundindex = intersection.getalignedtarget(i)
+                if target != None:
+                    if isinstance(foundindex, tuple):
+                        foundindex = str(foundindex[0]) + ',' + str(foundindex[1])
+                    else:
+                        foundindex = str(foundindex)
+                    entries.append(str(i) + ':' + foundindex + ':' + target)
+        f.write('\t'.join(entries) + '\n')
+    f.close()
+
+
+class NGramIndex(object):
+    """Hashed index of the n-grams in a sentence, mapping each n-gram (a tuple of words) to the position of its first occurrence. The index for a given n is built once, when first queried"""
+
+    def __init__(self, words):
+        self.words = words
+        self.index = {}
+
+    def find(self, ngram):
+        """Returns the position of the first occurrence of the n-gram, or -1 if it does not occur"""
+        n = len(ngram)
+        try:
+            index = self.index[n]
+        except KeyError:
+            index = self.index[n] = {}
+            #walk backwards so the first occurrence ends up in the index
+            for j in xrange(len(self.words) - n, -1, -1):
+                index[tuple(self.words[j:j+n])] = j
+        return index.get(ngram, -1)
+
+
+class Vocabulary(object):
+    """Maps hashable keys, such as (lemma,pos) tuples, to consecutive integer ids and back"""
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+
+    def id(self, key):
+        try:
+            return self.ids[key]
+        except KeyError:
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            return self.ids[key]
+
+    def key(self, id):
+        return self.keys[id]
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class CooccurrenceCounts(object):
+    """Counts for the bag-of-words model: the corpus frequency of all (lemma,pos) keywords and, per word expert, how often each keyword occurs in the context of each sense. Keywords are mapped to ids through the shared vocabulary, senses through a vocabulary per word expert. The counts of a word expert form a sparse senses x keywords matrix, held as sorted arrays of cell keys (senseid << 32 | keywordid) and counts. Updates are collected per sentence and merged in bulk once more than maxpending are pending"""
+
+    def __init__(self, vocabulary, maxpending = 10000000):
+        self.vocabulary = vocabulary
+        self.maxpending = maxpending
+        self.totalcount = numpy.zeros(1024, dtype=numpy.int64)
+        self.senses = {} #(lemma,pos) -> Vocabulary of senses
+        self.cells = {} #(lemma,pos) -> (cellkeys, counts)
+        self.pending = {} #(lemma,pos) -> list of (cellkeys, counts)
+        self.pendingsize = 0
+        self.tables = {} #(lemma,pos) -> cached probability table
+
+    def ids(self, lemmas, postags):
+        """Returns the keyword ids of a sentence as an array"""
+        return numpy.array([ self.vocabulary.id(key) for key in zip(lemmas, postags) ], dtype=numpy.int64)
+
+    def grow(self, size):
+        if size > len(self.totalcount):
+            self.totalcount = numpy.concatenate( (self.totalcount, numpy.zeros(max(size, 2 * len(self.totalcount)) - len(self.totalcount), dtype=numpy.int64)) )
+
+    def addsentence(self, ids):
+        """Count all keywords (ids) of a sentence for the corpus frequency"""
+        if len(ids):
+            self.grow(ids.max() + 1)
+            numpy.add.at(self.totalcount, ids, 1)
+            if self.tables: self.tables = {}
+
+    def addcontext(self, focus, sense, ids):
+        """Count the context keywords (ids, the focus word itself excluded) of an occurrence of the focus word with the given sense"""
+        if not focus in self.senses:
+            self.senses[focus] = Vocabulary()
+            self.cells[focus] = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+            self.pending[focus] = []
+        self.add(focus, (self.senses[focus].id(sense) << 32) | ids, numpy.ones(len(ids), dtype=numpy.int64))
+
+    def add(self, focus, cellkeys, counts):
+        self.pending[focus].append( (cellkeys, counts) )
+        self.pendingsize += len(cellkeys)
+        if self.pendingsize > self.maxpending:
+            self.compact()
+
+    def compact(self, focus = None):
+        """Merge the pending updates into the count matrices, for the given word expert only or for all"""
+        if focus is None:
+            for focus in self.pending:
+                self.compact(focus)
+        elif self.pending[focus]:
+            cellkeys, counts = self.cells[focus]
+            cellkeys = numpy.concatenate( [cellkeys] + [ x[0] for x in self.pending[focus] ] )
+            counts = numpy.concatenate( [counts] + [ x[1] for x in self.pending[focus] ] )
+            self.pendingsize -= len(cellkeys) - len(self.cells[focus][0])
+            cellkeys, inverse = numpy.unique(cellkeys, return_inverse=True)
+            self.cells[focus] = (cellkeys, numpy.bincount(inverse, weights=counts).astype(numpy.int64))
+            self.pending[focus] = []
+            if focus in self.tables: del self.tables[focus]
+
+    def matrix(self, focus):
+        """Returns the non-zero cells of the count matrix of a word expert as arrays (senseids, keywordids, counts)"""
+        self.compact(focus)
+        cellkeys, counts = self.cells[focus]
+        return cellkeys >> 32, cellkeys & 0xffffffff, counts
+
+    def table(self, focus):
+        """Returns the P(sense|keyword) table of a word expert as arrays (senseids, keywordids, counts, corpuscounts, p) over the non-zero cells of its count matrix, followed by the marginal count of every keyword in the context of the word expert (indexed by keyword id). Computed in one go and cached until the counts change"""
+        self.compact(focus)
+        if not focus in self.tables:
+            senseids, keywordids, c = self.matrix(focus)
+            marginals = numpy.bincount(keywordids, weights=c) if len(keywordids) else numpy.zeros(0)
+            Nkloc = marginals[keywordids] #occurrences of the keyword in the context of any sense
+            Nkcorp = self.totalcount[keywordids].astype(numpy.float64)
+            self.tables[focus] = (senseids, keywordids, c, Nkcorp, (c / Nkloc) * (1 / Nkcorp), marginals)
+        return self.tables[focus]
+
+    def count(self, focus, senseid, keywordid):
+        """Returns the count of a single cell"""
+        self.compact(focus)
+        cellkeys, counts = self.cells[focus]
+        index = numpy.searchsorted(cellkeys, (senseid << 32) | keywordid)
+        if index < len(cellkeys) and cellkeys[index] == (senseid << 32) | keywordid:
+            return counts[index]
+        return 0
+
+    def merge(self, other, vocabularykeys):
+        """Add the counts of another instance, typically of a worker process, whose keyword ids map to vocabularykeys"""
+        other.compact()
+        keymap = numpy.array([ self.vocabulary.id(key) for key in vocabularykeys ], dtype=numpy.int64)
+        if len(keymap):
+            self.grow(keymap.max() + 1)
+            self.totalcount[keymap] += other.totalcount[:len(keymap)]
+            if self.tables: self.tables = {}
+        for focus, (cellkeys, counts) in other.cells.items():
+            if not len(cellkeys): continue
+            if not focus in self.senses:
+                self.senses[focus] = Vocabulary()
+                self.cells[focus] = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+                self.pending[focus] = []
+            sensemap = numpy.array([ self.senses[focus].id(sense) for sense in other.senses[focus].keys ], dtype=numpy.int64)
+            self.add(focus, (sensemap[cellkeys >> 32] << 32) | keymap[cellkeys & 0xffffffff], counts)
+
+    def __contains__(self, focus):
+        return focus in self.senses
+
+    def __iter__(self):
+        """Iterates over all word experts"""
+        return iter(self.senses.keys())
+
+
+class BagEncoder(object):
+    """Compiled bag-of-words feature encoder for a word expert, maps every keyword (lemma,pos) of the bag to its feature column (columns in sorted keyword order). Shared by trainer and tester so both produce the very same global features"""
+
+    def __init__(self, keywords):
+        self.keywords = sorted(set(keywords))
+        self.columns = dict( (keyword, column) for column, keyword in enumerate(self.keywords) )
+
+    def encode(self, contextkeys, focusindex = -1):
+        """Returns the bag-of-words features for the (lemma,pos) pairs of a sentence: "1" for each keyword found in the sentence, "0" otherwise. The focus word itself, at focusindex, is not considered"""
+        features = ["0"] * len(self.keywords)
+        for j, key in enumerate(contextkeys):
+            if j != focusindex:
+                column = self.columns.get(key)
+                if column is not None:
+                    features[column] = "1"
+        return features
+
+    def __len__(self):
+        return len(self.keywords)
+
+
+class BagStore(object):
+    """Indexed store of the bags of words of all word experts of a training run: a single SQLite database (bags.sqlite in the output directory) rather than a .bag file per word expert. Bags are loaded lazily, as BagEncoder, when a word expert is first asked for. A directory may be passed instead of a database, for training runs that still have separate .bag files.
+
+    Only the trainer creates a store (create=True), opening a store that does not exist raises an exception rather than yielding an empty store"""
+
+    def __init__(self, filename, targetlang, create = False):
+        self.filename = filename
+        self.targetlang = targetlang
+        self.encoders = {}
+        if os.path.isdir(filename):
+            self.db = None
+        elif create:
+            self.db = sqlite3.connect(filename)
+            self.db.execute("CREATE TABLE IF NOT EXISTS bags (targetlang TEXT, focuslemma TEXT, focuspos TEXT, keylemma TEXT, keypos TEXT, sense TEXT, count INTEGER, p REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS wordexpert ON bags (targetlang, focuslemma, focuspos)")
+        elif not os.path.exists(filename):
+            raise Exception("Bag store does not exist: " + filename)
+        else:
+            self.db = sqlite3.connect(filename)
+            if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bags'").fetchone() is None:
+                self.db.close()
+                raise Exception("Not a bag store: " + filename)
+
+    def bagfile(self, focuslemma, focuspos):
+        return self.filename + '/' + focuslemma + '.' + focuspos + '.' + self.targetlang + '.bag'
+
+    def write(self, focuslemma, focuspos, bag):
+        """Store the bag of a word expert, a list of (lemma,pos,sense,count,p), replacing any previous one. Call commit() when done"""
+        self.db.execute("DELETE FROM bags WHERE targetlang = ? AND focuslemma = ? AND focuspos = ?", (self.targetlang, focuslemma, focuspos))
+        self.db.executemany("INSERT INTO bags VALUES (?,?,?,?,?,?,?,?)", [ (self.targetlang, focuslemma, focuspos) + entry for entry in bag ])
+        if (focuslemma,focuspos) in self.encoders:
+            del self.encoders[(focuslemma,focuspos)]
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def bag(self, focuslemma, focuspos):
+        """Returns the bag of a word expert as a list of (lemma,pos,sense,count,p), sorted"""
+        if self.db:
+            return [ tuple(row) for row in self.db.execute("SELECT keylemma, keypos, sense, count, p FROM bags WHERE targetlang = ? AND focuslemma = ? AND focuspos = ? ORDER BY keylemma, keypos, sense", (self.targetlang, focuslemma, focuspos)) ]
+        else:
+            bag = []
+            f = codecs.open(self.bagfile(focuslemma, focuspos),'r','utf-8')
+            for line in f:
+                fields = line.strip('\n').split("\t")
+                bag.append( (fields[0], fields[1], fields[2], int(fields[3]), float(fields[4])) )
+            f.close()
+            return bag
+
+    def __contains__(self, key):
+        focuslemma, focuspos = key
+        if key in self.encoders:
+            return True
+        elif self.db:
+            return self.db.execute("SELECT 1 FROM bags WHERE targetlang = ? AND focuslemma = ? AND focuspos = ? LIMIT 1", (self.targetlang, focuslemma, focuspos)).fetchone() is not None
+        else:
+            return os.path.exists(self.bagfile(focuslemma, focuspos))
+
+    def __getitem__(self, key):
+        """Returns the BagEncoder of a word expert"""
+        try:
+            return self.encoders[key]
+        except KeyError:
+            if not key in self:
+                raise KeyError(key)
+            focuslemma, focuspos = key
+            print >>sys.stderr, "Loading bag for " + focuslemma.encode('utf-8') + '.' + focuspos
+            self.encoders[key] = BagEncoder( (keylemma,keypos) for keylemma, keypos, _, _, _ in self.bag(focuslemma, focuspos) )
+            return self.encoders[key]
+
+
+class OccurrenceBuffer(object):
+    """Buffers target word occurrences (tuples of marshallable data) for single-pass training. Occurrences are held in memory and spilled to disk whenever more than maxsize are held. Iterating yields them in the order they were appended"""
+
+    def __init__(self, filename, maxsize = 1000000, spilled = 0):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.buffer = []
+        self.spilled = spilled #number of occurrences already in the file (when reopening a flushed buffer)
+        self.f = None
+
+    def append(self, occurrence):
+        self.buffer.append(occurrence)
+        if len(self.buffer) >= self.maxsize:
+            self.spill()
+
+    def spill(self):
+        print >>sys.stderr, "Spilling " + str(len(self.buffer)) + " buffered occurrences to " + self.filename
+        if not self.f:
+            self.f = open(self.filename,'wb')
+        for occurrence in self.buffer:
+            marshal.dump(occurrence, self.f)
+        self.spilled += len(self.buffer)
+        self.buffer = []
+
+    def flush(self):
+        """Spill all occurrences to disk and close the file, the buffer can be reopened later by passing the number of occurrences"""
+        self.spill()
+        self.f.close()
+        self.f = None
+
+    def __len__(self):
+        return self.spilled + len(self.buffer)
+
+    def __iter__(self):
+        if self.spilled:
+            if self.f: self.f.flush()
+            f = open(self.filename,'rb')
+            for i in xrange(self.spilled):
+                yield marshal.load(f)
+            f.close()
+        for occurrence in self.buffer:
+            yield occurrence
+
+    def close(self):
+        self.buffer = []
+        if self.f:
+            self.f.close()
+            self.f = None
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+
+class TaggedCorpus(object):
+    """Compact binary store of the tagger output for a corpus. Words, lemmas and PoS tags are integer-encoded with one shared vocabulary; all (word,lemma,pos) id triples are stored in a single memory-mapped file, with an index of sentence offsets.
+
+    The store is built once per corpus (see build()) and can then be used in place of the tagger: process() returns the next sentence and reset() rewinds, just like a file-based Tagger, whereas sentences can also be accessed at random by index."""
+
+    VERSION = "2" #format of the store, stores of another version are rebuilt
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+        #the vocabulary is a marshalled list of unicode strings, tokens may contain any character
+        f = open(prefix + '.vocab','rb')
+        self.vocabulary = marshal.load(f)
+        f.close()
+
+        self.index = array.array('I')
+        f = open(prefix + '.index','rb')
+        self.index.fromstring(f.read())
+        f.close()
+
+        f = open(prefix + '.data','rb')
+        if os.path.getsize(prefix + '.data') > 0:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+        f.close()
+
+        self.cursor = 0
+
+    def __len__(self):
+        return len(self.index) - 1
+
+    def __getitem__(self, sentencenum):
+        """Returns (words, postags, lemmas) for the specified sentence (0-indexed)"""
+        begin = self.index[sentencenum] * 12 #three 4-byte ids per token
+        end = self.index[sentencenum+1] * 12
+        ids = array.array('I')
+        ids.fromstring(self.data[begin:end])
+        words = [ self.vocabulary[x] for x in ids[0::3] ]
+        lemmas = [ self.vocabulary[x] for x in ids[1::3] ]
+        postags = [ self.vocabulary[x] for x in ids[2::3] ]
+        return words, postags, lemmas
+
+    def __iter__(self):
+        for sentencenum in xrange(len(self)):
+            yield self[sentencenum]
+
+    def process(self, words):
+        """Returns the next sentence (the words passed are ignored), so the store can stand in for the tagger it was built with"""
+        sentence = self[self.cursor]
+        self.cursor += 1
+        return sentence
+
+    def reset(self):
+        self.cursor = 0
+
+    def wordforms(self, targetwords):
+        """Returns the set of words in the corpus tagged with the lemma and PoS of one of the target words (the PoS reduced to its lowercased first letter, as in training), which includes the irregular inflections of the target words"""
+        lemmas = set( lemma for lemma, pos in targetwords )
+        lemmaids = [ id for id, key in enumerate(self.vocabulary) if key in lemmas ]
+        if not lemmaids or not len(self.data):
+            return set()
+        ids = numpy.frombuffer(self.data, dtype=numpy.uint32).reshape(-1,3)
+        triples = ids[numpy.in1d(ids[:,1], lemmaids)]
+        wordforms = set()
+        for wordid, lemmaid, posid in set( tuple(triple) for triple in triples.tolist() ):
+            if (self.vocabulary[lemmaid], self.vocabulary[posid][:1].lower()) in targetwords:
+                wordforms.add(self.vocabulary[wordid])
+        return wordforms
+
+    @staticmethod
+    def uptodate(prefix, corpusfile, taggerspec):
+        """Is there a store for this corpus, in the current format, that was built with the same tagger and is not older than the corpus?"""
+        for ext in ('.info','.vocab','.index','.data'):
+            if not os.path.exists(prefix + ext) or os.path.getmtime(prefix + ext) < os.path.getmtime(corpusfile):
+                return False
+        f = codecs.open(prefix + '.info','r','utf-8')
+        info = f.read().split("\n")
+        f.close()
+        return info[:2] == [taggerspec, TaggedCorpus.VERSION]
+
+    @staticmethod
+    def build(prefix, corpusfile, tagger, taggerspec):
+        """Tag a corpus (one sentence per line, tokenised) and write the store. Words, lemmas and tags are stripped of surrounding whitespace (the file-based Tagger, for one, leaves the newline on the last tag of a sentence)"""
+        print >>sys.stderr, "Building tagged corpus store " + prefix + " for " + corpusfile
+        vocabulary = Vocabulary()
+        index = array.array('I',[0])
+        tokens = 0
+        tagger.reset()
+        f_in = codecs.open(corpusfile,'r','utf-8')
+        f_data = open(prefix + '.data','wb')
+        for sentencenum, (words, postags, lemmas) in enumerate(tagstream(tagger, ( line.strip().split() for line in f_in ))):
+            if (sentencenum+1) % 10000 == 0:
+                print >>sys.stderr, "@" + str(sentencenum+1)
+            ids = array.array('I')
+            for word, pos, lemma in zip(words, postags, lemmas):
+                ids.append(vocabulary.id(word.strip()))
+                ids.append(vocabulary.id(lemma.strip()))
+                ids.append(vocabulary.id(pos.strip()))
+            ids.tofile(f_data)
+            tokens += len(ids) / 3
+            index.append(tokens)
+        f_in.close()
+        f_data.close()
+
+        f = open(prefix + '.index','wb')
+        index.tofile(f)
+        f.close()
+
+        f = open(prefix + '.vocab','wb')
+        marshal.dump( [ unicode(key) for key in vocabulary.keys ], f)
+        f.close()
+
+        #written last, marks the store as complete
+        f = codecs.open(prefix + '.info','w','utf-8')
+        f.write(taggerspec + "\n" + TaggedCorpus.VERSION + "\n")
+        f.close()
+        print >>sys.stderr, "Stored " + str(len(index) - 1) + " sentences, " + str(tokens) + " tokens, " + str(len(vocabulary)) + " types"
+
+    @staticmethod
+    def load(corpusfile, tagger, taggerspec):
+        """Returns the store for a corpus, building it first if there is none for this tagger yet"""
+        prefix = corpusfile + '.tagstore'
+        if not TaggedCorpus.uptodate(prefix, corpusfile, taggerspec):
+            TaggedCorpus.build(prefix, corpusfile, tagger, taggerspec)
+        print >>sys.stderr, "Loading tagged corpus store " + prefix
+        return TaggedCorpus(prefix)
+
+
+_shardtrainer = None
+
+def _runshard(args):
+    """Worker for sharded training, operates on the trainer inherited from the parent process"""
+    stage, shardnum, shard, bags = args
+    return _shardtrainer.runshard(stage, shardnum, shard, bags)
+
+
 class CLWSD2Trainer(object):
 
-    def __init__(self, outputdir, targetlang, phrasetable, gizamodel_s2t, gizamodel_t2s, sourcefile, targetfile, targetwordsfile, sourcetagger, targettagger, contextsize, DOPOS, DOLEMMAS, DOVOTER, exemplarweights, timbloptions, bagofwords, compute_bow_params, bow_absolute_threshold, bow_prob_threshold, bow_filter_threshold, maxdivergencefrombest = 0.5):
+    def __init__(self, outputdir, targetlang, phrasetable, gizamodel_s2t, gizamodel_t2s, sourcefile, targetfile, targetwordsfile, sourcetagger, targettagger, contextsize, DOPOS, DOLEMMAS, DOVOTER, exemplarweights, timbloptions, bagofwords, compute_bow_params, bow_absolute_threshold, bow_prob_threshold, bow_filter_threshold, maxdivergencefrombest = 0.5, singlepass = False, maxbuffer = 1000000, workers = 1, gizafiles = None, alignments = None, voterfolds = None):
         if phrasetablefile and not os.path.exists(phrasetablefile):
             raise Exception("Moses phrasetable does not exist: " + phrasetablefile)
         if not os.path.exists(sourcefile):
@@ -292,6 +1391,8 @@ class CLWSD2Trainer(object):
         self.exemplarweights = exemplarweights
         self.outputdir = outputdir
         self.classifiers = {}
+        self.votertrain = {} #(lemma,pos) -> [(classlabel, gold)], filled by makevoterinput, for Voter.addtrain
+        self.voterfolds = voterfolds #None: voter input by classifying the training data itself, 0: leave-one-out, k: k-fold cross-validation
 
         self.bagofwords = bagofwords
         self.compute_bow_params = compute_bow_params
@@ -300,60 +1401,59 @@ class CLWSD2Trainer(object):
         self.bow_filter_threshold = bow_filter_threshold
         self.timbloptions = timbloptions
         self.maxdivergencefrombest = maxdivergencefrombest
-
-    def probability_sense_given_keyword(self, focuslemma,focuspos,senselabel, lemma,pos, count, totalcount):
-        if not (focuslemma,focuspos) in count:
+        self.singlepass = singlepass
+        self.maxbuffer = maxbuffer
+        self.vocabulary = Vocabulary()
+        self.workers = workers
+        self.gizafiles = gizafiles
+        self.alignments = alignments
+        self.optionngrams = {}
+
+    def probability_sense_given_keyword(self, focuslemma,focuspos,senselabel, lemma,pos, counts):
+        if not (focuslemma,focuspos) in counts:
             print "focusword not seen", focuslemma.encode('utf-8') +'.'+ focuspos
             return 0 #focus word has not been counted for
 
-        if not senselabel in count[(focuslemma,focuspos)]:
+        if not senselabel in counts.senses[(focuslemma,focuspos)]:
             print "sense not seen:", senselabel.encode('utf-8')
             return 0 #sense has never been seen for this focus word
 
-        if not (lemma,pos) in totalcount:
+        if not (lemma,pos) in self.vocabulary or counts.totalcount[self.vocabulary.id((lemma,pos))] == 0:
             print "keyword not seen:", lemma.encode('utf-8')+'.'+pos
             return 0 #keyword has never been seen
 
-        Ns_kloc = 0.0
-        if (lemma,pos) in count[(focuslemma,focuspos)][senselabel]:
-            Ns_kloc = float(count[(focuslemma,focuspos)][senselabel][(lemma,pos)])
+        keywordid = self.vocabulary.id((lemma,pos))
+        marginals = counts.table((focuslemma,focuspos))[-1]
+        if keywordid >= len(marginals) or marginals[keywordid] == 0:
+            return 0 #keyword has never been seen in the context of the focus word
+        Nkloc = marginals[keywordid]
+        Ns_kloc = float(counts.count((focuslemma,focuspos), counts.senses[(focuslemma,focuspos)].id(senselabel), keywordid))
 
-        Nkloc = 0
-        for sense in count[(focuslemma,focuspos)]:
-            if (lemma,pos) in count[(focuslemma,focuspos)][sense]:
-                Nkloc += count[(focuslemma,focuspos)][sense][(lemma,pos)]
-
-
-        Nkcorp = float(totalcount[(lemma,pos)]) #/ float(totalcount_sum)
-
-        #if focuslemma == 'wild':
-        #    print "p = (",Ns_kloc,"/",Nkloc,") * 1/",Nkcorp, " = ",  (Ns_kloc / Nkloc) * (1/Nkcorp)
+        Nkcorp = float(counts.totalcount[self.vocabulary.id((lemma,pos))]) #/ float(totalcount_sum)
 
         return (Ns_kloc / float(Nkloc)) * (1/Nkcorp)
 
 
-    def make_bag_of_words(self, focuslemma, focuspos, bow_absolute_threshold, count, totalcount):
+    def make_bag_of_words(self, focuslemma, focuspos, bow_absolute_threshold, counts, bagstore):
         print >>sys.stderr, "Computing and writing bag for " + focuslemma.encode('utf-8') + "..."
 
-        if not (focuslemma,focuspos) in count:
+        if not (focuslemma,focuspos) in counts:
             print >>sys.stderr, "   WARNING: No count found!"
             return [] #focus word has not been counted for
 
+        senseids, keywordids, c, Nkcorp, p, _ = counts.table((focuslemma,focuspos))
+
+        #select all words that occur at least 3 times for a sense, and have a probability_sense_given_keyword >= 0.001, filter very rare words (occuring less than 20 times)
+        selected = numpy.nonzero( (Nkcorp >= self.bow_filter_threshold) & (c >= bow_absolute_threshold) & (p >= self.bow_prob_threshold) )[0]
+
+        senses = counts.senses[(focuslemma,focuspos)]
         bag = []
-        #select all words that occur at least 3 times for a sense, and have a probability_sense_given_keyword >= 0.001
-        for sense in count[(focuslemma,focuspos)]:
-            for lemma, pos in count[(focuslemma,focuspos)][sense].keys():
-                 if (totalcount[(lemma,pos)] >= self.bow_filter_threshold): #filter very rare words (occuring less than 20 times)
-                     if count[(focuslemma,focuspos)][sense][(lemma,pos)] >= bow_absolute_threshold:
-                        p = self.probability_sense_given_keyword(focuslemma,focuspos,sense,lemma,pos, count, totalcount)
-                        if p >= self.bow_prob_threshold:
-                            bag.append( (lemma,pos, sense, count[(focuslemma,focuspos)][sense][(lemma,pos)], p) )
+        for index in selected:
+            lemma, pos = self.vocabulary.key(keywordids[index])
+            bag.append( (lemma,pos, senses.key(senseids[index]), int(c[index]), float(p[index])) )
 
         bag = sorted(bag)
-        f = codecs.open(self.outputdir+ '/' + focuslemma + '.' + focuspos+ '.' + self.targetlang + '.bag','w','utf-8')
-        for lemma,pos, sense, c, p in bag:
-            f.write(lemma + '\t' + pos + '\t' + sense + '\t' + str(c) + '\t' + str(p) + '\n')
-        f.close()
+        bagstore.write(focuslemma, focuspos, bag)
 
         print >>sys.stderr, "\tFound " + str(len(bag)) + " keywords"
         return bag
@@ -361,231 +1461,405 @@ class CLWSD2Trainer(object):
 
 
 
-    def run(self):
+    def sentences(self, shard = None):
+        """Reads the parallel corpus and its alignments and tags both sides, yields (sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection) per sentence pair.
 
-        count = {}
-        totalcount = {}
-        totalcount_sum = 0
-        bags = {} #will store bags of words
-
-        if self.bagofwords:
-            finalstage = False
+        If a shard (firstsentence, numsentences, offsets) is specified, only that range of sentences is read, starting at the byte offsets in the source, target, and alignment store or both GIZA files. The taggers must then be TaggedCorpus stores"""
+        if shard:
+            firstsentence, numsentences, offsets = shard
+            f_source = readlines(self.sourcefile, offsets[0], numsentences)
+            f_target = readlines(self.targetfile, offsets[1], numsentences)
+            if self.alignments:
+                iter_alignments = self.alignments.iterfrom(offsets[2])
+            elif self.gizamodel_s2t:
+                iter_s2t = readgiza(self.gizafiles[0], offsets[2])
+                iter_t2s = readgiza(self.gizafiles[1], offsets[3])
         else:
-            finalstage = True
-
-
-
-
-
-        while True:
+            firstsentence = 0
             if self.sourcetagger: self.sourcetagger.reset()
             if self.targettagger: self.targettagger.reset()
 
-            if not finalstage and self.bagofwords:
-                print >>sys.stderr, "Reading texts and counting for global context (first pass)"
-            elif finalstage:
-                print >>sys.stderr, "Reading texts and extracting features (last pass)"
             f_source = codecs.open(self.sourcefile,'r','utf-8')
             f_target = codecs.open(self.targetfile,'r','utf-8')
 
-            if self.gizamodel_s2t:
+            #tag in chunks, so pooled taggers can process many sentences concurrently
+            sourcetagged = tagstream(self.sourcetagger, ( line.strip().split() for line in codecs.open(self.sourcefile,'r','utf-8') ))
+            if self.targettagger:
+                targettagged = tagstream(self.targettagger, ( line.strip().split() for line in codecs.open(self.targetfile,'r','utf-8') ))
+
+            if self.alignments:
+                iter_alignments = iter(self.alignments)
+            elif self.gizamodel_s2t:
                 iter_s2t = iter(self.gizamodel_s2t)
                 iter_t2s = iter(self.gizamodel_t2s)
 
 
-            for sentencenum, (sourceline, targetline) in enumerate(zip(f_source, f_target)):
-                print >>sys.stderr, "@" + str(sentencenum+1)
+        for sentencenum, (sourceline, targetline) in enumerate(itertools.izip(f_source, f_target), firstsentence):
+            print >>sys.stderr, "@" + str(sentencenum+1)
+
+            if self.alignments:
+                try:
+                    intersection = iter_alignments.next()
+                except StopIteration:
+                    print >>sys.stderr,"WARNING: No more alignments, breaking"
+                    break
+            elif self.gizamodel_s2t:
+                try:
+                    s2t = iter_s2t.next() #self.gizamodel_s2t.next()
+                    t2s = iter_t2s.next() #self.gizamodel_t2s.next()
+                except StopIteration:
+                    print >>sys.stderr,"WARNING: No more GIZA alignments, breaking"
+                    break
+                #print >>sys.stderr, "S2T: " + repr(s2t)
+                #print >>sys.stderr, "T2S: " + repr(t2s)
+                intersection = s2t.intersect(t2s)
+                #print >>sys.stderr, "INT: " + repr(intersection)
+            else:
+                intersection = None
 
-                if self.gizamodel_s2t:
-                    try:
-                        s2t = iter_s2t.next() #self.gizamodel_s2t.next()
-                        t2s = iter_t2s.next() #self.gizamodel_t2s.next()
-                    except StopIteration:
-                        print >>sys.stderr,"WARNING: No more GIZA alignments, breaking"
-                        break
-                    #print >>sys.stderr, "S2T: " + repr(s2t)
-                    #print >>sys.stderr, "T2S: " + repr(t2s)
-                    intersection = s2t.intersect(t2s)
-                    #print >>sys.stderr, "INT: " + repr(intersection)
-                else:
-                    intersection = None
+            sourceline = sourceline.strip()
+            targetline = targetline.strip()
+            sourcewords = sourceline.split()
+            targetwords = targetline.split()
 
-                sourceline = sourceline.strip()
-                targetline = targetline.strip()
-                sourcewords = sourceline.split()
-                targetwords = targetline.split()
+            if shard:
+                sourcewords, sourcepostags, sourcelemmas = self.sourcetagger[sentencenum]
+            else:
+                sourcewords, sourcepostags, sourcelemmas = sourcetagged.next()
+            sourcepostags = [ x[0].lower() for x in sourcepostags ]
 
-                sourcewords, sourcepostags, sourcelemmas = self.sourcetagger.process(sourcewords)
-                sourcepostags = [ x[0].lower() for x in sourcepostags ]
 
+            if self.targettagger:
+                if shard:
+                    targetwords, targetpostags, targetlemmas = self.targettagger[sentencenum]
+                else:
+                    targetwords, targetpostags, targetlemmas = targettagged.next()
+            else:
+                targetlemmas = []
+
+            yield sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection
+
+        f_source.close()
+        f_target.close()
+
+
+    def occurrences(self, sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection):
+        """Finds the occurrences of target words in a sentence pair for which a translation can be established, yields (i, sourcelemma, sourcepos, target, localfeatures)"""
+        targetindex = None #n-gram index of the target sentence, built when first needed
+        for i, (sourceword, sourcepos, sourcelemma) in enumerate(zip(sourcewords, sourcepostags, sourcelemmas)):
+            if (sourcelemma, sourcepos) in self.targetwords:
+                print >>sys.stderr, " @" + str(sentencenum+1) + ":" + str(i) + " -- Found " + sourcelemma.encode('utf-8') + '.' + sourcepos,
+                target = None
+                Pst = Pts = 0
+                if intersection != None:
+                    target, foundindex = intersection.getalignedtarget(i)
+                    if isinstance(foundindex, tuple):
+                        targetl = foundindex[1]
+                        foundindex = foundindex[0]
+
+
+                #Is this sourceword aligned?
+                if (self.phrasetable != None and sourceword in self.phrasetable) or (intersection != None and target != None):
+
+                    #find options in phrasetable
+                    if self.phrasetable:
+                        try:
+                            translationoptions = self.phrasetable[sourceword]  #[ (target, Pst, Pts, null_alignments) ]
+                        except KeyError:
+                            continue
+                    elif self.gizamodel_s2t or self.alignments:
+                        #We already have the aligned target
+                        translationoptions = None
+                        print >>sys.stderr, " aligned with '" + target.encode('utf-8') + "'"
+
+
+
+                    #grab local context features
+                    localfeatures = []
+                    for j in range(i - self.contextsize, i + 1 + self.contextsize):
+                        if j > 0 and j < len(sourcewords):
+                            localfeatures.append(sourcewords[j])
+                            if self.DOPOS: localfeatures.append(sourcepostags[j])
+                            if self.DOLEMMAS: localfeatures.append(sourcelemmas[j])
+                        else:
+                            localfeatures.append("{NULL}")
+                            if self.DOPOS: localfeatures.append("{NULL}")
+                            if self.DOLEMMAS: localfeatures.append("{NULL}")
+
+
+                    if translationoptions:
+                        #Find which translation option is the best match here, only one may be used
+                        if targetindex is None:
+                            targetindex = NGramIndex(targetwords)
+                        targetngrams, scores = self.translationngrams(sourceword, translationoptions)
+                        bestpossiblescore = max(scores)
+
+                        #check if and where each option occurs in the target sentence, and take the first best scoring one that does
+                        foundindices = [ targetindex.find(ngram) for ngram in targetngrams ]
+                        bestscore = 0
+                        best = None
+                        for k, (foundindex, Pts) in enumerate(zip(foundindices, scores)):
+                            if foundindex != -1 and Pts > bestscore:
+                                bestscore = Pts
+                                best = k
+
+                        if best is None:
+                            print >>sys.stderr,"No translation options match"
+                            continue
+                        elif bestscore < bestpossiblescore * self.maxdivergencefrombest:
+                            print >>sys.stderr,"Matching translation option '" + translationoptions[best][0].encode('utf-8') + "' scores too low (" + str(bestscore) + " vs " + str(bestpossiblescore) + ")"
+                            continue
+                        else:
+                            target = translationoptions[best][0]
+                            foundindex = foundindices[best]
+                            targetl = len(targetngrams[best])
+                            print >>sys.stderr, " aligned with '" + target.encode('utf-8') + "'"
+
+                    #get lemmatised form of target word
+                    if self.targettagger:
+                        if ' ' in target:
+                            target = ' '.join(targetlemmas[foundindex:foundindex+targetl])
+                        else:
+                            target = targetlemmas[foundindex]
 
-                if self.targettagger:
-                    targetwords, targetpostags, targetlemmas = self.targettagger.process(targetwords)
-                    targetpostags = [ x[0].lower() for x in targetpostags ]
+                    print >>sys.stderr, "\t\"" + target.encode('utf-8') + "\""
+                    yield i, sourcelemma, sourcepos, target, localfeatures
                 else:
-                    targetpostags = []
-                    targetlemmas = []
+                    print >>sys.stderr
+
+
+    def translationngrams(self, sourceword, translationoptions):
+        """Returns the translation options of a source word as word tuples, along with their scores (Pts). Cached, as the same words are looked up over and over again"""
+        try:
+            return self.optionngrams[sourceword]
+        except KeyError:
+            self.optionngrams[sourceword] = ( [ tuple(target.split(' ')) for target, Pst, Pts, _ in translationoptions ], [ Pts for target, Pst, Pts, _ in translationoptions ] )
+            return self.optionngrams[sourceword]
+
+    def counttotal(self, counts, sourcelemmas, sourcepostags):
+        """Count all words of a sentence for the global corpus frequency (bag-of-words first pass), returns the keyword ids of the sentence"""
+        ids = counts.ids(sourcelemmas, sourcepostags)
+        counts.addsentence(ids)
+        return ids
+
+    def countcontext(self, counts, i, sourcelemma, sourcepos, target, ids):
+        """Count the context words (keyword ids of the sentence) of a target word occurrence for the given sense (bag-of-words first pass)"""
+        counts.addcontext( (sourcelemma,sourcepos), target, numpy.concatenate( (ids[:i], ids[i+1:]) ) )
+
+    def bagthreshold(self, focuslemma, focuspos, counts):
+        """Returns the absolute threshold for the bag of words of a word expert when computing the bag-of-words parameters (-R). The configured threshold is loosened while it selects 5 keywords or fewer and tightened while it selects 500 or more, in steps of one. Rather than trying every step, the outcome is read directly from the sorted counts of all candidate keywords (those passing the other thresholds)"""
+        absthreshold = self.bow_absolute_threshold
+        if not (focuslemma,focuspos) in counts:
+            return absthreshold
+        senseids, keywordids, c, Nkcorp, p, _ = counts.table((focuslemma,focuspos))
+        candidates = numpy.sort(c[(Nkcorp >= self.bow_filter_threshold) & (p >= self.bow_prob_threshold)])[::-1]
+        size = numpy.count_nonzero(candidates >= absthreshold)
+        if size <= 5 and absthreshold > 1:
+            #too few results, loosen parameters: the highest threshold still selecting six keywords, if any
+            if len(candidates) > 5:
+                absthreshold = int(candidates[5])
+            else:
+                absthreshold = 1
+        elif size >= 500:
+            #too many results, tighten parameters: the lowest threshold selecting fewer than 500 keywords
+            absthreshold = int(candidates[499]) + 1
+        return absthreshold
+
+    def make_bags(self, counts):
+        """Make the bags of words for all word experts and write them to the bag store, returns a BagEncoder per word expert"""
+        print >>sys.stderr, "Making bags of words"
+        bags = {}
+        bagstore = BagStore(self.outputdir + '/bags.sqlite', self.targetlang, True)
+        for lemma,pos in counts:
+            if self.compute_bow_params:
+                bag = self.make_bag_of_words(lemma,pos, self.bagthreshold(lemma,pos, counts), counts, bagstore)
+            else:
+                bag = self.make_bag_of_words(lemma,pos, self.bow_absolute_threshold,  counts, bagstore)
+            bags[(lemma,pos)] = BagEncoder( (keylemma,keypos) for keylemma,keypos,_,_,_ in bag )
+        bagstore.commit()
+        bagstore.close()
+        return bags
+
+    def append(self, sourcelemma, sourcepos, target, localfeatures, contextkeys, focusindex, bags):
+        """Add a training instance to the word expert, contextkeys are the (lemma,pos) pairs of the sentence and focusindex the position of the target word in it (used for the bag-of-words features)"""
+        if not (sourcelemma,sourcepos, self.targetlang) in self.classifiers:
+            #init classifier
+            self.classifiers[(sourcelemma,sourcepos, self.targetlang)] = timbl.TimblClassifier(self.outputdir + '/' + sourcelemma +'.' + sourcepos + '.' + self.targetlang, self.timbloptions)
+
+
+        if self.bagofwords and (sourcelemma,sourcepos) in bags:
+            globalfeatures = bags[(sourcelemma,sourcepos)].encode(contextkeys, focusindex)
+            self.classifiers[(sourcelemma,sourcepos, self.targetlang)].append(localfeatures + globalfeatures, target)
+        else:
+            self.classifiers[(sourcelemma,sourcepos, self.targetlang)].append(localfeatures, target)
+
+
+    def shards(self):
+        """Splits the corpus into one line range per worker, returns a list of (firstsentence, numsentences, offsets), the offsets being the byte offsets in the source, target and both GIZA files at which the shard starts"""
+        if not isinstance(self.sourcetagger, TaggedCorpus) or (self.targettagger and not isinstance(self.targettagger, TaggedCorpus)):
+            raise Exception("Training with multiple workers requires tagged corpus stores for source and target (use --tagcache)")
+        if self.gizamodel_s2t and not self.alignments and not self.gizafiles:
+            raise Exception("Training with multiple workers requires the GIZA filenames to be passed")
+        if self.gizamodel_s2t and not self.alignments and (compressed(self.gizafiles[0]) or compressed(self.gizafiles[1])):
+            raise Exception("Training with multiple workers can not split compressed GIZA++ files into ranges, decompress them or use --alignments")
+
+        total = len(self.sourcetagger)
+        shardsize = max(1, (total + self.workers - 1) / self.workers)
+        print >>sys.stderr, "Computing shards of " + str(shardsize) + " sentences"
+        offsets = [ recordoffsets(self.sourcefile, shardsize), recordoffsets(self.targetfile, shardsize) ]
+        if self.alignments:
+            offsets.append( [ self.alignments.index[sentencenum] for sentencenum in range(0, len(self.alignments), shardsize) ] )
+        elif self.gizamodel_s2t:
+            offsets.append( recordoffsets(self.gizafiles[0], shardsize, 3) )
+            offsets.append( recordoffsets(self.gizafiles[1], shardsize, 3) )
+
+        shards = []
+        for shardnum in range(min( len(x) for x in offsets )):
+            firstsentence = shardnum * shardsize
+            if firstsentence >= total: break
+            shards.append( (firstsentence, min(shardsize, total - firstsentence), [ x[shardnum] for x in offsets ]) )
+        return shards
+
+    def runshard(self, stage, shardnum, shard, bags):
+        """Process a single shard in a worker process. Stage 'count' returns the partial counts and the vocabulary keys their ids map to, stage 'buffer' additionally buffers all occurrences on disk and returns (counts, vocabularykeys, bufferfile, bufferedoccurrences), stage 'extract' writes partial per-word-expert instance files to a shard directory and returns the word experts found"""
+        if stage in ('count','buffer'):
+            counts = CooccurrenceCounts(self.vocabulary)
+            if stage == 'buffer':
+                buffer = OccurrenceBuffer(self.outputdir + '/shard' + str(shardnum) + '.buffer', self.maxbuffer)
+            for sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection in self.sentences(shard):
+                ids = self.counttotal(counts, sourcelemmas, sourcepostags)
+                contextids = None
+                for i, sourcelemma, sourcepos, target, localfeatures in self.occurrences(sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection):
+                    self.countcontext(counts, i, sourcelemma, sourcepos, target, ids)
+                    if stage == 'buffer':
+                        if contextids is None:
+                            contextids = ids.tolist()
+                        buffer.append( (sourcelemma, sourcepos, target, localfeatures, contextids, i) )
+            counts.compact()
+            if stage == 'buffer':
+                buffer.flush()
+                return counts, self.vocabulary.keys, buffer.filename, len(buffer)
+            else:
+                return counts, self.vocabulary.keys
+        elif stage == 'extract':
+            #we are in a forked copy of the trainer, so we can simply redirect its output to the shard directory
+            self.outputdir = self.outputdir + '/shard' + str(shardnum)
+            if not os.path.isdir(self.outputdir):
+                os.mkdir(self.outputdir)
+            self.classifiers = {}
+            for sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection in self.sentences(shard):
+                for i, sourcelemma, sourcepos, target, localfeatures in self.occurrences(sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection):
+                    self.append(sourcelemma, sourcepos, target, localfeatures, zip(sourcelemmas, sourcepostags), i, bags)
+            for classifier in self.classifiers.values():
+                classifier.flush()
+            return self.classifiers.keys()
+        else:
+            raise ValueError("Unknown stage: " + stage)
+
+    def mapshards(self, stage, shards, bags = None):
+        """Run a stage over all shards in a pool of worker processes, returns the results in shard order"""
+        global _shardtrainer
+        print >>sys.stderr, "Processing " + str(len(shards)) + " shards in parallel (" + stage + ")"
+        _shardtrainer = self #inherited by the forked workers
+        pool = multiprocessing.Pool(len(shards))
+        try:
+            results = pool.map(_runshard, [ (stage, shardnum, shard, bags) for shardnum, shard in enumerate(shards) ], 1)
+        finally:
+            pool.close()
+            pool.join()
+            _shardtrainer = None
+        return results
+
+    def mergeshards(self, numshards, results):
+        """Concatenate the partial instance files of all shards, in shard order, into the instance files of the word experts"""
+        for sourcelemma, sourcepos, targetlang in sorted(set( key for keys in results for key in keys )):
+            fileprefix = self.outputdir + '/' + sourcelemma +'.' + sourcepos + '.' + targetlang
+            print >>sys.stderr, "Merging " + str(numshards) + " shards into " + fileprefix.encode('utf-8') + ".train"
+            f_out = open(fileprefix + '.train','wb')
+            for shardnum in range(numshards):
+                shardfile = self.outputdir + '/shard' + str(shardnum) + '/' + os.path.basename(fileprefix) + '.train'
+                if os.path.exists(shardfile):
+                    f_in = open(shardfile,'rb')
+                    shutil.copyfileobj(f_in, f_out)
+                    f_in.close()
+                    os.unlink(shardfile)
+            f_out.close()
+            self.classifiers[(sourcelemma,sourcepos,targetlang)] = timbl.TimblClassifier(fileprefix, self.timbloptions)
+        for shardnum in range(numshards):
+            shutil.rmtree(self.outputdir + '/shard' + str(shardnum), True)
 
-                for i, (sourceword, sourcepos, sourcelemma) in enumerate(zip(sourcewords, sourcepostags, sourcelemmas)):
-                    if self.bagofwords and not finalstage:
-                        if not (sourcelemma, sourcepos) in totalcount:
-                            totalcount[(sourcelemma, sourcepos)] = 1
-                        else:
-                            totalcount[(sourcelemma, sourcepos)] += 1
-                        totalcount_sum += 1
-
-
-                    if (sourcelemma, sourcepos) in self.targetwords:
-                        print >>sys.stderr, " @" + str(sentencenum+1) + ":" + str(i) + " -- Found " + sourcelemma.encode('utf-8') + '.' + sourcepos,
-                        target = None
-                        Pst = Pts = 0
-                        if intersection != None:
-                            target, foundindex = intersection.getalignedtarget(i)
-                            if isinstance(foundindex, tuple):
-                                targetl = foundindex[1]
-                                foundindex = foundindex[0]
-
-
-                        #Is this sourceword aligned?
-                        if (self.phrasetable != None and sourceword in self.phrasetable) or (intersection != None and target != None):
-
-                            #find options in phrasetable
-                            if self.phrasetable:
-                                try:
-                                    translationoptions = self.phrasetable[sourceword]  #[ (target, Pst, Pts, null_alignments) ]
-                                except KeyError:
-                                    continue
-                            elif self.gizamodel_s2t:
-                                #We already have the aligned target
-                                translationoptions = None
-                                print >>sys.stderr, " aligned with '" + target.encode('utf-8') + "'"
-
-
-
-                            #grab local context features
-                            localfeatures = []
-                            for j in range(i - self.contextsize, i + 1 + self.contextsize):
-                                if j > 0 and j < len(sourcewords):
-                                    localfeatures.append(sourcewords[j])
-                                    if self.DOPOS: localfeatures.append(sourcepostags[j])
-                                    if self.DOLEMMAS: localfeatures.append(sourcelemmas[j])
-                                else:
-                                    localfeatures.append("{NULL}")
-                                    if self.DOPOS: localfeatures.append("{NULL}")
-                                    if self.DOLEMMAS: localfeatures.append("{NULL}")
-
-
-                            if translationoptions:
-                                #Find which translation option is the best match here, only one may be used
-                                bestpossiblescore = max([ x[2] for x in translationoptions])
-                                bestscore = 0
-                                best = None
-                                for target, Pst, Pts,_ in translationoptions:
-                                    #check if and where it occurs in target sense
-                                    foundindex = -1
-                                    if ' ' in target:
-                                        targetl = target.split(' ')
-                                        for j in range(0,len(targetwords) - len(targetl)):
-                                            if targetwords[j:j+len(targetl)] == targetl:
-                                                foundindex = j
-                                                break
-                                    else:
-                                        for j, w in enumerate(targetwords):
-                                            if target == w:
-                                                foundindex = j
-                                                break
-
-                                    if foundindex != -1:
-                                        if Pts > bestscore:
-                                            bestscore = Pts
-                                            best = (target, Pts, foundindex)
-
-                                if not best:
-                                    print >>sys.stderr,"No translation options match"
-                                    continue
-                                elif bestscore < bestpossiblescore * self.maxdivergencefrombest:
-                                    print >>sys.stderr,"Matching translation option '" + target + "' scores too low (" + str(bestscore) + " vs " + str(bestpossiblescore) + ")"
-                                    continue
-                                else:
-                                    target, Pts, foundindex = best
-                                    print >>sys.stderr, " aligned with '" + target.encode('utf-8') + "'"
-
-                            #get lemmatised form of target word
-                            if self.targettagger:
-                                if ' ' in target:
-                                    if self.phrasetable:
-                                        target = ' '.join(targetlemmas[foundindex:foundindex+len(targetl)])
-                                    else:
-                                        target = ' '.join(targetlemmas[foundindex:foundindex+targetl])
-                                else:
-                                    target = targetlemmas[foundindex]
-
-                            print >>sys.stderr, "\t\"" + target.encode('utf-8') + "\"",
-                            if finalstage:
-                                if not (sourcelemma,sourcepos, self.targetlang) in self.classifiers:
-                                    #init classifier
-                                    self.classifiers[(sourcelemma,sourcepos, self.targetlang)] = timbl.TimblClassifier(self.outputdir + '/' + sourcelemma +'.' + sourcepos + '.' + targetlang, self.timbloptions)
-
-
-                                if self.bagofwords and (sourcelemma,sourcepos) in bags:
-                                    globalfeatures = []
-                                    #create new bag
-                                    bag = {}
-                                    for keylemma,keypos,_,_,_ in bags[(sourcelemma, sourcepos)]:
-                                        bag[keylemma,keypos] = 0
-
-                                    #now count the words in our context
-                                    for j, (contextword, contextpos, contextlemma) in enumerate(zip(sourcewords, sourcepostags, sourcelemmas)):
-                                        if (contextlemma, contextpos) in bag:
-                                            bag[(contextlemma,contextpos)] = 1
-
-                                    #and output the bag of words features
-                                    for contextlemma, contextpos in sorted(bag.keys()):
-                                        globalfeatures.append(bag[(contextlemma,contextpos)])
-
-                                    self.classifiers[(sourcelemma,sourcepos, self.targetlang)].append(localfeatures + globalfeatures, target)
-
-                                else:
-                                    self.classifiers[(sourcelemma,sourcepos, self.targetlang)].append(localfeatures, target)
-
-                            elif self.bagofwords:
-                                if not (sourcelemma,sourcepos) in count:
-                                    count[(sourcelemma,sourcepos)] = {}
-                                if not target in count[(sourcelemma, sourcepos)]:
-                                    count[(sourcelemma,sourcepos)][target] = {}
-
-                                for j, (contextword, contextpos, contextlemma) in enumerate(zip(sourcewords, sourcepostags, sourcelemmas)):
-                                    if j != i:
-                                        if not (contextlemma, contextpos) in count[(sourcelemma,sourcepos)][target]:
-                                            count[(sourcelemma, sourcepos)][target][(contextlemma,contextpos)] = 1
-                                        else:
-                                            count[(sourcelemma, sourcepos)][target][(contextlemma,contextpos)] += 1
-
-                            print >>sys.stderr
-
-            f_source.close()
-            f_target.close()
-            if finalstage:
-                break
-            elif self.bagofwords:
-                print >>sys.stderr, "Making bags of words"
-                for lemma,pos in count.keys():
-                    if self.compute_bow_params:
-                        bags[(lemma,pos)] = self.make_bag_of_words(lemma,pos, self.bow_absolute_threshold,count, totalcount)
-                        absthreshold = self.bow_absolute_threshold
-                        if len(bags[(lemma,pos)]) <= 5:
-                            #too few results, loosen parameters
-                            while len(bags[(lemma,pos)]) <= 5 and absthreshold > 1:
-                                absthreshold = absthreshold - 1
-                                bags[(lemma,pos)] = self.make_bag_of_words(lemma,pos,absthreshold, count, totalcount)
-                        elif len(bags[(lemma,pos)]) >= 500:
-                            #too many results, tighten parameters
-                            while len(bags[(lemma,pos)]) >= 500:
-                                absthreshold = absthreshold + 1
-                                bags[(lemma,pos)] = self.make_bag_of_words(lemma,pos, absthreshold, count, totalcount)
-                    else:
-                        bags[(lemma,pos)] = self.make_bag_of_words(lemma,pos, self.bow_absolute_threshold,  count, totalcount)
-                finalstage = True
+    def runsharded(self):
+        """Generate the training instances with multiple worker processes, each processing a range of the corpus"""
+        counts = CooccurrenceCounts(self.vocabulary)
+        bags = {} #will store bags of words
+
+        shards = self.shards()
+
+        if self.bagofwords:
+            if self.singlepass:
+                print >>sys.stderr, "Reading texts, counting for global context and buffering occurrences (single pass)"
+                results = self.mapshards('buffer', shards)
+            else:
+                print >>sys.stderr, "Reading texts and counting for global context (first pass)"
+                results = self.mapshards('count', shards)
+            for result in results:
+                counts.merge(result[0], result[1])
+
+            bags = self.make_bags(counts)
+
+            if self.singlepass:
+                for _, vocabularykeys, bufferfile, bufferedoccurrences in results:
+                    print >>sys.stderr, "Extracting features from " + str(bufferedoccurrences) + " buffered occurrences in " + bufferfile
+                    buffer = OccurrenceBuffer(bufferfile, self.maxbuffer, bufferedoccurrences)
+                    for sourcelemma, sourcepos, target, localfeatures, contextids, i in buffer:
+                        self.append(sourcelemma, sourcepos, target, localfeatures, [ vocabularykeys[id] for id in contextids ], i, bags)
+                    buffer.close()
+                return
+
+        print >>sys.stderr, "Reading texts and extracting features (last pass)"
+        results = self.mapshards('extract', shards, bags)
+        self.mergeshards(len(shards), results)
+
+
+    def run(self):
+        counts = CooccurrenceCounts(self.vocabulary)
+        bags = {} #will store bags of words
+
+        if self.workers > 1:
+            self.runsharded()
+        elif self.bagofwords and self.singlepass:
+            #count and buffer everything needed for the final stage in one pass over the corpus
+            print >>sys.stderr, "Reading texts, counting for global context and buffering occurrences (single pass)"
+            buffer = OccurrenceBuffer(self.outputdir + '/occurrences.buffer', self.maxbuffer)
+            for sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection in self.sentences():
+                ids = self.counttotal(counts, sourcelemmas, sourcepostags)
+                contextids = None
+                for i, sourcelemma, sourcepos, target, localfeatures in self.occurrences(sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection):
+                    self.countcontext(counts, i, sourcelemma, sourcepos, target, ids)
+                    if contextids is None:
+                        contextids = ids.tolist()
+                    buffer.append( (sourcelemma, sourcepos, target, localfeatures, contextids, i) )
+
+            bags = self.make_bags(counts)
+
+            print >>sys.stderr, "Extracting features from " + str(len(buffer)) + " buffered occurrences"
+            for sourcelemma, sourcepos, target, localfeatures, contextids, i in buffer:
+                self.append(sourcelemma, sourcepos, target, localfeatures, [ self.vocabulary.key(id) for id in contextids ], i, bags)
+            buffer.close()
+        else:
+            if self.bagofwords:
+                print >>sys.stderr, "Reading texts and counting for global context (first pass)"
+                for sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection in self.sentences():
+                    ids = self.counttotal(counts, sourcelemmas, sourcepostags)
+                    for i, sourcelemma, sourcepos, target, localfeatures in self.occurrences(sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection):
+                        self.countcontext(counts, i, sourcelemma, sourcepos, target, ids)
+
+                bags = self.make_bags(counts)
+
+            print >>sys.stderr, "Reading texts and extracting features (last pass)"
+            for sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection in self.sentences():
+                for i, sourcelemma, sourcepos, target, localfeatures in self.occurrences(sentencenum, sourcewords, sourcepostags, sourcelemmas, targetwords, targetlemmas, intersection):
+                    self.append(sourcelemma, sourcepos, target, localfeatures, zip(sourcelemmas, sourcepostags), i, bags)
 
         self.run2()
         if self.DOVOTER:
@@ -610,23 +1884,118 @@ class CLWSD2Trainer(object):
 
 
     def makevoterinput(self):
-        """Make traindata for voter by testing on traindata"""
+        """Make traindata for voter by testing on traindata. If voterfolds is set, each training instance is classified by a classifier that has not seen it (leave-one-out if voterfolds is 0, k-fold cross-validation otherwise), with the word experts processed in parallel by the workers"""
+        if self.voterfolds is not None:
+            self.makevoterinput_heldout()
+            return
         print >>sys.stderr, "Generating voter input by classifying traindata"
         for classifier in self.classifiers:
             id = self.classifiers[classifier].fileprefix
             print >>sys.stderr, "Making voter input for " + id.encode('utf-8') + '.votertrain'
-            f_out = codecs.open(id + '.votertrain','w','utf-8')
+            instances = []
+            goldlabels = []
             f_in = codecs.open(id + '.train','r','utf-8')
             for line in f_in:
                 line = line.strip()
                 fields = line.split("\t")
-                features = fields[:-1]
-                classlabel, distribution, distance =  self.classifiers[classifier].classify(features)
-                if not isinstance(classlabel, unicode): classlabel = unicode(classlabel,'utf-8')
-                if not isinstance(fields[-1], unicode): fields[-1] = unicode(fields[-1],'utf-8')
-                f_out.write(classlabel + "\t" + fields[-1] + "\n")
+                instances.append(fields[:-1])
+                goldlabels.append(fields[-1])
             f_in.close()
-            f_out.close()
+            cachedclassifier = CachedClassifier(PooledClassifier(id, self.timbloptions), self.timbloptions)
+            votertrain = []
+            for (classlabel, distribution, distance), gold in zip(cachedclassifier.classifybatch(instances), goldlabels):
+                if not isinstance(classlabel, unicode): classlabel = unicode(classlabel,'utf-8')
+                votertrain.append( (classlabel, gold) )
+            writevotertrain(id, votertrain)
+            lemma, pos = classifier[:2]
+            self.votertrain[(lemma,pos)] = votertrain
+            print >>sys.stderr, cachedclassifier.report()
+
+    def makevoterinput_heldout(self):
+        if self.voterfolds:
+            print >>sys.stderr, "Generating voter input by " + str(self.voterfolds) + "-fold cross-validation on traindata"
+        else:
+            print >>sys.stderr, "Generating voter input by leave-one-out classification of traindata"
+        keys = sorted(self.classifiers)
+        tasks = []
+        for classifier in keys:
+            id = self.classifiers[classifier].fileprefix
+            tasks.append( (id, classifieroptions(id, self.timbloptions), self.voterfolds) )
+        if self.workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(self.workers, len(tasks)))
+            try:
+                results = pool.map(_makevoterinput, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ _makevoterinput(args) for args in tasks ]
+        for classifier, votertrain in zip(keys, results):
+            lemma, pos = classifier[:2]
+            self.votertrain[(lemma,pos)] = votertrain
+
+
+def writevotertrain(fileprefix, votertrain):
+    f_out = codecs.open(fileprefix + '.votertrain','w','utf-8')
+    for classlabel, gold in votertrain:
+        f_out.write(classlabel + "\t" + gold + "\n")
+    f_out.close()
+
+def timblheldout(fileprefix, timbloptions, folds = 0):
+    """Classifies every training instance of a word expert with a classifier that was not trained on it: leave-one-out over the whole instance base in a single Timbl run if folds is 0, k-fold cross-validation otherwise (one Timbl run per fold). Only sensible for IB1, the default algorithm. Returns a list of (classlabel, gold) in the order of the training data"""
+    trainfile = fileprefix + '.train'
+    if not folds:
+        outputfile = fileprefix + '.loo.' + str(os.getpid()) + '.out'
+        cmd = TIMBL + timbloptions.split() + ['-f', trainfile, '-t', 'leave_one_out', '-o', outputfile]
+        print >>sys.stderr, "Leave-one-out: " + ' '.join(cmd).encode('utf-8')
+        r = subprocess.call(cmd, stdout=sys.stderr)
+        if r != 0:
+            raise Exception("Timbl failed on leave-one-out for " + fileprefix.encode('utf-8') + ", command was: " + ' '.join(cmd).encode('utf-8'))
+        results = []
+        f = codecs.open(outputfile,'r','utf-8')
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line:
+                fields = line.split('\t')
+                results.append( (fields[-1], fields[-2]) ) #the instance, gold label included, followed by the class label assigned
+        f.close()
+        os.unlink(outputfile)
+        return results
+
+    lines = []
+    f = codecs.open(trainfile,'r','utf-8')
+    for line in f:
+        line = line.rstrip('\r\n')
+        if line:
+            lines.append(line)
+    f.close()
+    results = [None] * len(lines)
+    for fold in range(folds):
+        test = range(fold, len(lines), folds)
+        if not test:
+            continue
+        foldprefix = fileprefix + '.fold' + str(fold) + '.' + str(os.getpid())
+        f = codecs.open(foldprefix + '.train','w','utf-8')
+        for i, line in enumerate(lines):
+            if i % folds != fold:
+                f.write(line + '\n')
+        f.close()
+        instances = [ lines[i].split('\t')[:-1] for i in test ]
+        try:
+            classifications = timblclassifybatch(foldprefix, timbloptions, instances)
+        finally:
+            os.unlink(foldprefix + '.train')
+        for i, (classlabel, distribution, distance) in zip(test, classifications):
+            results[i] = (classlabel, lines[i].split('\t')[-1])
+    return results
+
+def _makevoterinput(args):
+    """Writes the voter training data of a word expert by held-out classification of its training data (run in a worker process by CLWSD2Trainer.makevoterinput)"""
+    fileprefix, timbloptions, folds = args
+    print >>sys.stderr, "Making voter input for " + fileprefix.encode('utf-8') + '.votertrain'
+    votertrain = timblheldout(fileprefix, timbloptions, folds)
+    writevotertrain(fileprefix, votertrain)
+    return votertrain
 
 
 
@@ -652,56 +2021,533 @@ def paramsearch2timblargs(filename):
                 opts += " -k " + field[1:]
     return opts
 
-def processresult(out_best, oof_senses, id, lemma, pos, targetlang, bestsense, distribution, distance, divergencefrombestoutputthreshold):
-    bestscore = max(distribution.values())
-    bestsenses = [ sense for sense, score in sorted(distribution.items(), key=lambda x: x[1] * -1) if score >= bestscore * divergencefrombestoutputthreshold  ]
-    #fivebestsenses = [ sense for sense, score in sorted(distribution.items()[:5], key=lambda x: -1 * x[1]) ]
-    bestsenses_s = ';'.join(bestsenses)
-    #fivebestsenses_s = ';'.join(fivebestsenses)
-    if not isinstance(bestsenses_s,unicode): bestsenses_s  = unicode(bestsenses_s,'utf-8')
-    #if not isinstance(fivebestsenses_s,unicode): fivebestsenses_s  = unicode(fivebestsenses_s,'utf-8')
-    out_best.write(lemma + "." + pos + "." + targetlang + ' ' + str(id) + ' :: ' + bestsenses_s + ';\n')
-    oof_senses.append( (id, lemma, pos, targetlang, distribution, distance) )
-    #out_oof.write(lemma + "." + pos + "." + targetlang + ' ' + str(id) + ' ::: ' + fivebestsenses_s + ';\n')
-    print >>sys.stderr, "<-- Timbl output for " + lemma.encode('utf-8') + '.' + pos + " @" + str(id) + ": " + repr(distribution)
-
-
-def processresult_final(out_oof, oof_senses):
-    senses = {}
-    for id, lemma, pos, targetlang, distribution, distance in oof_senses:
-        for sense, score in distribution.items():
-            if not sense in senses:
-                senses[sense] = score
-            else:
-                senses[sense] += score
-    print >>sys.stderr,"Aggregated senses for OOF baseline: ",
-    print >>sys.stderr, sorted(senses.items(), key=lambda x: -1 * x[1])[:5]
-    oof_baseline =  [ sense for sense, score in sorted(senses.items(), key=lambda x: -1 * x[1])[:5] ]
-
-    for id, lemma, pos, targetlang, distribution, distance in oof_senses:
-        fivebestsenses = [ sense for sense, score in sorted(distribution.items(), key=lambda x: -1 * x[1])[:5] ]
-        for s in oof_baseline:
-            if len(fivebestsenses) == 5:
+def classifieroptions(fileprefix, timbloptions):
+    """Returns the Timbl options for the classifier of a word expert: the given options extended with those found by paramsearch, if any"""
+    if os.path.exists(fileprefix + '.train.paramsearch'):
+        o = paramsearch2timblargs(fileprefix + '.train.paramsearch')
+        print >>sys.stderr, "Parameter optimisation loaded: " + o
+        return timbloptions + " " + o
+    else:
+        print >>sys.stderr, "NOTICE: No parameter optimisation found!"
+        return timbloptions
+
+
+def parsetimbloutput(line):
+    """Parses a line of Timbl output (Tabbed format, with +v db+di), returns (classlabel, distribution, distance). The distribution is normalised to sum to one, as python-timbl does by default, so classifications in batch and through the python-timbl classifiers are alike. A line looks like this (fields of the instance and the gold label, the assigned label, the distribution and the distance):
+
+        bus\tN\tcoach\ttrainer\ttrainer { trainer 3.00000, coach 1.00000 }        0.070701999903882
+    """
+    line = line.rstrip('\r\n')
+    end = line.rindex('}')
+    begin = line.rindex('{', 0, end)
+    classlabel = line[:begin].rstrip().rsplit('\t',1)[-1]
+    distribution = {}
+    for entry in line[begin+1:end].strip().split(', '):
+        if entry:
+            sense, score = entry.rsplit(' ',1)
+            distribution[sense] = float(score)
+    total = sum(distribution.values())
+    if total > 0:
+        for sense in distribution:
+            distribution[sense] = distribution[sense] / total
+    distance = line[end+1:].strip()
+    return classlabel, distribution, float(distance) if distance else 0.0
+
+
+def timblclassifybatch(fileprefix, timbloptions, instances):
+    """Classifies a batch of instances (lists of features) with the classifier of a word expert in a single Timbl run, rather than one call per instance. The instance base is used if it was saved, the training data otherwise. Returns a list of (classlabel, distribution, distance) tuples, in order"""
+    if not instances:
+        return []
+    testfile = fileprefix + '.batch.' + str(os.getpid()) + '.test'
+    outputfile = testfile + '.out'
+    f = codecs.open(testfile,'w','utf-8')
+    for features in instances:
+        f.write('\t'.join( x if isinstance(x, unicode) else unicode(str(x),'utf-8') for x in features) + '\t?\n')
+    f.close()
+
+    options = timbloptions.split()
+    if os.path.exists(fileprefix + '.ibase'):
+        if os.path.exists(fileprefix + '.wgt'):
+            #weights are stored separately from the instance base, read them with the configured weighting
+            weighting = None
+            for i, option in enumerate(options[:-1]):
+                if option == '-w': weighting = options[i+1]
+            options = [ option for i, option in enumerate(options) if option != '-w' and (i == 0 or options[i-1] != '-w') ]
+            options += ['-w', fileprefix + '.wgt' + (':' + weighting if weighting else '')]
+        options += ['-i', fileprefix + '.ibase']
+    else:
+        options += ['-f', fileprefix + '.train']
+
+    cmd = TIMBL + options + ['-t', testfile, '-o', outputfile, '+v', 'db+di']
+    print >>sys.stderr, "Classifying " + str(len(instances)) + " instances: " + ' '.join(cmd).encode('utf-8')
+    r = subprocess.call(cmd, stdout=sys.stderr)
+    if r != 0:
+        raise Exception("Timbl failed on batch for " + fileprefix.encode('utf-8') + ", command was: " + ' '.join(cmd).encode('utf-8'))
+
+    results = []
+    f = codecs.open(outputfile,'r','utf-8')
+    for line in f:
+        if line.strip():
+            results.append(parsetimbloutput(line))
+    f.close()
+    os.unlink(testfile)
+    os.unlink(outputfile)
+    if len(results) != len(instances):
+        raise Exception("Timbl returned " + str(len(results)) + " results for " + str(len(instances)) + " instances")
+    return results
+
+
+class PooledClassifier(object):
+    """A classifier held by a ClassifierPool. Timbl is not thread-safe, so classifications are serialised per classifier"""
+
+    def __init__(self, fileprefix, timbloptions):
+        self.fileprefix = fileprefix
+        self.timbloptions = timbloptions
+        self.classifier = timbl.TimblClassifier(fileprefix, timbloptions)
+        self.lock = threading.Lock()
+        self.mtime = PooledClassifier.modified(fileprefix)
+
+    @staticmethod
+    def modified(fileprefix):
+        """Last modification time of the instance base, training data or optimised parameters of a classifier"""
+        return max([ os.path.getmtime(fileprefix + ext) for ext in ('.train','.ibase','.wgt','.train.paramsearch') if os.path.exists(fileprefix + ext) ] or [0])
+
+    def classify(self, features):
+        with self.lock:
+            return self.classifier.classify(features)
+
+    def classifybatch(self, instances, loaded = False):
+        """Classify a list of instances, returns a list of (classlabel, distribution, distance) tuples. Runs Timbl over the whole batch at once, unless the classifier is to be kept loaded in memory (as in the classifier server)"""
+        if loaded:
+            with self.lock:
+                return [ self.classifier.classify(features) for features in instances ]
+        else:
+            return timblclassifybatch(self.fileprefix, self.timbloptions, instances)
+
+
+class CachedClassifier(object):
+    """Memoises the classifications of a classifier (anything offering classify and classifybatch) by feature vector, as the same feature vectors come up over and over again. The cache holds at most maxsize results, the least recently used ones are evicted first"""
+
+    def __init__(self, classifier, timbloptions = "", maxsize = 100000):
+        self.classifier = classifier
+        self.timbloptions = timbloptions
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        result = self.cache.pop(key)
+        self.cache[key] = result #most recently used now
+        return result
+
+    def store(self, key, result):
+        self.cache[key] = result
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(False)
+
+    def classify(self, features):
+        key = (tuple(features), self.timbloptions)
+        try:
+            result = self.lookup(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            result = self.classifier.classify(features)
+            self.store(key, result)
+        return result
+
+    def classifybatch(self, instances):
+        """Classify a list of instances, only the distinct feature vectors not in the cache are passed on to the classifier, in one batch"""
+        results = [None] * len(instances)
+        missing = collections.OrderedDict() #key -> indices of the instances
+        for i, features in enumerate(instances):
+            key = (tuple(features), self.timbloptions)
+            if key in missing:
+                self.hits += 1
+                missing[key].append(i)
+                continue
+            try:
+                results[i] = self.lookup(key)
+                self.hits += 1
+            except KeyError:
+                self.misses += 1
+                missing[key] = [i]
+        if missing:
+            for (key, indices), result in zip(missing.items(), self.classifier.classifybatch([ list(key[0]) for key in missing ])):
+                self.store(key, result)
+                for i in indices:
+                    results[i] = result
+        return results
+
+    def report(self):
+        return "Classification cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses"
+
+
+class ClassifierPool(object):
+    """Keeps the Timbl classifiers of word experts loaded so they can be reused for many classifications, in-process or through a ClassifierServer. A classifier is identified by its file prefix and the base Timbl options, the options optimised by paramsearch are added automatically. A classifier is reloaded when it has been retrained in the meantime"""
+
+    def __init__(self):
+        self.classifiers = {}
+        self.lock = threading.Lock()
+
+    def get(self, fileprefix, timbloptions, reload = True):
+        """Returns the classifier, loading it if it is not in the pool yet (or, with reload, if it changed on disk)"""
+        key = (fileprefix, timbloptions)
+        with self.lock:
+            if not key in self.classifiers or (reload and self.classifiers[key].mtime != PooledClassifier.modified(fileprefix)):
+                options = classifieroptions(fileprefix, timbloptions)
+                print >>sys.stderr, "Instantiating classifier " + fileprefix.encode('utf-8') + " with options: " + options
+                self.classifiers[key] = PooledClassifier(fileprefix, options)
+            return self.classifiers[key]
+
+    def __len__(self):
+        return len(self.classifiers)
+
+
+class ClassifierRequestHandler(SocketServer.StreamRequestHandler):
+    """Handles a connection to the ClassifierServer, requests and responses are JSON objects, one per line"""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
                 break
-            if not s in fivebestsenses:
-                fivebestsenses.append(s)
-        fivebestsenses_s = ';'.join(fivebestsenses)
-        if not isinstance(fivebestsenses_s, unicode): fivebestsenses_s = unicode(fivebestsenses_s, 'utf-8')
+            try:
+                request = json.loads(line)
+                if request['command'] == 'open':
+                    self.server.pool.get(request['classifier'], request['options'])
+                    response = {'classifier': request['classifier']}
+                elif request['command'] == 'classify':
+                    classlabel, distribution, distance = self.server.pool.get(request['classifier'], request['options'], False).classify(request['features'])
+                    response = {'classlabel': classlabel, 'distribution': distribution, 'distance': distance}
+                elif request['command'] == 'classifybatch':
+                    response = {'results': self.server.pool.get(request['classifier'], request['options'], False).classifybatch(request['instances'], True) }
+                else:
+                    raise ValueError("Unknown command: " + request['command'])
+            except Exception, e:
+                response = {'error': repr(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class ClassifierServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Long-lived server keeping a ClassifierPool, so repeated test runs (tester, voter, experiments) need not load the instance bases again. Started with wsd2.py --classifierserver"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port, host = 'localhost'):
+        SocketServer.TCPServer.__init__(self, (host, port), ClassifierRequestHandler)
+        self.pool = ClassifierPool()
+
+
+class RemoteClassifier(object):
+    """Proxy for a classifier in the pool of a ClassifierServer"""
+
+    def __init__(self, client, fileprefix, timbloptions):
+        self.client = client
+        self.fileprefix = fileprefix
+        self.timbloptions = timbloptions
+
+    def classify(self, features):
+        response = self.client.request({'command': 'classify', 'classifier': self.fileprefix, 'options': self.timbloptions, 'features': features})
+        return response['classlabel'], response['distribution'], response['distance']
+
+    def classifybatch(self, instances):
+        response = self.client.request({'command': 'classifybatch', 'classifier': self.fileprefix, 'options': self.timbloptions, 'instances': instances})
+        return [ tuple(result) for result in response['results'] ]
+
+
+class ClassifierPoolClient(object):
+    """Client for a ClassifierServer, offers the same get() as ClassifierPool. Classifiers are identified by absolute file prefix, so client and server need to share the filesystem"""
+
+    def __init__(self, host, port):
+        self.socket = socket.create_connection((host, port))
+        self.rfile = self.socket.makefile('rb')
+        self.wfile = self.socket.makefile('wb')
+        self.lock = threading.Lock()
+
+    def request(self, request):
+        with self.lock:
+            self.wfile.write(json.dumps(request) + "\n")
+            self.wfile.flush()
+            line = self.rfile.readline()
+        if not line:
+            raise Exception("Connection to classifier server lost")
+        response = json.loads(line)
+        if 'error' in response:
+            raise Exception("Classifier server: " + response['error'])
+        return response
+
+    def get(self, fileprefix, timbloptions):
+        fileprefix = os.path.abspath(fileprefix)
+        self.request({'command': 'open', 'classifier': fileprefix, 'options': timbloptions})
+        return RemoteClassifier(self, fileprefix, timbloptions)
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.socket.close()
+
+
+class SenseOutput(object):
+    """Collects the classifier output for the instances of a lexical unit and writes the .best and .oof output files. Senses are mapped to ids and each distribution is held as arrays of sense ids and scores. Only the best senses are selected (a partial selection on a heap rather than sorting the whole distribution) and only the five best of each instance are kept. The scores per sense for the out-of-five baseline (the five best senses over all instances, filling up instances with fewer than five senses) are summed as instances are added. Both files are written at once by close()"""
+
+    def __init__(self, outputprefix, lemma, pos, targetlang, divergencefrombestoutputthreshold, k=5):
+        self.outputprefix = outputprefix #output files are outputprefix.best and outputprefix.oof
         if not isinstance(lemma, unicode): lemma = unicode(lemma, 'utf-8')
-        out_oof.write(lemma + "." + pos + "." + targetlang + ' ' + str(id) + ' ::: ' + fivebestsenses_s + ';\n')
+        self.lemma = lemma
+        self.pos = pos
+        self.targetlang = targetlang
+        self.divergencefrombestoutputthreshold = divergencefrombestoutputthreshold
+        self.k = k
+        self.senses = Vocabulary()
+        self.totals = numpy.zeros(64) #summed scores per sense id, for the out-of-five baseline
+        self.best = [] #output lines
+        self.kbest = [] #(id, sense ids of the k best senses) per instance
+
+    def sensestring(self, senseids):
+        s = ';'.join( self.senses.key(senseid) for senseid in senseids )
+        if not isinstance(s,unicode): s = unicode(s,'utf-8')
+        return s
+
+    def add(self, id, distribution):
+        """Add the distribution (sense -> score) the classifier returned for an instance"""
+        n = len(distribution)
+        senseids = numpy.fromiter( (self.senses.id(sense) for sense in distribution), int, n)
+        scores = numpy.fromiter( distribution.itervalues(), float, n)
+
+        if len(self.senses) > len(self.totals):
+            self.totals = numpy.concatenate( (self.totals, numpy.zeros(max(len(self.senses), len(self.totals)))) )
+        self.totals[senseids] += scores #ids are unique within a distribution
+
+        #all senses scoring close enough to the best score, best first (ties remain in distribution order)
+        selected = numpy.flatnonzero(scores >= scores.max() * self.divergencefrombestoutputthreshold)
+        selected = selected[numpy.argsort(-scores[selected], kind='mergesort')]
+        self.best.append(self.lemma + "." + self.pos + "." + self.targetlang + ' ' + str(id) + ' :: ' + self.sensestring(senseids[selected]) + ';\n')
+
+        self.kbest.append( (id, [ senseids[i] for i in heapq.nlargest(self.k, xrange(n), key=scores.__getitem__) ]) )
+        print >>sys.stderr, "<-- Timbl output for " + self.lemma.encode('utf-8') + '.' + self.pos + " @" + str(id) + ": " + repr(distribution)
+
+    def close(self):
+        f = codecs.open(self.outputprefix + '.best','w','utf-8')
+        f.write(u''.join(self.best))
+        f.close()
+
+        baseline = heapq.nlargest(self.k, xrange(len(self.senses)), key=self.totals.__getitem__)
+        print >>sys.stderr,"Aggregated senses for OOF baseline: ",
+        print >>sys.stderr, [ (self.senses.key(senseid), self.totals[senseid]) for senseid in baseline ]
+
+        oof = []
+        for id, kbestsenses in self.kbest:
+            for senseid in baseline:
+                if len(kbestsenses) == self.k:
+                    break
+                if not senseid in kbestsenses:
+                    kbestsenses.append(senseid)
+            oof.append(self.lemma + "." + self.pos + "." + self.targetlang + ' ' + str(id) + ' ::: ' + self.sensestring(kbestsenses) + ';\n')
+        f = codecs.open(self.outputprefix + '.oof','w','utf-8')
+        f.write(u''.join(oof))
+        f.close()
+
+
 
 
+def alignvotertrain(votertrain):
+    """Aligns the voter training data of several classifiers column-wise. Takes a list (one entry per classifier) of lists of (classlabel, gold) for the training instances of a word expert, in the same order for all classifiers. Returns a list of (features, gold), with the class label of each classifier as features"""
+    if len(set( len(data) for data in votertrain )) > 1:
+        raise Exception("Voter training data of the classifiers differs in length: " + ', '.join( str(len(data)) for data in votertrain))
+    instances = []
+    for i, row in enumerate(itertools.izip(*votertrain)):
+        gold = row[0][1]
+        if any( g != gold for _, g in row ):
+            raise Exception("Voter training data of the classifiers is not aligned, gold labels differ on instance " + str(i+1))
+        instances.append( ([ classlabel for classlabel, _ in row ], gold) )
+    return instances
+
+def alignvotertest(votertest):
+    """Aligns the output of several classifiers on the test instances of a word expert. Takes a list (one entry per classifier) of lists of (id, sense). Returns a list of (id, features), in the order of the first classifier"""
+    senses = [ dict(data) for data in votertest ]
+    instances = []
+    for id, _ in votertest[0]:
+        try:
+            instances.append( (id, [ s[id] for s in senses ]) )
+        except KeyError:
+            raise Exception("Voter test data of the classifiers is not aligned, instance " + str(id) + " is missing for some")
+    return instances
+
+def buildvoter(fileprefix, timbloptions, traininstances, paramsearch = True):
+    """Writes the training data for the voter of a word expert, optimises its parameters and saves its instance base (fileprefix.ibase and fileprefix.wgt). Returns the Timbl options to use"""
+    f = codecs.open(fileprefix + '.train','w','utf-8')
+    for features, gold in traininstances:
+        f.write('\t'.join(features + [gold]) + '\n')
+    f.close()
+    if paramsearch:
+        os.system("paramsearch ib1 " + fileprefix + ".train > " + fileprefix + ".train.paramsearch")
+    options = classifieroptions(fileprefix, timbloptions)
+    cmd = TIMBL + options.split() + ['-f', fileprefix + '.train', '-I', fileprefix + '.ibase', '-W', fileprefix + '.wgt']
+    r = subprocess.call(cmd, stdout=sys.stderr)
+    if r != 0:
+        raise Exception("Timbl failed building voter " + fileprefix.encode('utf-8') + ", command was: " + ' '.join(cmd).encode('utf-8'))
+    return options
+
+def _runvoter(args):
+    """Builds the voter of a word expert and, if test instances are passed, classifies them in one batch (run in a worker process by Voter.run)"""
+    fileprefix, timbloptions, traininstances, testinstances, paramsearch = args
+    options = buildvoter(fileprefix, timbloptions, traininstances, paramsearch)
+    if testinstances is None:
+        return None
+    classifier = CachedClassifier(PooledClassifier(fileprefix, options), options)
+    results = classifier.classifybatch([ features for _, features in testinstances ])
+    print >>sys.stderr, classifier.report()
+    return results
+
+
+class Voter(object):
+    """Second-stage classifiers (voters) that decide between the output of several classifiers, such as those of different configurations. For each word expert, a voter is trained on the class labels the classifiers assigned to the training instances (the .votertrain data, from CLWSD2Trainer.makevoterinput). It is then tested on the senses they assigned to the test instances (the .votertest data, from CLWSD2Tester with the voter enabled).
+
+    The output of the classifiers can be added in memory (addtrain/addtest) or loaded from their output directories (load). run() builds the instance bases of all voters in a pool of worker processes and classifies the test instances of each word expert in one batch"""
+
+    def __init__(self, outputdir, targetlang, timbloptions, divergencefrombestoutputthreshold = 0.9, workers = 1, paramsearch = True, classifierpool = None):
+        self.outputdir = outputdir
+        self.targetlang = targetlang
+        self.timbloptions = timbloptions
+        self.divergencefrombestoutputthreshold = divergencefrombestoutputthreshold
+        self.workers = workers
+        self.paramsearch = paramsearch
+        self.classifierpool = classifierpool #classify through this pool (in this process) rather than in the workers
+        self.classifiernames = []
+        self.votertrain = {} #(lemma,pos) -> classifiername -> [(classlabel, gold)]
+        self.votertest = {} #(lemma,pos) -> classifiername -> [(id, sense)]
+        self.tested = []
+
+    def addclassifier(self, classifiername):
+        if not classifiername in self.classifiernames:
+            self.classifiernames.append(classifiername)
+
+    def addtrain(self, classifiername, lemma, pos, votertrain):
+        """Add the class labels a classifier assigned to the training instances of a word expert, a list of (classlabel, gold)"""
+        self.addclassifier(classifiername)
+        if not (lemma,pos) in self.votertrain: self.votertrain[(lemma,pos)] = {}
+        self.votertrain[(lemma,pos)][classifiername] = votertrain
+
+    def addtest(self, classifiername, lemma, pos, votertest):
+        """Add the senses a classifier assigned to the test instances of a word expert, a list of (id, sense). Ids are compared as unicode strings, so output read from files and output passed in memory align"""
+        self.addclassifier(classifiername)
+        if not (lemma,pos) in self.votertest: self.votertest[(lemma,pos)] = {}
+        self.votertest[(lemma,pos)][classifiername] = [ (unicode(id), sense) for id, sense in votertest ]
+
+    @staticmethod
+    def classifiername(classifierdir):
+        return os.path.basename(os.path.normpath(classifierdir))
+
+    def loadtrain(self, classifierdir, lemma, pos):
+        """Load the .votertrain file of a word expert from the output directory of a classifier, named after the directory"""
+        filename = classifierdir + '/' + lemma + '.' + pos + '.' + self.targetlang + '.votertrain'
+        if not os.path.exists(filename):
+            raise Exception("No votertrain found for " + lemma.encode('utf-8') + " in " + classifierdir)
+        votertrain = []
+        f = codecs.open(filename,'r','utf-8')
+        for line in f:
+            fields = line.strip().split('\t')
+            votertrain.append( (fields[0], fields[1]) ) #(classlabel, gold)
+        f.close()
+        self.addtrain(Voter.classifiername(classifierdir), lemma, pos, votertrain)
+
+    def loadtest(self, classifierdir, lemma, pos):
+        """Load the .votertest file of a word expert from the output directory of a classifier, named after the directory"""
+        filename = classifierdir + '/' + lemma + '.' + pos + '.votertest'
+        if not os.path.exists(filename):
+            raise Exception("No votertest found for " + lemma.encode('utf-8') + " in " + classifierdir)
+        votertest = []
+        f = codecs.open(filename,'r','utf-8')
+        for line in f:
+            fields = line.strip().split('\t')
+            votertest.append( (fields[0], fields[2]) ) #(id, sense), the focus word is not needed
+        f.close()
+        self.addtest(Voter.classifiername(classifierdir), lemma, pos, votertest)
+
+    def load(self, classifierdir, lemmas):
+        """Load the .votertrain and .votertest files of the given lemmas (a list of (lemma,pos)) from the output directory of a classifier"""
+        for lemma, pos in lemmas:
+            self.loadtrain(classifierdir, lemma, pos)
+            self.loadtest(classifierdir, lemma, pos)
 
+    def fileprefix(self, lemma, pos):
+        return self.outputdir + '/' + lemma + '.' + pos + '.' + self.targetlang
+
+    def run(self):
+        """Build all voters and classify the test instances, writes the .best and .oof output for each word expert with test data. Returns the list of (lemma,pos) tested"""
+        tasks = []
+        for lemma, pos in sorted(self.votertrain):
+            if len(self.votertrain[(lemma,pos)]) != len(self.classifiernames):
+                raise Exception("Voter training data for " + lemma.encode('utf-8') + " is missing for some classifiers")
+            traininstances = alignvotertrain([ self.votertrain[(lemma,pos)][name] for name in self.classifiernames ])
+            if (lemma,pos) in self.votertest:
+                if len(self.votertest[(lemma,pos)]) != len(self.classifiernames):
+                    raise Exception("Voter test data for " + lemma.encode('utf-8') + " is missing for some classifiers")
+                testinstances = alignvotertest([ self.votertest[(lemma,pos)][name] for name in self.classifiernames ])
+            else:
+                testinstances = None
+            tasks.append( ((lemma, pos), (self.fileprefix(lemma,pos), self.timbloptions, traininstances, None if self.classifierpool else testinstances, self.paramsearch), testinstances) )
+
+        print >>sys.stderr, "Building " + str(len(tasks)) + " voters"
+        if self.workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(self.workers, len(tasks)))
+            try:
+                results = pool.map(_runvoter, [ args for _, args, _ in tasks ])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ _runvoter(args) for _, args, _ in tasks ]
+
+        self.tested = []
+        for ((lemma, pos), args, testinstances), classifications in zip(tasks, results):
+            if testinstances is None:
+                continue
+            print >>sys.stderr, "Testing voter for " + lemma.encode('utf-8')
+            if self.classifierpool:
+                classifier = CachedClassifier(self.classifierpool.get(self.fileprefix(lemma,pos), self.timbloptions), self.timbloptions)
+                classifications = classifier.classifybatch([ features for _, features in testinstances ])
+                print >>sys.stderr, classifier.report()
+            output = SenseOutput(self.outputdir + '/' + lemma + '.' + pos, lemma, pos, self.targetlang, self.divergencefrombestoutputthreshold)
+            for (id, features), (sense, distribution, distance) in zip(testinstances, classifications):
+                print >>sys.stderr, "--> Voter input for " + str(id) + ": " + repr(features)
+                output.add(id, distribution)
+            output.close()
+            self.tested.append( (lemma,pos) )
+        return self.tested
+
+    def score(self, testdir, resultsstore = None, conf = None):
+        """Score the output of the voters against the gold standard in the test directory and write the results file. Scores are also recorded in the given results store (filename), if any, under the given configuration name (by default the name of the output directory)"""
+        scorer = Scorer()
+        for lemma, pos in self.tested:
+            goldfile = testdir + '/' + self.targetlang + '/' + lemma + '_gold.txt'
+            for scoretype in ('best','oof'):
+                try:
+                    scorer.score(self.outputdir + '/' + lemma + '.' + pos + '.' + scoretype, goldfile, scoretype)
+                except Exception as e:
+                    print >>sys.stderr,"ERROR: SCORER FAILED ON " + (self.outputdir + '/' + lemma + '.' + pos + '.' + scoretype).encode('utf-8') + ": " + str(e)
+        if resultsstore:
+            resultsstore = ResultsStore(resultsstore)
+            scorereport(self.outputdir, scorer, resultsstore, self.targetlang, conf or os.path.basename(os.path.normpath(self.outputdir)))
+            resultsstore.close()
+        else:
+            scorereport(self.outputdir, scorer)
 
 
 class CLWSD2Tester(object):
-    def __init__(self, testdir, outputdir, targetlang,targetwordsfile, sourcetagger, timbloptions, contextsize, DOPOS, DOLEMMAS, bagofwords, DOVOTER, divergencefrombestoutputthreshold =1, variableconfiguration=None, constrainsenses= False, DOSCORE=True):
+    def __init__(self, testdir, outputdir, targetlang,targetwordsfile, sourcetagger, timbloptions, contextsize, DOPOS, DOLEMMAS, bagofwords, DOVOTER, divergencefrombestoutputthreshold =1, variableconfiguration=None, constrainsenses= False, DOSCORE=True, cachedir=None, stream=False, workers=1, bagstore=None, classifierpool=None, sourcetaggerspec=None, resultsstore=None):
         self.sourcetagger = sourcetagger
+        self.resultsstore = resultsstore
+        self.sourcetaggerspec = sourcetaggerspec
 
 
         print >>sys.stderr, "Loading Target Words " + targetwordsfile
         self.targetwords = loadtargetwords(targetwordsfile)
         self.classifiers = {}
+        self.votertest = {} #(lemma,pos) -> [(id, sense)], filled by run() if DOVOTER, for Voter.addtest
 
         self.targetlang = targetlang
 
@@ -721,43 +2567,52 @@ class CLWSD2Tester(object):
                 testfiles.append(testdir+"/" + lemma + '.data')
             else:
                 print >>sys.stderr, "WARNING: No testfile found for " + lemma + " (tried " + testdir+"/" + lemma + '.data)'
-        self.testset = TestSet(testfiles)
+        if stream:
+            self.testset = StreamingTestSet(testfiles)
+        else:
+            self.testset = TestSet(testfiles, cachedir, workers)
 
         self.divergencefrombestoutputthreshold = divergencefrombestoutputthreshold
 
         self.timbloptions = timbloptions
+        if classifierpool:
+            self.classifierpool = classifierpool
+        else:
+            self.classifierpool = ClassifierPool()
         self.bagofwords = bagofwords
         self.bags = {}
         self.variableconfiguration = variableconfiguration
         if self.bagofwords or self.variableconfiguration:
-            #load bags
-            for bagfile in glob.glob(outputdir + "/*.bag"):
-                print >>sys.stderr, "Loading bag " + bagfile
-                focuslemma,focuspos,_ ,_= os.path.basename(bagfile).split(".")
-                focuslemma = unicode(focuslemma,'utf-8')
-                self.bags[(focuslemma,focuspos)] = []
-                f = codecs.open(bagfile,'r','utf-8')
-                for line in f:
-                    fields = line.split("\t")
-                    if not (fields[0],fields[1]) in self.bags[(focuslemma,focuspos)]:
-                        self.bags[(focuslemma,focuspos)].append((fields[0],fields[1]))
-                f.close()
+            #bags are loaded lazily from the bag store, or from the .bag files of older training runs
+            if not bagstore:
+                if os.path.exists(outputdir + '/bags.sqlite'):
+                    bagstore = outputdir + '/bags.sqlite'
+                elif self.bagofwords and not glob.glob(outputdir + '/*.bag'):
+                    raise Exception("No bags of words found in " + outputdir + " (neither bags.sqlite nor .bag files), train with bag-of-words first or pass --bagstore")
+                else:
+                    bagstore = outputdir
+            elif not os.path.exists(bagstore):
+                raise Exception("Bag store does not exist: " + bagstore)
+            print >>sys.stderr, "Using bags from " + bagstore
+            self.bags = BagStore(bagstore, targetlang)
 
 
 
     def run(self):
         global WSDDIR
 
-        if self.variableconfiguration:
-            for lemma,pos in self.testset.lemmas():
-                if not lemma in self.variableconfiguration:
-                    raise Exception("No variable configuration passed for " + lemma)
+        if not isinstance(self.testset, StreamingTestSet):
+            #tag all instances at once, rather than one tagger call per instance
+            self.testset.tag(self.sourcetagger, self.sourcetaggerspec)
 
         print >>sys.stderr, "Extracting features from testset"
-        for lemma,pos in self.testset.lemmas():
+        for lemma,pos, instances in self.testset.iterlexelts():
             print >>sys.stderr, "Processing " + lemma.encode('utf-8')
+            taggedinstances = self.testset.taggedinstances(lemma, pos, instances, self.sourcetagger)
 
             if self.variableconfiguration:
+                if not lemma in self.variableconfiguration:
+                    raise Exception("No variable configuration passed for " + lemma)
                 print >>sys.stderr, "Loading variable configuration for " + lemma.encode('utf-8')
                 self.contextsize, self.DOPOS, self.DOLEMMAS, self.bagofwords = self.variableconfiguration[lemma]
                 print >>sys.stderr, "contextsize: ", self.contextsize
@@ -765,28 +2620,16 @@ class CLWSD2Tester(object):
                 print >>sys.stderr, "lemma: ", self.DOLEMMAS
                 print >>sys.stderr, "bag: ", self.bagofwords
 
-            timbloptions = self.timbloptions
-            if os.path.exists(self.outputdir + '/' + lemma +'.' + pos + '.' + self.targetlang + '.train.paramsearch'):
-                o = paramsearch2timblargs(self.outputdir + '/' + lemma +'.' + pos + '.' + self.targetlang + '.train.paramsearch')
-                timbloptions += " " + o
-                print >>sys.stderr, "Parameter optimisation loaded: " + o
-            else:
-                print >>sys.stderr, "NOTICE: No parameter optimisation found!"
-
-            print >>sys.stderr, "Instantiating classifier " + lemma.encode('utf-8') + " with options: " + timbloptions
-            classifier = timbl.TimblClassifier(self.outputdir + '/' + lemma +'.' + pos + '.' + self.targetlang, timbloptions)
-            out_best = codecs.open(self.outputdir + '/' + lemma + '.' + pos + '.best','w','utf-8')
-            out_oof = codecs.open(self.outputdir + '/' + lemma + '.' + pos + '.oof','w','utf-8')
-            oof_senses = []
+            classifier = CachedClassifier(self.classifierpool.get(self.outputdir + '/' + lemma +'.' + pos + '.' + self.targetlang, self.timbloptions), self.timbloptions)
+            output = SenseOutput(self.outputdir + '/' + lemma + '.' + pos, lemma, pos, self.targetlang, self.divergencefrombestoutputthreshold)
             if self.DOVOTER:
                 out_votertest =  codecs.open(self.outputdir + '/' + lemma + '.' + pos + '.votertest','w','utf-8')
+                self.votertest[(lemma,pos)] = []
 
-            for instancenum, (id, ( leftcontext,head,rightcontext)) in enumerate(self.testset.instances(lemma,pos)):
+            batch = [] #(id, focusword, features) per instance
+            for instancenum, ((id, ( leftcontext,head,rightcontext)), (sourcewords, sourcepostags, sourcelemmas)) in enumerate(zip(instances, taggedinstances)):
                 print >>sys.stderr, "--> " + lemma.encode('utf-8') + '.' + pos + " @" + str(instancenum+1) + ": " + leftcontext.encode('utf-8') + " *" + head.encode('utf-8') + "* " + rightcontext.encode('utf-8')
 
-                sourcewords_pretagged = leftcontext + ' ' + head + ' ' + rightcontext
-
-                sourcewords, sourcepostags, sourcelemmas = sourcetagger.process(sourcewords_pretagged.split(' '))
                 sourcepostags = [ x[0].lower() if x else "?" for x in sourcepostags ]
 
 
@@ -831,35 +2674,29 @@ class CLWSD2Tester(object):
 
                 if self.bagofwords:
                     if (sourcelemma,sourcepos) in self.bags:
-                        for keylemma,keypos in self.bags[(sourcelemma,sourcepos)]:
-                            found = False
-                            for j, w in enumerate(sourcewords):
-                                if j != focusindex:
-                                    if sourcelemmas[j] == keylemma and sourcepostags[j] == keypos:
-                                        found = True
-                                        break
-
-                            #Write bag-of-word features
-                            if found:
-                                features.append("1")
-                            else:
-                                features.append("0")
+                        #Write bag-of-word features
+                        features += self.bags[(sourcelemma,sourcepos)].encode(zip(sourcelemmas, sourcepostags), focusindex)
                     else:
                         print >>sys.stderr, 'NOTICE: ' + sourcelemma.encode('utf-8')+ ' ' + sourcepos + ' has no bag'
 
 
                 print >>sys.stderr, " -- Classifier features: " + repr(features)
-                bestsense, distribution, distance = classifier.classify(features)
+                batch.append( (id, sourcewords[focusindex], features) )
+
+            #classify all instances of the lexical unit at once
+            results = classifier.classifybatch([ features for _, _, features in batch ])
+            print >>sys.stderr, classifier.report()
+
+            for (id, focusword, _), (bestsense, distribution, distance) in zip(batch, results):
                 if not isinstance(bestsense,unicode): bestsense = unicode(bestsense,'utf-8')
 
-                processresult(out_best, oof_senses, id, lemma, pos, targetlang, bestsense, distribution, distance, self.divergencefrombestoutputthreshold)
+                output.add(id, distribution)
 
                 if self.DOVOTER:
-                    out_votertest.write(str(id) + "\t" + sourcewords[focusindex]+ "\t"+ bestsense + "\n")
+                    out_votertest.write(str(id) + "\t" + focusword + "\t"+ bestsense + "\n")
+                    self.votertest[(lemma,pos)].append( (unicode(id), bestsense) )
 
-            out_best.close()
-            processresult_final(out_oof, oof_senses)
-            out_oof.close()
+            output.close()
             if DOVOTER:
                 out_votertest.close()
 
@@ -868,73 +2705,28 @@ class CLWSD2Tester(object):
 
 
     def score(self):
-        global WSDDIR
         print >>sys.stderr, "Scoring"
+        scorer = Scorer()
         for lemma,pos in self.testset.lemmas():
             print >>sys.stderr, "Scoring " + lemma.encode('utf-8')
-            cmd = 'perl ' + WSDDIR + '/ScorerTask3.pl ' + self.outputdir + '/' + lemma + '.' + pos + '.best' + ' ' + self.testdir + '/' + self.targetlang + '/' + lemma + '_gold.txt 2> ' + outputdir + '/' + lemma + '.' + pos + '.best.scorerr'
-            r = os.system(cmd)
-            if r != 0:
-                print >>sys.stderr,"ERROR: SCORER FAILED! INSPECT " + outputdir + '/' + lemma + '.' + pos + '.best.scorerr -- Command was: ' + cmd
-            cmd = 'perl ' + WSDDIR + '/ScorerTask3.pl ' + self.outputdir + '/' + lemma + '.' + pos + '.oof' + ' ' + self.testdir + '/' + self.targetlang + '/' + lemma + '_gold.txt -t oof 2> ' + outputdir + '/' + lemma + '.' + pos + '.oof.scorerr'
-            r = os.system(cmd)
-            if r != 0:
-                print >>sys.stderr,"ERROR: SCORER FAILED! INSPECT " + outputdir + '/' + lemma + '.' + pos + '.oof.scorerr -- Command was: ' + cmd
-
-        scorereport(self.outputdir)
-
-def scorereport(outputdir):
-
-    f = codecs.open(outputdir + '/results','w','utf-8')
-    f.write('BEST RESULTS\n-------------\n')
-
-    rlist = []
-    plist = []
-
-    for filename in glob.glob(outputdir + '/*.best.results'):
-        lemma,pos = os.path.basename(filename).split('.')[:2]
-        f_in = open(filename,'r')
-        for line in f_in:
-            if line[:12] == "precision = ":
-                p = float(line[12:line.find(',')] )
-                r =  float(line[line.find('recall = ') + 9:] )
-                plist.append( p )
-                rlist.append( r )
-                f.write(lemma + ":\t" + str(p) + "\t" + str(r) + "\n")
-                break
-        f_in.close()
-
-    f.write("AVERAGE:\t" + str(sum(plist) / float(len(plist))) + "\t" + str(sum(rlist) / float(len(rlist)))+"\n")
-
-
-    rlist = []
-    plist = []
-
-    f.write('\n\nOUT OF FIVE RESULTS\n-------------\n')
-    for filename in glob.glob(outputdir + '/*.oof.results'):
-        lemma,pos = os.path.basename(filename).split('.')[:2]
-        f_in = open(filename,'r')
-        for line in f_in:
-            if line[:12] == "precision = ":
-                p = float(line[12:line.find(',')] )
-                r =  float(line[line.find('recall = ') + 9:] )
-                plist.append( p )
-                rlist.append( r )
-                f.write(lemma + ":\t" + str(p) + "\t" + str(r) + "\n")
-                break
-        f_in.close()
-
-    f.write("AVERAGE:\t" + str(sum(plist) / float(len(plist))) + "\t" + str(sum(rlist) / float(len(rlist)))+"\n")
-
-
-
-    f.close()
-    os.system("cat " + outputdir + '/results')
+            goldfile = self.testdir + '/' + self.targetlang + '/' + lemma + '_gold.txt'
+            for scoretype in ('best','oof'):
+                try:
+                    scorer.score(self.outputdir + '/' + lemma + '.' + pos + '.' + scoretype, goldfile, scoretype)
+                except Exception as e:
+                    print >>sys.stderr,"ERROR: SCORER FAILED ON " + (self.outputdir + '/' + lemma + '.' + pos + '.' + scoretype).encode('utf-8') + ": " + str(e)
+
+        if self.resultsstore:
+            resultsstore = ResultsStore(self.resultsstore)
+            scorereport(self.outputdir, scorer, resultsstore, self.targetlang, os.path.basename(os.path.normpath(self.outputdir)))
+            resultsstore.close()
+        else:
+            scorereport(self.outputdir, scorer)
 
 
 if __name__ == "__main__":
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "a:s:t:c:lpbB:Ro:w:L:O:m:T:VM:I:v:SX", ["train","test", "nogen", "scoreonly","Stagger=","Ttagger=","votertrainonly"])
+        opts, args = getopt.getopt(sys.argv[1:], "a:s:t:c:lpbB:Ro:w:L:O:m:T:VM:I:v:SX", ["train","test", "nogen", "scoreonly","Stagger=","Ttagger=","votertrainonly","cachedir=","stream","workers=","singlepass","buffersize=","tagcache","fullphrasetable","alignments=","bagstore=","classifierserver=","classifierpool=","taggerconnections=","resultsstore=","voterheldout=","voterwith="])
     except getopt.GetoptError, err:
          # print help information and exit:
         print str(err)
@@ -950,11 +2742,22 @@ if __name__ == "__main__":
     DOPOS = False
     DOVOTER = False
     VOTERTRAINONLY = False
+    voterfolds = None
+    voterdirs = []
     sourcetagger = None
     targettagger = None
+    sourcetaggerspec = targettaggerspec = ""
+    taggerconnections = 1
+    TAGCACHE = False
+    FULLPHRASETABLE = False
     outputdir = "."
     testdir = WSDDIR + "/data/trial"
     DOSCORE = True
+    cachedir = WSDDIR + "/cache"
+    STREAM = False
+    workers = 1
+    singlepass = False
+    maxbuffer = 1000000
     targetlang = ""
     exemplarweights = False
     timbloptions = "-a 0 -k 1"
@@ -969,6 +2772,11 @@ if __name__ == "__main__":
     gizafile_t2s = ""
     gizamodel_s2t = None
     gizamodel_t2s = None
+    alignmentfile = ""
+    bagstore = ""
+    classifierserverport = 0
+    classifierpool = None
+    resultsstore = None
 
     bagofwords = False
     compute_bow_params = False
@@ -986,6 +2794,15 @@ if __name__ == "__main__":
         elif o == "--scoreonly":
             SCOREONLY = True
             TRAINGEN = False
+        elif o == '--voterwith':
+            voterdirs = a.split(' ')
+        elif o == '--voterheldout':
+            if a == 'loo':
+                voterfolds = 0
+            else:
+                voterfolds = int(a)
+                if voterfolds < 2:
+                    raise Exception("--voterheldout takes loo or a number of folds of at least 2")
         elif o == '--votertrainonly':
             VOTERTRAINONLY = True
             TRAINGEN = False
@@ -1011,9 +2828,26 @@ if __name__ == "__main__":
         elif o == '-l':
             DOLEMMAS = True
         elif o == "--Stagger":
-            sourcetagger = Tagger(*a.split(':'))
+            sourcetaggerspec = a
         elif o == "--Ttagger":
-            targettagger = Tagger(*a.split(':'))
+            targettaggerspec = a
+        elif o == "--taggerconnections":
+            taggerconnections = int(a)
+        elif o == "--tagcache":
+            TAGCACHE = True
+        elif o == "--fullphrasetable":
+            FULLPHRASETABLE = True
+        elif o == "--alignments":
+            alignmentfile = a
+        elif o == "--bagstore":
+            bagstore = a
+        elif o == "--resultsstore":
+            resultsstore = a
+        elif o == "--classifierserver":
+            classifierserverport = int(a)
+        elif o == "--classifierpool":
+            host, port = a.rsplit(':',1)
+            classifierpool = ClassifierPoolClient(host, int(port))
         elif o == '-o':
             outputdir = a
         elif o == '-w':
@@ -1060,34 +2894,80 @@ if __name__ == "__main__":
             constrainsenses = True
         elif o == '-X':
             DOSCORE = False
+        elif o == '--cachedir':
+            cachedir = a
+        elif o == '--stream':
+            STREAM = True
+        elif o == '--workers':
+            workers = int(a)
+        elif o == '--singlepass':
+            singlepass = True
+        elif o == '--buffersize':
+            maxbuffer = int(a)
         else:
             print >>sys.stderr,"Unknown option: ", o
             sys.exit(2)
 
 
+    if sourcetaggerspec:
+        sourcetagger = maketagger(sourcetaggerspec, taggerconnections)
+    if targettaggerspec:
+        targettagger = maketagger(targettaggerspec, taggerconnections)
+
+    if classifierserverport:
+        print >>sys.stderr, "Starting classifier server on port " + str(classifierserverport)
+        ClassifierServer(classifierserverport).serve_forever()
+        sys.exit(0)
+
     if not targetlang:
         print >>sys.stderr, "ERROR: No target language specified"
         sys.exit(2)
     elif not SCOREONLY and not sourcetagger and not VOTERTRAINONLY:
         print >>sys.stderr, "ERROR: No source tagger specified"
         sys.exit(2)
+    elif SCOREONLY and STREAM:
+        #a streaming test set only learns the order of its lemmas while it is being tested, there is nothing to score against
+        print >>sys.stderr, "ERROR: --scoreonly can not be combined with --stream, score without --stream"
+        sys.exit(2)
 
     if TRAIN:
 
-        if not phrasetablefile and not (gizafile_s2t and gizafile_t2s) and not VOTERTRAINONLY and TRAINGEN:
+        if not phrasetablefile and not (gizafile_s2t and gizafile_t2s) and not alignmentfile and not VOTERTRAINONLY and TRAINGEN:
             print >>sys.stderr, "ERROR: No phrasetable or giza models specified"
             sys.exit(2)
 
         elif not targettagger and not VOTERTRAINONLY and TRAINGEN:
             print >>sys.stderr, "WARNING: No target tagger specified"
 
-        if TRAINGEN and phrasetablefile:
+        if TRAINGEN and TAGCACHE:
+            trainsourcetagger = TaggedCorpus.load(sourcefile, sourcetagger, sourcetaggerspec)
+            if targettagger:
+                traintargettagger = TaggedCorpus.load(targetfile, targettagger, targettaggerspec)
+            else:
+                traintargettagger = None
+        else:
+            trainsourcetagger = sourcetagger
+            traintargettagger = targettagger
+
+        if TRAINGEN and phrasetablefile and FULLPHRASETABLE:
             print >>sys.stderr, "Loading phrasetable..."
             phrasetable = PhraseTable(phrasetablefile, False, False, "|||", 5, 4, 1)
+        elif TRAINGEN and phrasetablefile:
+            targetwords = loadtargetwords(targetwordsfile)
+            if isinstance(trainsourcetagger, TaggedCorpus):
+                phrasetable = FilteredPhraseTable(phrasetablefile, targetwords, trainsourcetagger.wordforms(targetwords))
+            else:
+                print >>sys.stderr, "NOTICE: Filtering the phrasetable by the stems of the target words only, irregular inflections are left out (use --tagcache to keep all word forms tagged with a target word, or --fullphrasetable)"
+                phrasetable = FilteredPhraseTable(phrasetablefile, targetwords)
         else:
             phrasetable = None
 
-        if TRAINGEN and gizafile_s2t and gizafile_t2s:
+        alignments = None
+        if TRAINGEN and alignmentfile:
+            alignments = AlignmentStore.load(alignmentfile, gizafile_s2t, gizafile_t2s, workers)
+            gizamodel_s2t = None
+            gizamodel_t2s = None
+        elif TRAINGEN and gizafile_s2t and gizafile_t2s:
             print >>sys.stderr, "Loading GIZA model s->t..."
             gizamodel_s2t = GizaModel(gizafile_s2t)
             print >>sys.stderr, "Loading GIZA model t->s.."
@@ -1096,7 +2976,7 @@ if __name__ == "__main__":
             gizamodel_s2t = None
             gizamodel_t2s = None
 
-        trainer = CLWSD2Trainer(outputdir, targetlang, phrasetable, gizamodel_s2t, gizamodel_t2s, sourcefile, targetfile, targetwordsfile, sourcetagger, targettagger, contextsize, DOPOS, DOLEMMAS, DOVOTER, exemplarweights, timbloptions, bagofwords,compute_bow_params, bow_absolute_threshold, bow_prob_threshold, bow_filter_threshold, maxdivergencefrombest)
+        trainer = CLWSD2Trainer(outputdir, targetlang, phrasetable, gizamodel_s2t, gizamodel_t2s, sourcefile, targetfile, targetwordsfile, trainsourcetagger, traintargettagger, contextsize, DOPOS, DOLEMMAS, DOVOTER, exemplarweights, timbloptions, bagofwords,compute_bow_params, bow_absolute_threshold, bow_prob_threshold, bow_filter_threshold, maxdivergencefrombest, singlepass, maxbuffer, workers, (gizafile_s2t, gizafile_t2s), alignments, voterfolds)
         if VOTERTRAINONLY:
             trainer.loadclassifiers()
             trainer.makevoterinput()
@@ -1107,8 +2987,26 @@ if __name__ == "__main__":
             trainer.run()
 
     if TEST or SCOREONLY:
-        tester = CLWSD2Tester(testdir, outputdir, targetlang,targetwordsfile, sourcetagger, timbloptions, contextsize, DOPOS, DOLEMMAS, bagofwords, DOVOTER, divergencefrombestoutputthreshold, variableconfiguration, constrainsenses, DOSCORE)
+        tester = CLWSD2Tester(testdir, outputdir, targetlang,targetwordsfile, sourcetagger, timbloptions, contextsize, DOPOS, DOLEMMAS, bagofwords, DOVOTER, divergencefrombestoutputthreshold, variableconfiguration, constrainsenses, DOSCORE, cachedir, STREAM, workers, bagstore, classifierpool, sourcetaggerspec, resultsstore)
         if TEST:
             tester.run()
         elif SCOREONLY and DOSCORE:
             tester.score()
+
+        if TEST and DOVOTER and voterdirs:
+            #voter over this classifier (in memory) and those of the other output directories
+            if not os.path.isdir(outputdir + '/voter'):
+                os.mkdir(outputdir + '/voter')
+            voter = Voter(outputdir + '/voter', targetlang, timbloptions, divergencefrombestoutputthreshold, workers, True, classifierpool)
+            classifiername = Voter.classifiername(outputdir)
+            for lemma, pos in sorted(tester.votertest):
+                if TRAIN and (lemma,pos) in trainer.votertrain:
+                    voter.addtrain(classifiername, lemma, pos, trainer.votertrain[(lemma,pos)])
+                else:
+                    voter.loadtrain(outputdir, lemma, pos)
+                voter.addtest(classifiername, lemma, pos, tester.votertest[(lemma,pos)])
+            for voterdir in voterdirs:
+                voter.load(voterdir, sorted(tester.votertest))
+            voter.run()
+            if DOSCORE:
+                voter.score(testdir, resultsstore, classifiername + '.voter')
@@ -0,0 +1,356 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+#-------------------------------------------------------------------------------------
+# WSD2: Cross-Lingual Word Sense Disambiguation 2
+#   for SemEval 2013 - Task 10
+
+# by Maarten van Gompel <proycon@anaproy.nl>
+#   http://github.com/proycon/wsd2
+#   Centre for Language Studies
+#   Radboud University Nijmegen
+
+# Scoring of the system output and the store of the results of all experiments.
+# This module depends on the Python standard library only, so results can be
+# scored, collected and reported (collectresults.py) without Timbl, pynlpl or
+# NumPy installed. wsd2.py makes everything available from here as well.
+
+# Licensed under GNU Public License v3
+
+#-------------------------------------------------------------------------------------
+
+import sys
+import os
+import codecs
+import glob
+import sqlite3
+import collections
+import re
+
+
+class GoldStandard(object):
+    """Gold standard of a lexical unit (a [lemma]_gold.txt file), read exactly as ScorerTask3.pl reads it. Per item id it holds the human responses (translation -> count), the number of responses not to be counted (count 0) and the mode (the single most frequent response), if any. Counters the Perl scorer never touched remain None, as they print differently"""
+
+    ITEM = re.compile(r'([\w.]+) (\S+) \:\: (.*)')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.responses = {}
+        self.notcount = {}
+        self.modes = {}
+        self.totitems = None
+        self.totmodes = None
+        f = open(filename,'rb')
+        for line in f:
+            line = re.sub(r'\s+$', '', line).lower()
+            match = GoldStandard.ITEM.search(line)
+            if not match:
+                continue
+            wpos, id, rest = match.groups()
+            rest = re.sub(r';$', '', rest)
+            mode = modenum = ms = num = None
+            responses = [ response for response in perlsplit(';', rest) if 'pn' not in response ]
+            if responses:
+                match = re.search(r'.+ (\d+)', responses[0])
+                if match:
+                    num = int(match.group(1))
+            if len(responses) > 1 or (num or 0) > 1:
+                if (num or 0) != 0:
+                    self.totitems = (self.totitems or 0) + 1
+                for response in responses:
+                    match = re.search(r'(.+) (\d+)', response)
+                    if match:
+                        sub = match.group(1).replace("'", "", 1)
+                        num = int(match.group(2))
+                        if num == 0:
+                            self.notcount[id] = self.notcount.get(id,0) + 1
+                        if not perltrue(mode):
+                            mode = sub
+                            modenum = num
+                            self.modes[id] = mode
+                            self.totmodes = (self.totmodes or 0) + 1
+                        elif not ms and perltrue(mode) and num == modenum:
+                            #mode found was not the most frequent
+                            if id in self.modes: del self.modes[id]
+                            self.totmodes = (self.totmodes or 0) - 1
+                            ms = True
+                        if num == 0:
+                            num = 1
+                        if not id in self.responses:
+                            self.responses[id] = collections.OrderedDict()
+                        self.responses[id][sub] = num
+            else:
+                print >>sys.stderr, "can't use: " + line
+        f.close()
+
+    def norms(self, id):
+        """Returns the number of counted human responses for an item and the responses normalised by it. Responses with hyphens also count when written with spaces"""
+        responses = self.responses.get(id, {})
+        hu = sum(responses.values()) - self.notcount.get(id,0)
+        norms = {}
+        for key, value in responses.items():
+            if hu == 0:
+                raise ZeroDivisionError("Illegal division by zero (item " + id + " in " + self.filename + ")")
+            norms[key] = value / float(hu)
+            if '-' in key:
+                norms[key.replace('-',' ')] = value / float(hu)
+        return hu, norms
+
+
+def perlsplit(separator, s):
+    """Splits a string as Perl's split does, trailing empty fields are removed"""
+    fields = s.split(separator) if s else []
+    while fields and not fields[-1]:
+        fields.pop()
+    return fields
+
+def perltrue(value):
+    return value is not None and value != "" and value != "0" and value != 0
+
+def perlstr(value):
+    return "" if value is None else str(value)
+
+def perlround(number, dp = 2):
+    """Rounds a proportion to a percentage with dp decimals, formatted as ScorerTask3.pl does"""
+    mult = 10 ** dp
+    number = number * 100
+    number = number * mult
+    result = '%.15g' % (int(number + .5) / float(mult))
+    if '.' in result:
+        result += '0' * (dp - len(result[result.index('.')+1:]))
+    else:
+        result += '.' + '0' * dp
+    return result
+
+
+class Scorer(object):
+    """Native implementation of the scorer of the task (ScorerTask3.pl, by Diana McCarthy and Els Lefever), without a Perl process per output file. Gold standards are loaded once and kept. score() writes the very same [outputfile].results file as the Perl scorer and remembers the precision and recall for scorereport()"""
+
+    BEST = re.compile(r'([\w.]+) (\S+) \:\: (.*)')
+    OOF = re.compile(r'([\w.]+) (\S+) \:\:\: (.*)')
+
+    def __init__(self):
+        self.goldstandards = {}
+        self.results = {} #results file -> (precision, recall)
+
+    def goldstandard(self, goldfile):
+        if not goldfile in self.goldstandards:
+            self.goldstandards[goldfile] = GoldStandard(goldfile)
+        return self.goldstandards[goldfile]
+
+    def score(self, ansfile, goldfile, scoretype = 'best'):
+        """Scores a system output file (best or oof) against the gold standard, writes ansfile.results and returns (precision, recall) as the percentages (strings) written there"""
+        if isinstance(ansfile, unicode): ansfile = ansfile.encode('utf-8')
+        if isinstance(goldfile, unicode): goldfile = goldfile.encode('utf-8')
+        f_out = open(ansfile + '.results','w')
+        try:
+            f_out.write("Scoring '" + scoretype + "' goldfile = " + goldfile + " sysfile = " + ansfile + "\n")
+            gold = self.goldstandard(goldfile)
+            if scoretype == 'best':
+                result = self.scorebest(gold, ansfile, f_out)
+            elif scoretype == 'oof':
+                result = self.scoreoof(gold, ansfile, f_out)
+            else:
+                raise ValueError("Unknown score type: " + scoretype)
+        finally:
+            f_out.close()
+        self.results[ansfile + '.results'] = result
+        return result
+
+    def scorebest(self, gold, ansfile, f_out):
+        itemsattempted = totmodatt = besteqmode = corr = None
+        done = set()
+        res = []
+        numguesses = None
+        f = open(ansfile,'rb')
+        for lcnt, line in enumerate(f):
+            line = re.sub(r'\s+$', '', line).lower()
+            match = Scorer.BEST.search(line)
+            if match:
+                wpos, id, answer = match.groups()
+                answer = re.sub(r';$', '', answer)
+                hu, norms = gold.norms(id)
+                if hu and not id in done: #duplicates in system file are ignored
+                    done.add(id)
+                    if re.search(r'\S', answer): #(if not, the previous answer carries over, as in the Perl scorer)
+                        res = perlsplit(';', answer)
+                        numguesses = len(res)
+                        if numguesses:
+                            itemsattempted = (itemsattempted or 0) + 1
+                    if perltrue(gold.modes.get(id)) and numguesses:
+                        totmodatt = (totmodatt or 0) + 1
+                        if gold.modes[id] == res[0]:
+                            besteqmode = (besteqmode or 0) + 1
+                    idcorr = sum( norms.get(sub,0) for sub in res )
+                    if idcorr:
+                        corr = (corr or 0) + idcorr / float(numguesses)
+            elif re.search(r'\S', line):
+                f_out.write("Error in " + ansfile + " on line " + str(lcnt+1) + "\n")
+        f.close()
+        precision = perlround(Scorer.divide(corr, itemsattempted))
+        recall = perlround(Scorer.divide(corr, gold.totitems))
+        f_out.write("Total = " + perlstr(gold.totitems) + ", attempted = " + perlstr(itemsattempted) + "\n")
+        f_out.write("precision = " + precision + ", recall = " + recall + "\n")
+        modeprecision = perlround(Scorer.divide(besteqmode, totmodatt)) #where there was a mode and system had an answer
+        moderecall = perlround(Scorer.divide(besteqmode, gold.totmodes))
+        f_out.write("Total with mode " + perlstr(gold.totmodes) + " attempted " + perlstr(totmodatt) + "\n")
+        f_out.write("Mode precision = " + modeprecision + ", Mode recall = " + moderecall + "\n")
+        return precision, recall
+
+    def scoreoof(self, gold, ansfile, f_out):
+        itemsattempted = totmodatt = foundmode = corr = None
+        dupflag = 0
+        done = set()
+        res = []
+        f = open(ansfile,'rb')
+        for lcnt, line in enumerate(f):
+            line = re.sub(r'\s+$', '', line).lower()
+            match = Scorer.OOF.search(line)
+            if match:
+                wpos, id, answer = match.groups()
+                answer = re.sub(r';$', '', answer)
+                hu, norms = gold.norms(id)
+                if hu and not id in done:
+                    done.add(id)
+                    if re.search(r'\S', answer): #(if not, the previous answer carries over, as in the Perl scorer)
+                        res = perlsplit(';', answer)
+                        if res:
+                            itemsattempted = (itemsattempted or 0) + 1
+                        if len(set(res)) < len(res):
+                            dupflag += 1
+                    res = res[:5]
+                    if perltrue(gold.modes.get(id)) and res:
+                        totmodatt = (totmodatt or 0) + 1
+                        if gold.modes[id] in res:
+                            foundmode = (foundmode or 0) + 1
+                    idcorr = sum( norms.get(sub,0) for sub in res )
+                    if idcorr:
+                        corr = (corr or 0) + idcorr
+            elif re.search(r'\S', line):
+                f_out.write("Error in " + ansfile + " on line " + str(lcnt+1) + "\n")
+        f.close()
+        if dupflag:
+            f_out.write("NB OOF file contains duplicates on " + str(dupflag) + " lines\n")
+        precision = perlround(Scorer.divide(corr, itemsattempted))
+        recall = perlround(Scorer.divide(corr, gold.totitems))
+        f_out.write("Total = " + perlstr(gold.totitems) + ", attempted = " + perlstr(itemsattempted) + "\n")
+        f_out.write("precision = " + precision + ", recall = " + recall + "\n")
+        modeprecision = perlround(Scorer.divide(foundmode, totmodatt))
+        moderecall = perlround(Scorer.divide(foundmode, gold.totmodes))
+        f_out.write("Total with mode " + perlstr(gold.totmodes) + " attempted " + perlstr(totmodatt) + "\n")
+        f_out.write("precision = " + modeprecision + ", recall = " + moderecall + "\n")
+        return precision, recall
+
+    @staticmethod
+    def divide(x, y):
+        if not y:
+            raise ZeroDivisionError("Illegal division by zero")
+        return (x or 0) / float(y)
+
+
+def readresults(filename, scorer = None):
+    """Returns the precision and recall from a .results file, taken from the scorer if it produced the file, read from the file otherwise (None, None if there are none)"""
+    if scorer and filename in scorer.results:
+        p, r = scorer.results[filename]
+        return float(p), float(r)
+    f_in = open(filename,'r')
+    for line in f_in:
+        if line[:12] == "precision = ":
+            f_in.close()
+            return float(line[12:line.find(',')] ), float(line[line.find('recall = ') + 9:] )
+    f_in.close()
+    return None, None
+
+def scorereport(outputdir, scorer = None, resultsstore = None, lang = None, conf = None):
+    """Writes the results file of an output directory. If a ResultsStore is passed, the scores are recorded there as well, under the given language and configuration"""
+
+    f = codecs.open(outputdir + '/results','w','utf-8')
+    f.write('BEST RESULTS\n-------------\n')
+
+    for scoretype in ('best','oof'):
+        if scoretype == 'oof':
+            f.write('\n\nOUT OF FIVE RESULTS\n-------------\n')
+
+        rlist = []
+        plist = []
+
+        for filename in glob.glob(outputdir + '/*.' + scoretype + '.results'):
+            lemma,pos = os.path.basename(filename).split('.')[:2]
+            p, r = readresults(filename, scorer)
+            if p is not None:
+                plist.append( p )
+                rlist.append( r )
+                f.write(lemma + ":\t" + str(p) + "\t" + str(r) + "\n")
+                if resultsstore:
+                    resultsstore.add(lang, conf, lemma.decode('utf-8'), scoretype, p, r)
+
+        f.write("AVERAGE:\t" + str(sum(plist) / float(len(plist))) + "\t" + str(sum(rlist) / float(len(rlist)))+"\n")
+        if resultsstore:
+            resultsstore.add(lang, conf, u'OVERALL', scoretype, sum(plist) / float(len(plist)), sum(rlist) / float(len(rlist)))
+
+    f.close()
+    if resultsstore:
+        resultsstore.commit()
+    os.system("cat " + outputdir + '/results')
+
+
+class ResultsStore(object):
+    """Store of the scores of all experiments: an SQLite database with the precision and recall of each lemma (and the averages, as lemma OVERALL) per language, configuration and score type (best/oof). Runs record their scores as they complete (scores of a configuration that was run before are replaced), so results need not be collected from the results files of all output directories again"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=300) #several runs may complete at the same time
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (lang TEXT, conf TEXT, lemma TEXT, scoretype TEXT, metric TEXT, score REAL, PRIMARY KEY (lang, conf, lemma, scoretype, metric))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS ranking ON results (lang, lemma, scoretype, metric, score)")
+
+    def add(self, lang, conf, lemma, scoretype, precision, recall):
+        """Record the precision and recall of a lemma, replacing earlier scores. Call commit() when done"""
+        self.db.executemany("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?)", [ (lang, conf, lemma, scoretype, 'precision', precision), (lang, conf, lemma, scoretype, 'recall', recall) ])
+
+    def load(self, lang, conf, filename):
+        """Record the scores from a results file (as written by scorereport) of an earlier run"""
+        scoretype = None
+        f = codecs.open(filename,'r','utf-8')
+        for line in f:
+            line = line.strip()
+            if line:
+                if line[:4] == 'BEST':
+                    scoretype = 'best'
+                elif line[:3] == 'OUT':
+                    scoretype = 'oof'
+                elif line[0] != '-' and scoretype:
+                    fields = line.split("\t")
+                    lemma = fields[0].strip(':')
+                    if lemma == 'AVERAGE':
+                        lemma = u'OVERALL'
+                    self.add(lang, conf, lemma, scoretype, float(fields[1]), float(fields[2]))
+        f.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def __contains__(self, key):
+        lang, conf = key
+        return self.db.execute("SELECT 1 FROM results WHERE lang = ? AND conf = ? LIMIT 1", (lang, conf)).fetchone() is not None
+
+    def configurations(self, lang = None):
+        if lang:
+            return [ row[0] for row in self.db.execute("SELECT DISTINCT conf FROM results WHERE lang = ? ORDER BY conf", (lang,)) ]
+        else:
+            return [ row[0] for row in self.db.execute("SELECT DISTINCT conf FROM results ORDER BY conf") ]
+
+    def lemmas(self, lang):
+        return [ row[0] for row in self.db.execute("SELECT DISTINCT lemma FROM results WHERE lang = ? ORDER BY lemma", (lang,)) ]
+
+    def scores(self, lang, lemma, scoretype, metric = 'precision'):
+        """Returns a dictionary of configuration -> score for a lemma"""
+        return dict( self.db.execute("SELECT conf, score FROM results WHERE lang = ? AND lemma = ? AND scoretype = ? AND metric = ?", (lang, lemma, scoretype, metric)) )
+
+    def top(self, lang, lemma, scoretype, metric = 'precision', k = 3):
+        """Returns the k best configurations for a lemma, as a list of (configuration, score)"""
+        return [ tuple(row) for row in self.db.execute("SELECT conf, score FROM results WHERE lang = ? AND lemma = ? AND scoretype = ? AND metric = ? ORDER BY score DESC, conf LIMIT ?", (lang, lemma, scoretype, metric, k)) ]